@@ -8,7 +8,6 @@ import os
 import sys
 import json
 import base64
-import glob
 import logging
 from datetime import datetime
 import time
@@ -45,14 +44,16 @@ sys.path.insert(0, str(BASE_DIR))
 try:
     from helper_st import (
         UIHelper, MessageManagerUI, ResponseProcessorUI,
-        SessionStateManager, error_handler_ui, timer_ui,
-        InfoPanelManager, safe_streamlit_json, EasyInputMessageParam
+        SessionStateManager, error_handler_ui, timer_ui, cache_result_ui,
+        InfoPanelManager, safe_streamlit_json, EasyInputMessageParam, VisionBatchUI
     )
     from helper_api import (
         config, logger, TokenManager, AnthropicClient,
         MessageParam, ConfigManager, MessageManager, sanitize_key,
         error_handler, timer, get_default_messages, get_system_prompt,
-        ResponseProcessor, format_timestamp
+        ResponseProcessor, format_timestamp, CostSimulator, ConversationLog,
+        ConversationBuilder, ConversationCompactor, ImageEncoder,
+        Base64Payload, AnimationSampler, ImageDirectoryIndex, CityIndex, image_cache
     )
 except ImportError as e:
     st.error(f"ヘルパーモジュールのインポートに失敗しました: {e}")
@@ -225,6 +226,10 @@ class BaseDemo(ABC):
         # その他のパラメータ
         api_params.update(kwargs)
 
+        # ストリーミング表示が有効な場合は差分を逐次表示し、最終Messageを返す
+        if ResponseProcessorUI.is_streaming_enabled():
+            return ResponseProcessorUI.create_message(self.client.client, stream=True, **api_params)
+
         # create_message を使用（Anthropic API）
         return self.client.create_message(**api_params)
 
@@ -386,11 +391,12 @@ print(response.content[0].text)
             {"role": "user", "content": user_input}
         )
 
+        started = time.perf_counter()
         with st.spinner("処理中..."):
             response = self.call_api_unified(messages, temperature=temperature, max_tokens=max_tokens)
 
         # セッション状態に保存
-        st.session_state[f"last_response_{self.safe_key}"] = response
+        st.session_state[f"last_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
         st.session_state[f"last_query_{self.safe_key}"] = user_input
         st.success("✅ 応答を取得しました")
     
@@ -420,8 +426,9 @@ class MemoryResponseDemo(BaseDemo):
 
     def __init__(self, demo_name: str):
         super().__init__(demo_name)
-        # 会話ステップの管理
+        # 会話ステップの管理（各ステップは共有ログ上の範囲のみを保持）
         self.conversation_steps = []
+        self.conversation_log = ConversationLog()
         self._initialize_conversation_state()
 
     def _initialize_conversation_state(self):
@@ -430,7 +437,19 @@ class MemoryResponseDemo(BaseDemo):
         if session_key not in st.session_state:
             st.session_state[session_key] = []
 
+        log_key = f"conversation_log_{self.safe_key}"
+        if log_key not in st.session_state:
+            st.session_state[log_key] = ConversationLog()
+
         self.conversation_steps = st.session_state[session_key]
+        self.conversation_log = st.session_state[log_key]
+
+    def _messages_at_step(self, step: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """ステップ時点で送信したメッセージ列の再構成（旧形式のステップはそのまま）"""
+        if 'log_range' in step:
+            start, end = step['log_range']
+            return self.conversation_log.slice(start, end)
+        return step.get('messages_at_step', [])
 
     @error_handler_ui
     @timer_ui
@@ -561,8 +580,8 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
                     if 'usage' in step and step['usage']:
                         usage = step['usage']
                         st.write(f"**トークン使用**")
-                        st.write(f"入力: {usage.get('prompt_tokens', 0)}")
-                        st.write(f"出力: {usage.get('completion_tokens', 0)}")
+                        st.write(f"入力: {usage.get('input_tokens', usage.get('prompt_tokens', 0))}")
+                        st.write(f"出力: {usage.get('output_tokens', usage.get('completion_tokens', 0))}")
                         st.write(f"合計: {usage.get('total_tokens', 0)}")
 
                 # ユーザーの質問
@@ -577,7 +596,7 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
                 # この時点でのメッセージ履歴
                 if st.checkbox(f"メッセージ履歴を表示 (ステップ {i})", key=f"show_messages_{i}_{self.safe_key}"):
                     st.write("**📋 この時点でのメッセージ履歴:**")
-                    messages = step.get('messages_at_step', [])
+                    messages = self._messages_at_step(step)
                     for j, msg in enumerate(messages):
                         role = msg.get('role', 'unknown')
                         content = msg.get('content', '')
@@ -588,8 +607,10 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
         """入力フォームの作成（a05パターンを適用）"""
         # 現在の会話コンテキスト情報
         if self.conversation_steps:
+            history_tokens = self._get_message_builder().total_tokens
             st.info(
-                f"ℹ️ 現在 {len(self.conversation_steps)} ステップの会話履歴があります。新しい質問はこの履歴を踏まえて回答されます。")
+                f"ℹ️ 現在 {len(self.conversation_steps)} ステップの会話履歴があります（約 {history_tokens:,} トークン）。"
+                "新しい質問はこの履歴を踏まえて回答されます。")
         else:
             st.info("ℹ️ 最初の質問です。会話を開始してください。")
 
@@ -625,6 +646,10 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
         # ユーザー入力の同期
         st.session_state[input_key] = user_input
 
+        # トークン情報のプレビュー（メモ化済みのため再実行・送信時に再計算しない）
+        if user_input.strip():
+            UIHelper.show_token_info(user_input, self.model, position="sidebar")
+
         # パラメータ設定セクション
         col1, col2, col3 = st.columns([2, 1, 1])
         with col1:
@@ -702,36 +727,56 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
         if session_key in st.session_state:
             st.session_state[session_key]['execution_count'] += 1
 
-        # トークン情報の表示
-        UIHelper.show_token_info(user_input, self.model, position="sidebar")
-
-        # メッセージ履歴の構築
-        messages = self._build_conversation_messages(user_input)
+        # メッセージ履歴の構築（ビルダーに新しい質問を追加）
+        builder = self._get_message_builder()
+        self._apply_compaction(builder)
+        messages = self._build_conversation_messages(user_input, builder)
 
-        # APIコール
+        # APIコール（call_api_unified はエラー表示後にNoneを返すので、追加した質問を取り消す）
+        started = time.perf_counter()
         with st.spinner("🤖 AIが思考中..."):
             response = self.call_api_unified(messages, temperature=temperature)
+        if response is None:
+            builder.pop()
+            return
 
-        # レスポンスからテキストを抽出
-        assistant_texts = ResponseProcessor.extract_text(response)
-        assistant_response = assistant_texts[0] if assistant_texts else "応答を取得できませんでした"
-
-        # 会話ステップの記録
+        # 軽量レコードに変換（Messageオブジェクトはセッションに保持しない）
+        record = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
+        assistant_response = record.texts[0] if record.texts else "応答を取得できませんでした"
+
+        # 送信内容を共有ログに追記（ログが送信内容の先頭と一致しない場合は送信内容を丸ごと追記）
+        log = self.conversation_log
+        sync = self._builder_sync()
+        start = sync.get('log_start')
+        if start is None or len(log) - start != len(messages) - 1:
+            start = len(log)
+            log.extend([dict(msg) for msg in builder.plain_messages()[:-1]])
+            sync['log_start'] = start
+        log.append(dict(messages[-1]))
+        end = len(log)
+        log.append({"role": "assistant", "content": assistant_response})
+        builder.append("assistant", assistant_response)
+
+        # 会話ステップの記録（メッセージ列はログ上の範囲のみ）
         step_data = {
             'step_number'       : len(self.conversation_steps) + 1,
             'timestamp'         : format_timestamp(),
             'model'             : self.model,
             'user_input'        : user_input,
             'assistant_response': assistant_response,
-            'messages_at_step'  : [dict(msg) for msg in messages],  # EasyInputMessageParamを辞書に変換
+            'log_range'         : [start, end],
             'temperature'       : temperature,
-            'usage'             : self._extract_usage_info(response),
-            'total_tokens'      : self._calculate_total_tokens(response)
+            'usage'             : record.usage,
+            'total_tokens'      : record.total_tokens
         }
 
         # セッション状態に保存
         self.conversation_steps.append(step_data)
         st.session_state[f"conversation_steps_{self.safe_key}"] = self.conversation_steps
+        sync['steps'] = len(self.conversation_steps)
+
+        # 履歴が閾値を超えていれば古いターンの要約をバックグラウンドで開始（次ターンで適用）
+        self._schedule_compaction(builder)
 
         # 成功メッセージと即座の表示更新
         st.success(f"✅ ステップ {step_data['step_number']} の応答を取得しました")
@@ -743,48 +788,71 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
         # フォームの再描画（入力フィールドがクリアされる）
         st.rerun()
 
-    def _build_conversation_messages(self, new_user_input: str) -> List[MessageParam]:
-        """会話履歴を基にメッセージリストを構築"""
-        # デフォルトメッセージから開始
-        messages = get_default_messages()
-
-        # 過去の会話ステップを追加
-        for step in self.conversation_steps:
-            messages.append({"role": "user", "content": step['user_input']})
-            messages.append({"role": "assistant", "content": step['assistant_response']})
-
-        # 新しいユーザー入力を追加
-        messages.append({"role": "user", "content": new_user_input})
-
-        return messages
-
-    def _extract_usage_info(self, response: Message) -> Dict[str, Any]:
-        """レスポンスから使用量情報を抽出"""
-        try:
-            if hasattr(response, 'usage') and response.usage:
-                usage_obj = response.usage
-
-                # Pydantic モデルの場合
-                if hasattr(usage_obj, 'model_dump'):
-                    return usage_obj.model_dump()
-                elif hasattr(usage_obj, 'dict'):
-                    return usage_obj.dict()
-                else:
-                    # 手動で属性を抽出
-                    return {
-                        'input_tokens' : getattr(usage_obj, 'input_tokens', 0),
-                        'output_tokens': getattr(usage_obj, 'output_tokens', 0),
-                        'total_tokens' : getattr(usage_obj, 'input_tokens', 0) + getattr(usage_obj, 'output_tokens', 0)
-                    }
-            return {}
-        except Exception as e:
-            logger.error(f"使用量情報の抽出エラー: {e}")
-            return {}
+    def _builder_sync(self) -> Dict[str, Any]:
+        """ビルダーの同期情報（反映済みステップ数・共有ログ上の送信内容の開始位置）"""
+        key = f"conversation_sync_{self.safe_key}"
+        sync = st.session_state.get(key)
+        if not isinstance(sync, dict):
+            sync = {'steps': None, 'log_start': None}
+            st.session_state[key] = sync
+        return sync
+
+    def _get_message_builder(self) -> ConversationBuilder:
+        """送信用メッセージ列のビルダー（反映済みステップ数が会話ステップと合わない場合のみ再構築）"""
+        key = f"conversation_builder_{self.safe_key}"
+        builder = st.session_state.get(key)
+        sync = self._builder_sync()
+        if not isinstance(builder, ConversationBuilder) or sync.get('steps') != len(self.conversation_steps):
+            builder = ConversationBuilder(get_default_messages(), model=self.model)
+            for step in self.conversation_steps:
+                builder.append("user", step['user_input'])
+                builder.append("assistant", step['assistant_response'])
+            st.session_state[key] = builder
+            sync['steps'] = len(self.conversation_steps)
+            sync['log_start'] = None
+        return builder
+
+    def _reset_message_builder(self):
+        """ビルダー・同期情報・実行中の要約を破棄（履歴のクリア・インポート時。次の送信で再構築）"""
+        st.session_state.pop(f"conversation_builder_{self.safe_key}", None)
+        st.session_state[f"conversation_sync_{self.safe_key}"] = {'steps': None, 'log_start': None}
+        self._get_compactor().discard()
+
+    def _get_compactor(self) -> ConversationCompactor:
+        """会話コンパクション（セッションごとに1つ）"""
+        key = f"conversation_compactor_{self.safe_key}"
+        compactor = st.session_state.get(key)
+        if not isinstance(compactor, ConversationCompactor):
+            compactor = ConversationCompactor()
+            st.session_state[key] = compactor
+        return compactor
+
+    def _schedule_compaction(self, builder: ConversationBuilder):
+        """閾値超過時に古いターンの要約をバックグラウンドで開始"""
+        if config.get("compaction.enabled", True) is not True:
+            return
+        compactor = self._get_compactor()
+        if compactor.pending or builder.total_tokens <= compactor.threshold_tokens:
+            return
+        compactor.submit(self.client.client, builder.plain_messages(), builder.total_tokens, owner=builder)
 
-    def _calculate_total_tokens(self, response: Message) -> int:
-        """総トークン数の計算"""
-        usage_info = self._extract_usage_info(response)
-        return usage_info.get('total_tokens', 0)
+    def _apply_compaction(self, builder: ConversationBuilder):
+        """完了した要約があれば古いターンを要約メッセージに置き換える"""
+        result = self._get_compactor().poll(builder)
+        if result is None:
+            return
+        cut, summary = result
+        builder.replace_head(cut, [summary])
+        # 送信内容がログと一致しなくなるため、次の記録時に要約後の送信内容をログへ追記する
+        self._builder_sync()['log_start'] = None
+        st.caption(f"🗜️ 古い会話 {cut} 件を要約に置き換えました（履歴 約 {builder.total_tokens:,} トークン）")
+
+    def _build_conversation_messages(self, new_user_input: str,
+                                     builder: ConversationBuilder = None) -> List[MessageParam]:
+        """会話履歴を基にメッセージリストを構築（前ターンまでの構築結果に新しい質問を追加するのみ）"""
+        if builder is None:
+            builder = self._get_message_builder()
+        return builder.append("user", new_user_input)
 
     def _create_conversation_controls(self):
         """会話管理コントロール"""
@@ -796,6 +864,8 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
             if st.button("🗑️ 会話履歴クリア", key=f"clear_conv_{self.safe_key}"):
                 self.conversation_steps.clear()
                 st.session_state[f"conversation_steps_{self.safe_key}"] = []
+                st.session_state[f"conversation_log_{self.safe_key}"] = ConversationLog()
+                self._reset_message_builder()
                 st.success("会話履歴をクリアしました")
                 st.rerun()
 
@@ -828,9 +898,10 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
                 "timestamp"   : format_timestamp(),
                 "total_steps" : len(self.conversation_steps),
                 "model_used"  : self.model,
-                "demo_version": "MemoryResponseDemo_v2.0"
+                "demo_version": "MemoryResponseDemo_v2.1"
             },
-            "conversation_steps": self.conversation_steps
+            "conversation_steps": self.conversation_steps,
+            "message_log"       : self.conversation_log.to_list()
         }
 
         try:
@@ -861,11 +932,13 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
 
                 if st.button("インポート実行", key=f"execute_import_{self.safe_key}"):
                     if replace_option == "現在の履歴を置換":
-                        self.conversation_steps = imported_steps
-                    else:
-                        self.conversation_steps.extend(imported_steps)
+                        self.conversation_steps = []
+                        self.conversation_log = ConversationLog()
+                    self._append_imported_steps(imported_steps, data.get("message_log", []))
+                    self._reset_message_builder()
 
                     st.session_state[f"conversation_steps_{self.safe_key}"] = self.conversation_steps
+                    st.session_state[f"conversation_log_{self.safe_key}"] = self.conversation_log
                     st.success(f"{len(imported_steps)}ステップの会話履歴をインポートしました")
                     st.rerun()
             else:
@@ -875,6 +948,22 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
             st.error(f"インポートエラー: {e}")
             logger.error(f"Conversation import error: {e}")
 
+    def _append_imported_steps(self, steps: List[Dict[str, Any]], message_log: List[Dict[str, Any]]):
+        """インポートしたステップの追加（ログ範囲は現在のログ末尾からのオフセットに付け替える）"""
+        offset = len(self.conversation_log)
+        self.conversation_log.extend(message_log)
+        for step in steps:
+            step = dict(step)
+            if 'log_range' in step:
+                start, end = step['log_range']
+                step['log_range'] = [start + offset, end + offset]
+            elif 'messages_at_step' in step:
+                # 旧形式（v2.0）はメッセージ列をログに移す
+                start = len(self.conversation_log)
+                self.conversation_log.extend(step.pop('messages_at_step'))
+                step['log_range'] = [start, len(self.conversation_log)]
+            self.conversation_steps.append(step)
+
     def _show_conversation_statistics(self):
         """会話統計の表示"""
         if not self.conversation_steps:
@@ -898,13 +987,20 @@ conversation_history.append({"role": "assistant", "content": response_2.content[
                     avg_tokens = total_tokens / total_steps
                     st.metric("平均トークン/ステップ", f"{avg_tokens:.1f}")
 
-                # コスト推定
+                # コスト推定（記録済みの入力・出力トークンから算出）
                 try:
-                    estimated_cost = TokenManager.estimate_cost(
-                        total_tokens // 2,  # 概算で半分を入力トークンと仮定
-                        total_tokens // 2,  # 半分を出力トークンと仮定
-                        self.model
-                    )
+                    simulator = CostSimulator()
+                    usages = [step.get('usage') or {} for step in self.conversation_steps]
+                    tokens = [
+                        [usage.get('input_tokens', step.get('total_tokens', 0) // 2),
+                         usage.get('output_tokens', step.get('total_tokens', 0) // 2)]
+                        for step, usage in zip(self.conversation_steps, usages)
+                    ]
+                    if self.model in simulator.model_index:
+                        costs = simulator.cost_matrix(tokens)
+                        estimated_cost = float(costs[:, simulator.model_index[self.model]].sum())
+                    else:
+                        estimated_cost = sum(TokenManager.estimate_cost(i, o, self.model) for i, o in tokens)
                     st.metric("推定総コスト", f"${estimated_cost:.6f}")
                 except Exception as e:
                     st.warning(f"コスト推定エラー: {e}")
@@ -1033,6 +1129,13 @@ class ImageResponseDemo(BaseDemo):
         st.write("**📁 ローカル画像ファイルからBase64エンコード**")
         st.info("💡 Anthropic APIはbase64エンコード後最大5MBまでの画像を処理できます")
         
+        mode = st.radio("処理モード", ["1枚ずつ", "フォルダ一括"], horizontal=True,
+                        key=f"img_mode_{self.safe_key}")
+        if mode == "フォルダ一括":
+            VisionBatchUI.render(self.client, self.model, self.safe_key,
+                                 default_prompt="この画像を詳しく説明してください。")
+            return
+        
         images_dir = config.get("paths.images_dir", "images")
         
         # imagesディレクトリが存在しない場合はdataディレクトリを試す
@@ -1071,14 +1174,9 @@ class ImageResponseDemo(BaseDemo):
                 file_path = files[0]
                 st.write(f"**選択されたファイル:** {Path(file_path).name}")
             else:
-                file_options = [f"{Path(f).name} ({self._get_file_size_info(f)})" for f in files]
-                selected_idx = st.selectbox(
-                    "📷 画像ファイルを選択", 
-                    range(len(file_options)),
-                    format_func=lambda x: file_options[x],
-                    key=f"img_select_{self.safe_key}"
-                )
-                file_path = files[selected_idx]
+                file_path = self._select_indexed_image(images_dir)
+                if file_path is None:
+                    return
             
             # ファイル情報表示
             if file_path and Path(file_path).exists():
@@ -1132,34 +1230,112 @@ class ImageResponseDemo(BaseDemo):
             st.warning(f"ファイル情報取得エラー: {e}")
 
     def _get_image_files(self, images_dir: str) -> List[str]:
-        """画像ファイルのリストを取得"""
-        patterns = ["*.png", "*.jpg", "*.jpeg", "*.webp", "*.gif"]
-        files = []
-        for pattern in patterns:
-            files.extend(glob.glob(f"{images_dir}/{pattern}"))
-        return sorted(files)
+        """画像ファイルのリストを取得（永続インデックスから・変更分のみ再走査）"""
+        entries, _ = ImageDirectoryIndex.for_directory(images_dir).list()
+        return [entry['path'] for entry in entries]
+    
+    def _select_indexed_image(self, images_dir: str) -> Optional[str]:
+        """インデックスを使った画像選択（ファイル名の絞り込み・ページ分割）"""
+        index = ImageDirectoryIndex.for_directory(images_dir)
+        page_size = config.get("image_index.page_size", 50)
+        query = ""
+        if len(index) > page_size:
+            query = st.text_input("🔍 ファイル名で絞り込み", key=f"img_filter_{self.safe_key}")
+        total = index.count(query)
+        if not total:
+            st.warning("🔍 条件に一致する画像がありません")
+            return None
         
+        # 表示するページ分のエントリだけを取得
+        page = 1
+        pages = (total + page_size - 1) // page_size
+        if pages > 1:
+            page = st.number_input(f"ページ（全{pages}ページ・{total}件）", min_value=1, max_value=pages,
+                                   value=1, key=f"img_page_{self.safe_key}")
+        page_entries, _ = index.list(query, offset=(page - 1) * page_size, limit=page_size)
+        if not page_entries:
+            return None
+        
+        # サムネイルはインデックスに保存済みのものを表示（元画像は読み込まない）
+        thumbnails = [entry for entry in page_entries if entry.get('thumbnail')]
+        if thumbnails:
+            with st.expander(f"🖼️ サムネイル（{len(thumbnails)}件）", expanded=False):
+                st.image([entry['thumbnail'] for entry in thumbnails],
+                         caption=[entry['name'] for entry in thumbnails], width=96)
+        
+        selected_idx = st.selectbox(
+            "📷 画像ファイルを選択",
+            range(len(page_entries)),
+            format_func=lambda x: f"{page_entries[x]['name']} ({self._format_size_info(page_entries[x])})",
+            key=f"img_select_{self.safe_key}"
+        )
+        entry = page_entries[selected_idx]
+        
+        # インデックスの内容ハッシュを画像キャッシュに渡し、送信時の再ハッシュを省略
+        image_cache.remember_hash(entry['path'], entry['size'], entry['mtime_ns'], entry.get('content_hash'))
+        return entry['path']
+    
     def _get_file_size_info(self, file_path: str) -> str:
-        """ファイルサイズ情報を取得（Anthropic API制限対応）"""
+        """ファイルサイズ情報を取得（Anthropic API制限対応・インデックス登録済みならstat不要）"""
         try:
-            size_bytes = os.path.getsize(file_path)
-            size_mb = size_bytes / (1024 * 1024)
-            
-            # base64エンコード後の推定サイズ（約137%増加）
-            estimated_base64_mb = size_mb * 1.37
-            max_size_mb = config.get("limits.max_image_size_mb", 5)  # Anthropic APIの制限
-            
-            if estimated_base64_mb <= max_size_mb:
-                status = "✅"
-            elif estimated_base64_mb <= max_size_mb * 1.5:  # リサイズで対応可能
-                status = "🔄"
-            else:
-                status = "⚠️"  # 大幅なリサイズが必要
-                
-            return f"{status} {size_mb:.2f}MB → ~{estimated_base64_mb:.1f}MB"
+            entry = ImageDirectoryIndex.for_directory(Path(file_path).parent).get(Path(file_path).name)
+            if entry is None:
+                entry = {'size': os.path.getsize(file_path), 'width': None, 'height': None}
+            return self._format_size_info(entry)
         except Exception:
             return "❓ サイズ不明"
-
+    
+    @staticmethod
+    def _format_size_info(entry: Dict[str, Any]) -> str:
+        """サイズ・base64後サイズ・解像度の表示文字列"""
+        size_mb = entry['size'] / (1024 * 1024)
+        base64_mb = ImageEncoder.base64_size(entry['size']) / (1024 * 1024)
+        max_size_mb = config.get("limits.max_image_size_mb", 5)  # Anthropic APIの制限
+        
+        if base64_mb <= max_size_mb:
+            status = "✅"
+        elif base64_mb <= max_size_mb * 1.5:  # リサイズで対応可能
+            status = "🔄"
+        else:
+            status = "⚠️"  # 大幅なリサイズが必要
+        
+        resolution = f", {entry['width']}x{entry['height']}" if entry.get('width') else ""
+        return f"{status} {size_mb:.2f}MB → ~{base64_mb:.1f}MB{resolution}"
+
+    def _encode_image_blocks(self, path: str) -> List[Dict[str, Any]]:
+        """画像のコンテンツブロック（アニメーションGIF/WebPは代表フレームを抽出）"""
+        if AnimationSampler.applies_to(path):
+            blocks = self._encode_animation(path)
+            if blocks:
+                return blocks
+        b64_data, media_type = self._encode_image(path)
+        if not b64_data:
+            return []
+        return [ImageEncoder.image_block(b64_data, media_type)]
+    
+    def _encode_animation(self, path: str) -> List[Dict[str, Any]]:
+        """アニメーションから代表フレームを抽出してコンテンツブロック化（結果はキャッシュ）"""
+        try:
+            max_base64_bytes = config.get("limits.max_image_size_mb", 5) * 1024 * 1024
+            max_long_edge = ImageEncoder.default_max_long_edge()
+            if config.get("images.cache_enabled", True) is True:
+                payloads, stats = image_cache.get_or_encode_animation(path, max_base64_bytes, max_long_edge)
+            else:
+                payloads, stats = AnimationSampler.encode(path, max_base64_bytes, max_long_edge)
+            if not payloads:
+                st.warning("⚠️ フレームの抽出結果が制限内に収まらないため、元の画像を送信します")
+                return []
+            
+            mode_label = {'tile': "タイル", 'blocks': "複数画像", 'single': "動きなし"}[stats['mode']]
+            reused = "（前処理済みを再利用）" if stats.get('cached') else ""
+            st.info(f"🎞️ 全{stats['frames']}フレームから {len(stats['selected'])} フレームを抽出（{mode_label}）: "
+                    f"{stats['original_bytes'] / (1024 * 1024):.2f}MB → "
+                    f"{stats['base64_bytes'] / (1024 * 1024):.2f}MB (base64){reused}")
+            return AnimationSampler.content_blocks(payloads, stats)
+        except Exception as e:
+            st.warning(f"⚠️ フレーム抽出エラー: {e}")
+            return []
+    
     def _encode_image(self, path: str) -> Tuple[str, str]:
         """画像をBase64エンコード（Anthropic API対応）
         
@@ -1167,157 +1343,114 @@ class ImageResponseDemo(BaseDemo):
             Tuple[str, str]: (base64_encoded_data, media_type)
         """
         try:
-            # ファイル拡張子からメディアタイプを判定
-            ext = Path(path).suffix.lower()
-            media_type_map = {
-                '.jpg': 'image/jpeg',
-                '.jpeg': 'image/jpeg', 
-                '.png': 'image/png',
-                '.webp': 'image/webp',
-                '.gif': 'image/gif'
-            }
-            original_media_type = media_type_map.get(ext, 'image/jpeg')
-            
             # Anthropic APIの制限: 5MB (base64エンコード後)
             max_base64_size_mb = config.get("limits.max_image_size_mb", 5)
             max_base64_bytes = max_base64_size_mb * 1024 * 1024
             
-            # ファイルサイズをチェック
+            # ファイルサイズからbase64エンコード後のサイズを算出（エンコード不要）
             file_size = os.path.getsize(path)
             file_size_mb = file_size / (1024 * 1024)
-            
-            # base64エンコード後の推定サイズ（約133%増加）
-            estimated_base64_size = file_size * 1.37
+            base64_size = ImageEncoder.base64_size(file_size)
             
             st.info(f"📂 ファイル: {Path(path).name}")
-            st.info(f"📊 元サイズ: {file_size_mb:.2f}MB, 推定base64サイズ: {estimated_base64_size/(1024*1024):.2f}MB")
+            st.info(f"📊 元サイズ: {file_size_mb:.2f}MB, base64サイズ: {base64_size/(1024*1024):.2f}MB")
+            
+            # 送信前の見積もり（モデルの実効解像度を超える場合は縮小して送信）
+            max_long_edge = ImageEncoder.default_max_long_edge()
+            preflight = ImageEncoder.preflight(path, self.model, max_long_edge)
+            self._show_preflight(preflight)
+            
+            # 同じ内容・同じ制約で前処理済みならキャッシュを再利用
+            use_cache = config.get("images.cache_enabled", True) is True
+            if use_cache:
+                cached = image_cache.get(path, max_base64_bytes=max_base64_bytes, max_long_edge=max_long_edge)
+                if cached is not None:
+                    similar = "（ほぼ同じ画像を検出）" if image_cache.is_near_duplicate(path) else ""
+                    st.success(f"♻️ 前処理済みの画像を再利用しました{similar}: "
+                               f"{len(cached['data']) / (1024 * 1024):.2f}MB (base64)")
+                    return cached['data'], cached['media_type']
+            
+            target_size = preflight['send_size'] if preflight['downscale'] else None
+            encoded_data, media_type = self._encode_image_uncached(path, max_base64_bytes, target_size)
+            if use_cache:
+                image_cache.set(path, encoded_data, media_type,
+                                max_base64_bytes=max_base64_bytes, max_long_edge=max_long_edge)
+            return encoded_data, media_type
+            
+        except Exception as e:
+            st.error(f"画像エンコードエラー: {e}")
+            return "", "image/jpeg"
+    
+    def _show_preflight(self, preflight: Dict[str, Any]):
+        """送信前の見積もり表示（解像度・推定トークン数・推定入力コスト）"""
+        original = preflight['original_size']
+        send = preflight['send_size']
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("📐 送信解像度", f"{send[0]}x{send[1]}",
+                      delta=f"元 {original[0]}x{original[1]}" if preflight['downscale'] else None,
+                      delta_color="off")
+        with col2:
+            st.metric("🔢 推定画像トークン", f"{preflight['tokens']:,}")
+        with col3:
+            st.metric("💰 推定入力コスト", f"${preflight['cost_usd']:.5f}")
+    
+    def _encode_image_uncached(self, path: str, max_base64_bytes: int,
+                               target_size: Optional[Tuple[int, int]] = None) -> Tuple[str, str]:
+        """画像をBase64エンコード（キャッシュ未使用・必要時のみリサイズ）"""
+        try:
+            base64_size = ImageEncoder.base64_size(os.path.getsize(path))
+            
+            # モデルの実効解像度を超える場合は縮小（モデル側でも縮小されるため、送信量のみ削減）
+            if target_size is not None:
+                st.info(f"📐 実効解像度に合わせて {target_size[0]}x{target_size[1]} に縮小します")
+                return self._resize_and_encode_image(path, max_base64_bytes, target_size)
             
             # サイズが制限を超える場合はリサイズ
-            if estimated_base64_size > max_base64_bytes:
-                st.warning(f"⚠️ 推定base64サイズが制限({max_base64_size_mb}MB)を超過するため、リサイズします")
+            if base64_size > max_base64_bytes:
+                st.warning(f"⚠️ base64サイズが制限({max_base64_bytes / (1024 * 1024):.0f}MB)を超過するため、リサイズします")
                 return self._resize_and_encode_image(path, max_base64_bytes)
             
-            # サイズが問題なければそのままエンコード
-            with open(path, 'rb') as image_file:
-                image_bytes = image_file.read()
-                encoded_data = base64.b64encode(image_bytes).decode('utf-8')
-                
-            # 実際のbase64サイズをチェック
-            actual_base64_size = len(encoded_data.encode('utf-8'))
-            actual_size_mb = actual_base64_size / (1024 * 1024)
-            
-            if actual_base64_size > max_base64_bytes:
-                st.warning(f"⚠️ 実際のbase64サイズ({actual_size_mb:.2f}MB)が制限を超過するため、リサイズします")
+            # 向き補正・メタデータ除去・最小形式の選択
+            if ImageEncoder.optimize_enabled():
                 return self._resize_and_encode_image(path, max_base64_bytes)
             
-            st.success(f"✅ エンコード完了: {actual_size_mb:.2f}MB (base64)")
-            return encoded_data, original_media_type
+            # サイズが問題なければそのままエンコード（mmap + チャンク単位、ファイル全体は読み込まない）
+            encoded_data = Base64Payload.encode_file(path)
+            
+            st.success(f"✅ エンコード完了: {base64_size / (1024 * 1024):.2f}MB (base64)")
+            return encoded_data, ImageEncoder.media_type_for(path)
             
         except Exception as e:
             st.error(f"画像エンコードエラー: {e}")
             return "", "image/jpeg"
             
-    def _resize_and_encode_image(self, path: str, max_base64_bytes: int) -> Tuple[str, str]:
+    def _resize_and_encode_image(self, path: str, max_base64_bytes: int,
+                                 target_size: Optional[Tuple[int, int]] = None) -> Tuple[str, str]:
         """画像をリサイズしてBase64エンコード（Anthropic API制限対応）
         
+        品質→縮小率の順に二分探索し、制限をわずかに下回る設定を少ないエンコード回数で求める。
+        
         Returns:
             Tuple[str, str]: (base64_encoded_data, media_type)
         """
         try:
-            st.info("🔄 リサイズ処理を開始...")
+            st.info("🔄 画像の変換を開始...")
+            encoded_data, media_type, stats = ImageEncoder.resize_and_encode(path, max_base64_bytes, target_size)
             
-            # 元の拡張子からメディアタイプを判定
-            ext = Path(path).suffix.lower()
-            preserve_format = ext in ['.png', '.webp']  # 透明度を保持したい形式
-            
-            with Image.open(path) as img:
-                original_size = img.size
-                original_mode = img.mode
-                
-                st.info(f"📐 元画像: {original_size[0]}x{original_size[1]}, モード: {original_mode}")
-                
-                # フォーマット決定
-                if preserve_format and ext == '.png':
-                    save_format = 'PNG'
-                    media_type = 'image/png'
-                elif preserve_format and ext == '.webp':
-                    save_format = 'WebP'
-                    media_type = 'image/webp'
-                else:
-                    save_format = 'JPEG'
-                    media_type = 'image/jpeg'
-                    # JPEGの場合はRGBに変換
-                    if img.mode in ('RGBA', 'LA', 'P'):
-                        # 透明度がある場合は白背景で合成
-                        if img.mode == 'P':
-                            img = img.convert('RGBA')
-                        if 'transparency' in img.info or img.mode in ('RGBA', 'LA'):
-                            background = Image.new('RGB', img.size, (255, 255, 255))
-                            if img.mode == 'RGBA':
-                                background.paste(img, mask=img.split()[-1])
-                            else:
-                                background.paste(img)
-                            img = background
-                        else:
-                            img = img.convert('RGB')
-                
-                # 段階的リサイズ処理
-                quality = 90 if save_format == 'JPEG' else None
-                scale_factor = 0.9
-                attempt = 0
-                max_attempts = 15
-                
-                while attempt < max_attempts:
-                    # 画像を保存してbase64エンコード
-                    buffer = io.BytesIO()
-                    
-                    if save_format == 'JPEG':
-                        img.save(buffer, format=save_format, quality=quality, optimize=True)
-                    elif save_format == 'PNG':
-                        img.save(buffer, format=save_format, optimize=True)
-                    else:  # WebP
-                        img.save(buffer, format=save_format, quality=quality or 90, optimize=True)
-                    
-                    # base64エンコード
-                    buffer.seek(0)
-                    image_bytes = buffer.read()
-                    encoded_data = base64.b64encode(image_bytes).decode('utf-8')
-                    encoded_size = len(encoded_data.encode('utf-8'))
-                    
-                    size_mb = encoded_size / (1024 * 1024)
-                    
-                    if encoded_size <= max_base64_bytes:
-                        st.success(f"✅ リサイズ完了: {img.size[0]}x{img.size[1]} → {size_mb:.2f}MB (base64)")
-                        return encoded_data, media_type
-                    
-                    # サイズがまだ大きい場合の調整
-                    attempt += 1
-                    
-                    if attempt <= 5:
-                        # 最初は品質を下げる（JPEGとWebPのみ）
-                        if save_format in ['JPEG', 'WebP'] and quality:
-                            quality = max(60, quality - 10)
-                    else:
-                        # サイズを縮小
-                        new_width = int(img.width * scale_factor)
-                        new_height = int(img.height * scale_factor)
-                        
-                        # 最小サイズチェック
-                        if new_width < 100 or new_height < 100:
-                            st.error("❌ 最小サイズ(100x100)を下回るため、リサイズを中止")
-                            return "", media_type
-                        
-                        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                        
-                        # 品質もさらに下げる
-                        if save_format in ['JPEG', 'WebP'] and quality:
-                            quality = max(40, quality - 5)
-                    
-                    if attempt % 3 == 0:
-                        st.info(f"🔄 リサイズ中 ({attempt}/{max_attempts}): {img.size[0]}x{img.size[1]}, {size_mb:.2f}MB")
-                
-                st.error(f"❌ 最大試行回数({max_attempts})を超過。最終サイズ: {size_mb:.2f}MB")
+            if stats is None:
+                min_side = config.get("images.min_side", 100)
+                st.error(f"❌ 最小サイズ(短辺{min_side}px)まで縮小しても制限内に収まりません")
                 return "", media_type
+            
+            original = stats['original_size']
+            width, height = stats['size']
+            quality = f", 品質 {stats['quality']}" if stats['quality'] else ""
+            image_format = f" {stats['format']}" if stats.get('format') else ""
+            st.success(
+                f"✅ 変換完了: {original[0]}x{original[1]} → {width}x{height}{image_format}{quality} → "
+                f"{stats['base64_bytes'] / (1024 * 1024):.2f}MB (base64, エンコード {stats['encodes']} 回)")
+            return encoded_data, media_type
                             
         except Exception as e:
             st.error(f"❌ 画像リサイズエラー: {e}")
@@ -1348,38 +1481,42 @@ class ImageResponseDemo(BaseDemo):
 
     def _process_base64_image(self, file_path: str, question: str, temperature: Optional[float]):
         """Base64画像の処理（Anthropic API対応版）"""
+        # 内容が同じ画像への同じ質問なら過去の回答を再利用
+        answer_params = {'model': self.get_model(), 'temperature': temperature}
+        use_answer_cache = image_cache.answers_enabled()
+        if use_answer_cache:
+            cached_answer = image_cache.get_answer(file_path, question, **answer_params)
+            if cached_answer is not None:
+                st.success("♻️ 同じ画像・同じ質問の回答を再利用しました（API呼び出しなし）")
+                st.subheader("🎯 解析結果:")
+                ResponseProcessorUI.display_response(cached_answer)
+                return
+        
         # 画像エンコード
         with st.spinner("🔄 画像をエンコード中..."):
-            b64_data, media_type = self._encode_image(file_path)
+            image_blocks = self._encode_image_blocks(file_path)
             
-        if not b64_data:
+        if not image_blocks:
             st.error("❌ 画像のエンコードに失敗しました")
             return
 
         # エンコード結果の表示
-        st.success(f"✅ エンコード完了: {media_type}")
+        media_types = sorted({block['source']['media_type'] for block in image_blocks if block['type'] == 'image'})
+        st.success(f"✅ エンコード完了: {', '.join(media_types)}")
         
         # メッセージ構築（Anthropic API形式）
         messages = get_default_messages()
         messages.append({
             "role": "user",
-            "content": [
-                {"type": "text", "text": question},
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": media_type,
-                        "data": b64_data
-                    }
-                }
-            ]
+            "content": [{"type": "text", "text": question}] + image_blocks
         })
 
         # API呼び出し
         with st.spinner("🤖 Claude が画像を解析中..."):
             try:
                 response = self.call_api_unified(messages, temperature=temperature)
+                if use_answer_cache:
+                    image_cache.set_answer(file_path, question, response, **answer_params)
                 
                 st.success("✅ 画像解析が完了しました")
                 st.subheader("🎯 解析結果:")
@@ -1760,6 +1897,29 @@ class Event(BaseModel):
             ''', language="python")
 
 
+# ==================================================
+# 天気API（セッション間共有キャッシュ）
+# ==================================================
+@cache_result_ui(shared=True, shared_ttl=config.get("weather.cache_ttl", 600))
+def fetch_openweather(endpoint: str, lat: float, lon: float, unit: str = "metric") -> Dict[str, Any]:
+    """OpenWeatherMap API（weather / forecast）のレスポンス
+
+    座標・単位のみで決まりユーザー固有のデータを含まないため、全セッションで共有する
+    （APIキーはキャッシュキーに含めない）。失敗時は例外を送出し、キャッシュしない。
+    """
+    params = {
+        "lat"  : lat,
+        "lon"  : lon,
+        "appid": os.getenv("OPENWEATHER_API_KEY"),
+        "units": unit,
+        "lang" : "ja"  # 日本語での天気説明
+    }
+    response = requests.get(f"http://api.openweathermap.org/data/2.5/{endpoint}", params=params,
+                            timeout=config.get("api.timeout", 30))
+    response.raise_for_status()
+    return response.json()
+
+
 # ==================================================
 # 天気デモ
 # ==================================================
@@ -1797,10 +1957,10 @@ class WeatherDemo(BaseDemo):
             st.error(f"都市データファイルが見つかりません: {cities_json}")
             return
 
-        df_jp = self._load_japanese_cities(cities_json)
+        cities = self._load_japanese_cities(cities_json)
 
         # 都市選択UI
-        city, lat, lon = self._select_city(df_jp)
+        city, lat, lon = self._select_city(cities)
 
         # APIを実行ボタンの追加
         col1, col2, col3 = st.columns([2, 1, 2])
@@ -1840,30 +2000,17 @@ class WeatherDemo(BaseDemo):
             else:
                 st.error("❌ 都市が正しく選択されていません。都市を選択してから再実行してください。")
 
-    def _load_japanese_cities(self, json_path: str) -> pd.DataFrame:
-        """日本の都市データを city_jp.list.json から読み込み"""
+    def _load_japanese_cities(self, json_path: str) -> Optional[CityIndex]:
+        """日本の都市データを列指向インデックス（名前順・プロセス内共有）として読み込み"""
         try:
-            with open(json_path, "r", encoding="utf-8") as f:
-                cities_list = json.load(f)
-            # 必要なカラムのみ抽出
-            df = pd.DataFrame([
-                {
-                    "name": city["name"],
-                    "lat" : city["coord"]["lat"],
-                    "lon" : city["coord"]["lon"],
-                    "id"  : city["id"]
-                }
-                for city in cities_list
-            ])
-            # 都市名でソート
-            return df.sort_values("name").reset_index(drop=True)
+            return CityIndex.load(json_path)
         except Exception as e:
             st.error(f"都市データの読み込みに失敗しました: {e}")
-            return pd.DataFrame()
+            return None
 
-    def _select_city(self, df: pd.DataFrame) -> tuple:
+    def _select_city(self, cities: Optional[CityIndex]) -> tuple:
         """都市選択UI（改修版）"""
-        if df.empty:
+        if not cities:
             st.error("都市データが空です")
             return "Tokyo", 35.6895, 139.69171
 
@@ -1874,14 +2021,12 @@ class WeatherDemo(BaseDemo):
         # 都市選択ボックス
         city = st.selectbox(
             "都市を選択してください",
-            df["name"].tolist(),
+            cities.name_list(),
             key=f"city_{self.safe_key}",
             help="日本国内の主要都市から選択できます"
         )
 
-        row = df[df["name"] == city].iloc[0]
-
-        return city, row["lat"], row["lon"]
+        return cities.lookup(city) or (city, None, None)
 
     def _display_weather(self, lat: float, lon: float, city_name: str = None):
         """天気情報の表示（改修版）"""
@@ -1984,18 +2129,7 @@ class WeatherDemo(BaseDemo):
             return None
 
         try:
-            url = "http://api.openweathermap.org/data/2.5/weather"
-            params = {
-                "lat"  : lat,
-                "lon"  : lon,
-                "appid": api_key,
-                "units": unit,
-                "lang" : "ja"  # 日本語での天気説明
-            }
-
-            response = requests.get(url, params=params, timeout=config.get("api.timeout", 30))
-            response.raise_for_status()
-            data = response.json()
+            data = fetch_openweather("weather", lat, lon, unit)
 
             return {
                 "city"       : data["name"],
@@ -2022,18 +2156,7 @@ class WeatherDemo(BaseDemo):
             return []
 
         try:
-            url = "http://api.openweathermap.org/data/2.5/forecast"
-            params = {
-                "lat"  : lat,
-                "lon"  : lon,
-                "units": unit,
-                "appid": api_key,
-                "lang" : "ja"  # 日本語での天気説明
-            }
-
-            response = requests.get(url, params=params, timeout=config.get("api.timeout", 30))
-            response.raise_for_status()
-            data = response.json()
+            data = fetch_openweather("forecast", lat, lon, unit)
 
             # 日別に集計
             daily = {}
@@ -2355,19 +2478,8 @@ class WebSearchToolsDemo(BaseDemo):
                 st.error(f"都市データファイルが見つかりません: {cities_json}")
                 return None
             
-            # 日本の都市データ読み込み（WeatherDemoと同じロジック）
-            with open(cities_json, "r", encoding="utf-8") as f:
-                cities_list = json.load(f)
-            
-            cities_df = pd.DataFrame([
-                {
-                    "name": city["name"],
-                    "lat" : city["coord"]["lat"],
-                    "lon" : city["coord"]["lon"],
-                    "id"  : city["id"]
-                }
-                for city in cities_list
-            ])
+            # 日本の都市データ（WeatherDemoと共有の列指向インデックス）
+            cities = CityIndex.load(cities_json)
             
             # 1. エリア→都市マッピングをチェック
             if extracted_city in self.AREA_TO_CITY_MAPPING:
@@ -2376,27 +2488,22 @@ class WebSearchToolsDemo(BaseDemo):
             else:
                 target_city = extracted_city
             
-            # 2. 完全一致検索
-            exact_match = cities_df[cities_df["name"].str.contains(target_city, case=False, na=False)]
-            if not exact_match.empty:
-                row = exact_match.iloc[0]
-                return row["name"], row["lat"], row["lon"]
+            # 2. 完全一致検索（ソート済みの名前列を二分探索）
+            exact_match = cities.lookup(target_city)
+            if exact_match:
+                return exact_match
             
             # 3. 部分一致検索
-            partial_match = cities_df[cities_df["name"].str.contains(target_city, case=False, na=False)]
-            if not partial_match.empty:
-                row = partial_match.iloc[0]
-                return row["name"], row["lat"], row["lon"]
+            partial_match = cities.search(target_city)
+            if len(partial_match):
+                return cities.row(partial_match[0])
             
             # 4. 類似度マッチング（difflib使用）
-            import difflib
-            city_names = cities_df["name"].tolist()
-            close_matches = difflib.get_close_matches(target_city, city_names, n=1, cutoff=0.6)
-            if close_matches:
-                matched_name = close_matches[0]
-                row = cities_df[cities_df["name"] == matched_name].iloc[0]
+            close_match = cities.closest(target_city, cutoff=0.6)
+            if close_match is not None:
+                matched_name, lat, lon = cities.row(close_match)
                 st.info(f"🔍 類似マッチング: '{target_city}' → '{matched_name}'")
-                return row["name"], row["lat"], row["lon"]
+                return matched_name, lat, lon
             
             return None
             
@@ -2433,18 +2540,7 @@ class WebSearchToolsDemo(BaseDemo):
             return None
 
         try:
-            url = "http://api.openweathermap.org/data/2.5/weather"
-            params = {
-                "lat"  : lat,
-                "lon"  : lon,
-                "appid": api_key,
-                "units": unit,
-                "lang" : "ja"  # 日本語での天気説明
-            }
-
-            response = requests.get(url, params=params, timeout=config.get("api.timeout", 30))
-            response.raise_for_status()
-            data = response.json()
+            data = fetch_openweather("weather", lat, lon, unit)
 
             return {
                 "city"       : data["name"],
@@ -2466,18 +2562,7 @@ class WebSearchToolsDemo(BaseDemo):
             return []
 
         try:
-            url = "http://api.openweathermap.org/data/2.5/forecast"
-            params = {
-                "lat"  : lat,
-                "lon"  : lon,
-                "appid": api_key,
-                "units": unit,
-                "lang" : "ja"
-            }
-
-            response = requests.get(url, params=params, timeout=config.get("api.timeout", 30))
-            response.raise_for_status()
-            data = response.json()
+            data = fetch_openweather("forecast", lat, lon, unit)
 
             # 3時間毎データを日別に集約
             daily_data = {}
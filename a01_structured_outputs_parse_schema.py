@@ -523,6 +523,7 @@ event_info = EventInfo(**parsed_data)
         UIHelper.show_token_info(user_text, self.model, position="sidebar")
 
         try:
+            started = time.perf_counter()
             with st.spinner("イベント情報を抽出中..."):
                 response = self.call_api_parse(
                     input_text=user_text,
@@ -532,7 +533,7 @@ event_info = EventInfo(**parsed_data)
                 )
 
             # セッション状態に保存
-            st.session_state[f"last_response_{self.safe_key}"] = response
+            st.session_state[f"last_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
             st.session_state[f"last_extraction_{self.safe_key}"] = response.output_parsed
             st.success("✅ イベント情報の抽出が完了しました")
 
@@ -578,10 +579,8 @@ event_info = EventInfo(**parsed_data)
         with col2:
             # 統計情報
             st.metric("参加者数", len(event_info.participants))
-            if hasattr(response, 'usage') and response.usage:
-                usage = response.usage
-                if hasattr(usage, 'total_tokens'):
-                    st.metric("使用トークン数", getattr(usage, 'total_tokens', 0))
+            if response is not None and getattr(response, 'total_tokens', 0):
+                st.metric("使用トークン数", response.total_tokens)
 
         # 構造化データの表示
         st.write("---")
@@ -731,6 +730,7 @@ math_result = MathReasoning(**parsed_data)
         )
 
         try:
+            started = time.perf_counter()
             with st.spinner("数学的推論を実行中..."):
                 response = self.call_api_parse(
                     input_text=prompt,
@@ -740,7 +740,7 @@ math_result = MathReasoning(**parsed_data)
                 )
 
             # セッション状態に保存
-            st.session_state[f"last_response_{self.safe_key}"] = response
+            st.session_state[f"last_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
             st.session_state[f"last_math_result_{self.safe_key}"] = response.output_parsed
             st.success("✅ 思考ステップの生成が完了しました")
 
@@ -13,6 +13,7 @@
 
 import os
 import sys
+import time
 from pathlib import Path
 from typing import List, Dict, Any, Union
 from enum import Enum
@@ -44,7 +45,7 @@ try:
     from helper_api import (
         config, logger, TokenManager, AnthropicClient,
         ConfigManager, MessageManager, sanitize_key,
-        error_handler, timer
+        error_handler, timer, ResponseProcessor
     )
 except ImportError as e:
     st.error(f"ヘルパーモジュールのインポートに失敗しました: {e}")
@@ -535,6 +536,7 @@ for content in response.content:
                 "news": NewsRequest
             }
 
+            started = time.perf_counter()
             with st.spinner("処理中..."):
                 response = self.client.create_message_with_tools(
                     model=model,
@@ -544,7 +546,7 @@ for content in response.content:
                 )
 
             # セッション状態に保存
-            st.session_state[f"last_response_{self.safe_key}"] = response
+            st.session_state[f"last_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
             st.session_state[f"last_query_{self.safe_key}"] = user_input
             
             # Function callsの処理
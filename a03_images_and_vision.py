@@ -12,7 +12,7 @@ import logging
 from datetime import datetime
 import time
 from abc import ABC, abstractmethod
-from typing import Optional, List, Dict, Any, Union
+from typing import Optional, List, Dict, Any, Union, Tuple
 from pathlib import Path
 
 import streamlit as st
@@ -45,14 +45,15 @@ try:
     from helper_st import (
         UIHelper, MessageManagerUI, ResponseProcessorUI,
         SessionStateManager, error_handler_ui, timer_ui,
-        InfoPanelManager, safe_streamlit_json,
+        InfoPanelManager, safe_streamlit_json, VisionBatchUI,
         EasyInputMessageParam  # helper_st.pyから移動
     )
     from helper_api import (
         config, logger, TokenManager, AnthropicClient,
         ConfigManager, MessageManager, sanitize_key,
         error_handler, timer, get_default_messages,
-        ResponseProcessor, format_timestamp
+        ResponseProcessor, format_timestamp, ImageEncoder, AnimationSampler,
+        VisionBatchProcessor, VisionRequestPacker, URLImagePrefetcher, image_cache
     )
     
     # ResponseInputTextParamは存在しない可能性があるので、ダミー定義
@@ -159,6 +160,44 @@ class BaseDemo(ABC):
         
         # デモ実行
         self.run_demo()
+    
+    def _process_packed_images(self, items: List[Dict[str, Any]], prompt: str):
+        """複数画像を上限内でまとめて送信し、分割した回答を画像ごとに表示"""
+        packer = VisionRequestPacker()
+        groups = packer.pack(items)
+        st.info(f"📦 {len(items)} 枚の画像を {len(groups)} 回のリクエストにまとめて送信します")
+        
+        for number, group in enumerate(groups, 1):
+            try:
+                # 回答をJSONとして分割するため、ストリーミング表示は使わない
+                response = ResponseProcessorUI.create_message(
+                    self.client,
+                    spinner_text=f"処理中... ({number}/{len(groups)})",
+                    stream=False,
+                    model=self.model,
+                    messages=packer.build_messages(group, prompt),
+                    max_tokens=packer.max_tokens_for(group)
+                )
+            except Exception as e:
+                st.error(f"リクエスト {number}/{len(groups)} でエラーが発生しました: {e}")
+                continue
+            
+            text = "\n".join(ResponseProcessor.extract_text(response))
+            answers = packer.split_answer(text, len(group))
+            for item, answer in zip(group, answers):
+                st.markdown(f"#### 🖼️ {item['label']}")
+                col1, col2 = st.columns([1, 3])
+                with col1:
+                    st.image(item['preview'], use_container_width=True)
+                with col2:
+                    if answer is None:
+                        st.warning("回答を画像ごとに分割できませんでした（元の応答を下に表示します）")
+                    else:
+                        st.markdown(answer)
+            if any(answer is None for answer in answers):
+                with st.expander("📄 元の応答", expanded=False):
+                    st.markdown(text)
+            ResponseProcessorUI.display_details(response)
 
 
 # ==================================================
@@ -233,6 +272,12 @@ response = client.responses.create(model=model, input=messages)
         st.write("---")
         st.subheader("📤 入力")
         
+        mode = st.radio("処理モード", ["1枚ずつ", "まとめて送信（複数画像）"], horizontal=True,
+                        key=f"mode_{self.safe_key}")
+        if mode == "まとめて送信（複数画像）":
+            self._handle_packed_urls()
+            return
+        
         # 画像URL入力
         image_url = st.text_input(
             "画像URLを入力してください:",
@@ -260,30 +305,77 @@ response = client.responses.create(model=model, input=messages)
         if submit_button and user_prompt and image_url:
             self._process_image_with_text(user_prompt, image_url)
     
+    def _handle_packed_urls(self):
+        """複数の画像URLを1行ずつ受け付け、まとめて送信（「URL | 質問」で画像ごとの質問を指定）"""
+        with st.form(key=f"pack_form_{self.safe_key}"):
+            url_lines = st.text_area(
+                "画像URL（1行に1つ。「URL | 質問」で画像ごとの質問を指定）:",
+                value=image_url_default,
+                height=150,
+                key=f"pack_urls_{self.safe_key}"
+            )
+            user_prompt = st.text_area(
+                "共通の質問:",
+                value="この画像を日本語で簡潔に説明してください。",
+                height=config.get("ui.text_area_height", 75),
+                key=f"pack_prompt_{self.safe_key}"
+            )
+            submit_button = st.form_submit_button(label="🚀 まとめて送信")
+        
+        if not (submit_button and user_prompt):
+            return
+        entries = []
+        for line in url_lines.splitlines():
+            url, _, question = (part.strip() for part in line.partition("|"))
+            if url:
+                entries.append((url, question or None))
+        
+        # 全URLを並列に事前取得・検証し、取得できない画像はAPI送信前に除外
+        with st.spinner(f"🌐 {len(entries)} 件のURLを確認中..."):
+            results = URLImagePrefetcher().prefetch([url for url, _ in entries])
+        items = []
+        for url, question in entries:
+            result = results[url]
+            if result['status'] != 'ok':
+                st.warning(f"除外: {url}（{result['error']}）")
+                continue
+            if result['mode'] == 'base64':
+                item = VisionRequestPacker.base64_item(result['data'], result['media_type'], question, label=url)
+            else:
+                item = VisionRequestPacker.url_item(url, question)
+            item['preview'] = url
+            items.append(item)
+        if items:
+            self._process_packed_images(items, user_prompt)
+    
     def _process_image_with_text(self, prompt: str, image_url: str):
         """画像とテキストの処理"""
         try:
+            # 送信前にURLを取得・検証（到達不能・非画像・巨大な画像はモデル呼び出し前に検出）
+            with st.spinner("🌐 画像URLを確認中..."):
+                result = URLImagePrefetcher().fetch(image_url)
+            if result['status'] != 'ok':
+                st.error(f"画像URLを利用できません: {result['error']}")
+                return
+            if result['mode'] == 'base64':
+                st.info(f"📐 画像がAPIの制限を超えるため、{result['size'][0]}x{result['size'][1]} に変換して送信します")
+            
             # Anthropic API形式のメッセージを構築
             messages = [{
                 "role": "user",
                 "content": [
                     {"type": "text", "text": prompt},
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "url",
-                            "url": image_url
-                        }
-                    }
+                    URLImagePrefetcher.content_block(result)
                 ]
             }]
             
-            with st.spinner("処理中..."):
-                response = self.client.messages.create(
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=1024
-                )
+            response = ResponseProcessorUI.create_message(
+                self.client,
+                spinner_text="処理中...",
+                model=self.model,
+                messages=messages,
+                max_tokens=1024
+            )
             
             st.success("応答を取得しました")
             st.subheader("🤖 回答")
@@ -375,6 +467,15 @@ response = client.responses.create(model=model, input=messages)
         st.write("---")
         st.subheader("📤 入力")
         
+        mode = st.radio("処理モード", ["1枚ずつ", "まとめて送信（複数画像）", "フォルダ一括"], horizontal=True,
+                        key=f"mode_{self.safe_key}")
+        if mode == "フォルダ一括":
+            VisionBatchUI.render(AnthropicClient(), self.model, self.safe_key)
+            return
+        if mode == "まとめて送信（複数画像）":
+            self._handle_packed_images()
+            return
+        
         self._handle_image_selection()
     
     def _handle_image_selection(self):
@@ -439,59 +540,135 @@ response = client.responses.create(model=model, input=messages)
                 if selected_image_file:
                     self._process_base64_image(image_path, user_prompt)
     
-    def _encode_image_to_base64(self, image_path: str) -> str:
-        """画像をBase64エンコード"""
+    def _handle_packed_images(self):
+        """フォルダ内の複数画像を選択し、まとめて送信"""
+        paths = VisionBatchProcessor.list_images(config.get("paths.images_dir", "images"))
+        if not paths:
+            st.warning("画像フォルダに画像ファイルがありません。")
+            return
+        selected = st.multiselect(
+            "画像ファイルを選択してください（複数可）",
+            [path.name for path in paths],
+            default=[path.name for path in paths[:4]],
+            key=f"pack_images_{self.safe_key}"
+        )
+        user_prompt = st.text_area(
+            "全画像に共通のプロンプト",
+            value="画像に何が写っているか日本語で簡潔に説明してください。",
+            height=config.get("ui.text_area_height", 75),
+            key=f"pack_prompt_{self.safe_key}"
+        )
+        if not st.button("🚀 まとめて解析", key=f"pack_run_{self.safe_key}", disabled=not selected):
+            return
+        
+        max_base64_bytes = config.get("limits.max_image_size_mb", 5) * 1024 * 1024
+        max_long_edge = ImageEncoder.default_max_long_edge()
+        items = []
+        with st.spinner("🔄 画像をエンコード中..."):
+            for path in paths:
+                if path.name not in selected:
+                    continue
+                if config.get("images.cache_enabled", True) is True:
+                    data, media_type, _ = image_cache.get_or_encode(path, max_base64_bytes, max_long_edge)
+                else:
+                    data, media_type, _ = ImageEncoder.encode_file(path, max_base64_bytes, max_long_edge)
+                if not data:
+                    st.warning(f"{path.name}: サイズ制限内に収まらないため除外しました")
+                    continue
+                item = VisionRequestPacker.base64_item(data, media_type, label=path.name)
+                item['preview'] = str(path)
+                items.append(item)
+        if items:
+            self._process_packed_images(items, user_prompt)
+    
+    def _encode_image_blocks(self, image_path: str) -> List[Dict[str, Any]]:
+        """画像のコンテンツブロック（アニメーションGIF/WebPは代表フレームをタイル化・複数ブロック化）"""
+        if AnimationSampler.applies_to(image_path):
+            try:
+                max_base64_bytes = config.get("limits.max_image_size_mb", 5) * 1024 * 1024
+                max_long_edge = ImageEncoder.default_max_long_edge()
+                if config.get("images.cache_enabled", True) is True:
+                    payloads, stats = image_cache.get_or_encode_animation(image_path, max_base64_bytes, max_long_edge)
+                else:
+                    payloads, stats = AnimationSampler.encode(image_path, max_base64_bytes, max_long_edge)
+                if payloads:
+                    st.caption(f"🎞️ 全{stats['frames']}フレームから {len(stats['selected'])} フレームを抽出 "
+                               f"→ {stats['base64_bytes'] / (1024 * 1024):.2f}MB (base64)")
+                    return AnimationSampler.content_blocks(payloads, stats)
+            except Exception as e:
+                st.warning(f"フレーム抽出エラー: {e}")
+        image_base64, media_type = self._encode_image_to_base64(image_path)
+        if not image_base64:
+            return []
+        return [ImageEncoder.image_block(image_base64, media_type)]
+    
+    def _encode_image_to_base64(self, image_path: str) -> Tuple[str, str]:
+        """画像をBase64エンコード（サイズ制限超過時はリサイズ・前処理結果はキャッシュ）
+        
+        Returns:
+            Tuple[str, str]: (base64_encoded_data, media_type)
+        """
         try:
-            with open(image_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
+            max_base64_bytes = config.get("limits.max_image_size_mb", 5) * 1024 * 1024
+            max_long_edge = ImageEncoder.default_max_long_edge()
+            
+            # 送信前の見積もり（モデルの実効解像度を超える場合は縮小して送信）
+            preflight = ImageEncoder.preflight(image_path, self.model, max_long_edge)
+            original, send = preflight['original_size'], preflight['send_size']
+            resolution = f"{original[0]}x{original[1]}"
+            if preflight['downscale']:
+                resolution += f" → {send[0]}x{send[1]}（自動縮小）"
+            st.caption(f"📐 {resolution} / 推定画像トークン {preflight['tokens']:,} "
+                       f"（約 ${preflight['cost_usd']:.5f}）")
+            
+            if config.get("images.cache_enabled", True) is True:
+                image_base64, media_type, stats = image_cache.get_or_encode(
+                    image_path, max_base64_bytes, max_long_edge)
+                if stats.get('cached'):
+                    similar = "（ほぼ同じ画像を検出）" if stats.get('near_duplicate') else ""
+                    st.caption(f"♻️ 前処理済みの画像を再利用しました{similar}")
+                return image_base64, media_type
+            image_base64, media_type, _ = ImageEncoder.encode_file(image_path, max_base64_bytes, max_long_edge)
+            return image_base64, media_type
         except Exception as e:
             st.error(f"画像エンコードエラー: {e}")
-            return ""
+            return "", "image/jpeg"
     
     def _process_base64_image(self, image_path: str, prompt: str):
         """Base64画像の処理"""
         try:
-            # 画像をBase64エンコード
-            image_base64 = self._encode_image_to_base64(image_path)
+            # 内容が同じ画像への同じ質問なら過去の回答を再利用
+            use_answer_cache = image_cache.answers_enabled()
+            if use_answer_cache:
+                cached_answer = image_cache.get_answer(image_path, prompt, model=self.model)
+                if cached_answer is not None:
+                    st.success("♻️ 同じ画像・同じ質問の回答を再利用しました")
+                    st.subheader("🤖 回答")
+                    ResponseProcessorUI.display_response(cached_answer)
+                    return
             
-            if not image_base64:
+            # 画像をBase64エンコード（MIMEタイプはリサイズ後の形式・アニメーションは代表フレームを抽出）
+            image_blocks = self._encode_image_blocks(image_path)
+            
+            if not image_blocks:
                 st.error("画像のエンコードに失敗しました")
                 return
             
-            # 画像のMIMEタイプを判定
-            if image_path.lower().endswith('.png'):
-                media_type = "image/png"
-            elif image_path.lower().endswith(('.jpg', '.jpeg')):
-                media_type = "image/jpeg"
-            elif image_path.lower().endswith('.gif'):
-                media_type = "image/gif"
-            elif image_path.lower().endswith('.webp'):
-                media_type = "image/webp"
-            else:
-                media_type = "image/jpeg"  # デフォルト
-            
             # Anthropic API形式のメッセージを構築
             messages = [{
                 "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": media_type,
-                            "data": image_base64
-                        }
-                    }
-                ]
+                "content": [{"type": "text", "text": prompt}] + image_blocks
             }]
             
-            with st.spinner("処理中..."):
-                response = self.client.messages.create(
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=1024
-                )
+            response = ResponseProcessorUI.create_message(
+                self.client,
+                spinner_text="処理中...",
+                model=self.model,
+                messages=messages,
+                max_tokens=1024
+            )
+            if use_answer_cache:
+                image_cache.set_answer(image_path, prompt, response, model=self.model)
             
             st.success("応答を取得しました")
             st.subheader("🤖 回答")
@@ -32,14 +32,15 @@ sys.path.insert(0, str(BASE_DIR))
 try:
     from helper_st import (
         UIHelper, MessageManagerUI, ResponseProcessorUI,
-        SessionStateManager, error_handler_ui, timer_ui,
+        SessionStateManager, error_handler_ui, timer_ui, cache_result_ui,
         InfoPanelManager, safe_streamlit_json
     )
     from helper_api import (
         config, logger, TokenManager, AnthropicClient,
         ConfigManager, MessageManager, sanitize_key,
         error_handler, timer, get_default_messages,
-        ResponseProcessor, format_timestamp
+        ResponseProcessor, format_timestamp, ConversationBuilder, MessageParam,
+        ConversationCompactor, CityIndex
     )
 except ImportError as e:
     st.error(f"ヘルパーモジュールのインポートに失敗しました: {e}")
@@ -123,6 +124,9 @@ class ConversationHistoryManager:
         self.history = []
         self.max_history = max_length if max_length is not None else 100
         self.max_length = self.max_history  # エイリアス
+        # 送信用メッセージ列（historyと同期している間は追加分のみ反映）
+        self._builder: Optional[ConversationBuilder] = None
+        self._builder_source: Optional[List[Dict[str, str]]] = None
     
     def add_message(self, role: str, content: str):
         """メッセージを追加"""
@@ -131,10 +135,25 @@ class ConversationHistoryManager:
             "content": content,
             "timestamp": datetime.now().isoformat()
         })
+        if self._builder is not None and self._builder_source is self.history:
+            self._builder.append(role, content)
         
         # 最大履歴数を超えたら古いものから削除
         if len(self.history) > self.max_history:
-            self.history = self.history[-self.max_history:]
+            del self.history[:-self.max_history]
+    
+    def get_api_messages(self, limit: Optional[int] = None) -> List[MessageParam]:
+        """API送信用のメッセージ列（直近limit件・userから開始・timestampなし）
+
+        履歴が置き換えられた場合（インポート・読み込み）や limit が変わった場合のみ再構築する。
+        """
+        builder = self._builder
+        if builder is None or builder.max_messages != limit or self._builder_source is not self.history:
+            builder = ConversationBuilder(max_messages=limit)
+            builder.extend(self.history[-limit:] if limit else self.history)
+            self._builder = builder
+            self._builder_source = self.history
+        return builder.messages()
     
     def get_history(self, limit: Optional[int] = None) -> List[Dict[str, str]]:
         """会話履歴を取得"""
@@ -145,6 +164,7 @@ class ConversationHistoryManager:
     def clear_history(self):
         """履歴をクリア"""
         self.history.clear()
+        self._builder = None
     
     def export_history(self) -> str:
         """履歴をJSON形式でエクスポート"""
@@ -195,8 +215,8 @@ class ConversationStateDemo:
             # 履歴にユーザーメッセージを追加
             self.history_manager.add_message("user", message)
             
-            # メッセージを送信
-            messages = self.history_manager.get_history(limit=10)
+            # メッセージを送信（送信用メッセージ列は追加分のみ更新される）
+            messages = self.history_manager.get_api_messages(limit=10)
             response = self.client.client.messages.create(
                 model=model or self.model,
                 messages=messages,
@@ -507,14 +527,17 @@ follow_up_response = client.messages.create(
                 {"role": "user", "content": question}
             ]
             
-            with st.spinner("処理中..."):
-                response = self.client.client.messages.create(
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=1024
-                )
+            started = time.perf_counter()
+            response = ResponseProcessorUI.create_message(
+                self.client.client,
+                spinner_text="処理中...",
+                model=self.model,
+                messages=messages,
+                max_tokens=1024
+            )
             
-            # 会話履歴を保存
+            # 会話履歴を保存（前の会話の要約は新しい会話に適用しない）
+            self._get_compactor().discard()
             conversation_history = [
                 {"role": "user", "content": question},
                 {"role": "assistant", "content": response.content[0].text}
@@ -522,7 +545,7 @@ follow_up_response = client.messages.create(
             
             # セッション状態に保存
             st.session_state[f"conversation_history_{self.safe_key}"] = conversation_history
-            st.session_state[f"initial_response_{self.safe_key}"] = response
+            st.session_state[f"initial_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
             st.success(f"✅ 初回の質問を処理しました")
             st.rerun()
             
@@ -537,24 +560,32 @@ follow_up_response = client.messages.create(
             # 会話履歴を取得
             conversation_history = st.session_state[f"conversation_history_{self.safe_key}"]
             
+            # 完了した要約があれば古いターンを要約に置き換える
+            self._apply_compaction(conversation_history)
+            
             # 新しい質問を追加
             conversation_history.append({"role": "user", "content": question})
             
-            with st.spinner("処理中（前の会話を引き継ぎ中）..."):
-                response = self.client.client.messages.create(
-                    model=self.model,
-                    messages=conversation_history,
-                    max_tokens=1024
-                )
+            started = time.perf_counter()
+            response = ResponseProcessorUI.create_message(
+                self.client.client,
+                spinner_text="処理中（前の会話を引き継ぎ中）...",
+                model=self.model,
+                messages=conversation_history,
+                max_tokens=1024
+            )
             
             # 会話履歴を更新
             conversation_history.append(
                 {"role": "assistant", "content": response.content[0].text}
             )
             
+            # 履歴が閾値を超えていれば古いターンの要約をバックグラウンドで開始（次の質問で適用）
+            self._schedule_compaction(conversation_history)
+            
             # セッション状態に保存
             st.session_state[f"conversation_history_{self.safe_key}"] = conversation_history
-            st.session_state[f"follow_up_response_{self.safe_key}"] = response
+            st.session_state[f"follow_up_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
             st.success(f"✅ 会話を継続しました")
             st.rerun()
             
@@ -563,6 +594,34 @@ follow_up_response = client.messages.create(
             if config.get("experimental.debug_mode", False):
                 st.exception(e)
     
+    def _get_compactor(self) -> ConversationCompactor:
+        """会話コンパクション（セッションごとに1つ）"""
+        key = f"conversation_compactor_{self.safe_key}"
+        compactor = st.session_state.get(key)
+        if not isinstance(compactor, ConversationCompactor):
+            compactor = ConversationCompactor()
+            st.session_state[key] = compactor
+        return compactor
+    
+    def _schedule_compaction(self, conversation_history: List[Dict[str, str]]):
+        """閾値超過時に古いターンの要約をバックグラウンドで開始"""
+        if config.get("compaction.enabled", True) is not True:
+            return
+        compactor = self._get_compactor()
+        if compactor.pending:
+            return
+        total_tokens = sum(TokenManager.count_tokens(msg["content"], self.model) for msg in conversation_history)
+        compactor.submit(self.client.client, conversation_history, total_tokens, owner=conversation_history)
+    
+    def _apply_compaction(self, conversation_history: List[Dict[str, str]]):
+        """完了した要約があれば古いターンを要約メッセージに置き換える"""
+        result = self._get_compactor().poll(conversation_history)
+        if result is None:
+            return
+        cut, summary = result
+        conversation_history[:cut] = [summary]
+        st.caption(f"🗜️ 古い会話 {cut} 件を要約に置き換えました")
+    
     def _display_conversation_results(self):
         """会話結果の表示"""
         # 初回回答
@@ -765,6 +824,19 @@ if response.stop_reason == "tool_use":
                         })
 
 
+@cache_result_ui(shared=True, shared_ttl=config.get("weather.cache_ttl", 600))
+def fetch_current_weather(latitude: float, longitude: float) -> Dict[str, Any]:
+    """Open-Meteo APIの現在の天気（座標のみで決まるため全セッションで共有・失敗時は例外でキャッシュしない）"""
+    url = (
+        "https://api.open-meteo.com/v1/forecast"
+        f"?latitude={latitude}&longitude={longitude}"
+        "&current=temperature_2m,relative_humidity_2m,wind_speed_10m"
+    )
+    r = requests.get(url, timeout=10)
+    r.raise_for_status()
+    return r.json()
+
+
 class FunctionCallingDemo(BaseDemo):
     """Function Callingデモ"""
 
@@ -899,15 +971,8 @@ if response.stop_reason == "tool_use":
             # 天気取得関数
             def get_weather(latitude: float, longitude: float) -> dict:
                 """Open-Meteo APIで現在の天気情報を取得"""
-                url = (
-                    "https://api.open-meteo.com/v1/forecast"
-                    f"?latitude={latitude}&longitude={longitude}"
-                    "&current=temperature_2m,relative_humidity_2m,wind_speed_10m"
-                )
                 try:
-                    r = requests.get(url, timeout=10)
-                    r.raise_for_status()
-                    data = r.json()
+                    data = fetch_current_weather(latitude, longitude)
                     return {
                         "temperature": data["current"]["temperature_2m"],
                         "humidity": data["current"]["relative_humidity_2m"],
@@ -980,6 +1045,10 @@ if response.stop_reason == "tool_use":
                             "tool_name": content.name,
                             "tool_input": content.input
                         })
+                        nearest = self._nearest_city(content.input)
+                        if nearest:
+                            name, country, distance = nearest
+                            st.caption(f"📍 指定座標の最寄り都市: {name}（{country}）約{distance:.1f}km")
             
             # リアルタイム天気データ
             if weather_data and "error" not in weather_data:
@@ -996,6 +1065,27 @@ if response.stop_reason == "tool_use":
             elif weather_data:
                 st.error(f"天気データ取得エラー: {weather_data.get('error', 'Unknown error')}")
 
+    def _nearest_city(self, tool_input: dict) -> Optional[tuple]:
+        """ツール入力の座標から最寄りの都市を逆引き
+
+        全世界の都市データは事前生成済み（get_cities_list.py）の場合のみ使い、描画中には生成しない。
+        未生成なら都市選択と同じ日本の都市データで逆引きする。
+        """
+        try:
+            lat, lon = float(tool_input["latitude"]), float(tool_input["longitude"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        try:
+            cities = CityIndex.load_prebuilt(config.get("paths.cities_world_json", "data/city.list.json.gz"))
+            if cities is None:
+                cities = CityIndex.load()
+            [(position, distance)] = cities.nearest(lat, lon, k=1)
+            name, _, _ = cities.row(position)
+            return name, str(cities.countries[position]), distance
+        except Exception as e:
+            logger.warning(f"最寄り都市の逆引きに失敗しました: {e}")
+            return None
+
 
 # ==================================================
 # デモ管理クラス（統一化版）
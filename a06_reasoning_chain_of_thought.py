@@ -288,18 +288,20 @@ response = client.messages.create(
 
 推論において正確で論理的にしてください。"""
             
-            with st.spinner("段階的推論中..."):
-                response = self.client.client.messages.create(
-                    model=self.model,
-                    system=system_prompt,
-                    messages=[
-                        {"role": "user", "content": question}
-                    ],
-                    max_tokens=1024
-                )
+            started = time.perf_counter()
+            response = ResponseProcessorUI.create_message(
+                self.client.client,
+                spinner_text="段階的推論中...",
+                model=self.model,
+                system=system_prompt,
+                messages=[
+                    {"role": "user", "content": question}
+                ],
+                max_tokens=1024
+            )
             
             # セッション状態に保存
-            st.session_state[f"reasoning_response_{self.safe_key}"] = response
+            st.session_state[f"reasoning_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
             st.success("✅ 段階的推論完了")
             st.rerun()
             
@@ -401,18 +403,20 @@ response = client.messages.create(
             
             user_content = f"Problem: {problem}\nHypothesis: {hypothesis}"
             
-            with st.spinner("仮説検証中..."):
-                response = self.client.client.messages.create(
-                    model=self.model,
-                    system=system_prompt,
-                    messages=[
-                        {"role": "user", "content": user_content}
-                    ],
-                    max_tokens=1024
-                )
+            started = time.perf_counter()
+            response = ResponseProcessorUI.create_message(
+                self.client.client,
+                spinner_text="仮説検証中...",
+                model=self.model,
+                system=system_prompt,
+                messages=[
+                    {"role": "user", "content": user_content}
+                ],
+                max_tokens=1024
+            )
             
             # セッション状態に保存
-            st.session_state[f"hypothesis_response_{self.safe_key}"] = response
+            st.session_state[f"hypothesis_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
             st.success("✅ 仮説検証完了")
             st.rerun()
             
@@ -642,18 +646,20 @@ response = client.messages.create(
             
             user_content = f"Goal: {goal}"
             
-            with st.spinner("Tree of Thought 探索中..."):
-                response = self.client.client.messages.create(
-                    model=self.model,
-                    system=system_prompt,
-                    messages=[
-                        {"role": "user", "content": user_content}
-                    ],
-                    max_tokens=1024
-                )
+            started = time.perf_counter()
+            response = ResponseProcessorUI.create_message(
+                self.client.client,
+                spinner_text="Tree of Thought 探索中...",
+                model=self.model,
+                system=system_prompt,
+                messages=[
+                    {"role": "user", "content": user_content}
+                ],
+                max_tokens=1024
+            )
             
             # セッション状態に保存
-            st.session_state[f"tree_response_{self.safe_key}"] = response
+            st.session_state[f"tree_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
             st.success("✅ Tree of Thought 探索完了")
             st.rerun()
             
@@ -766,18 +772,20 @@ response = client.messages.create(
             
             user_content = f"Topic: {topic}\nPerspective: {perspective}"
             
-            with st.spinner("賛否比較決定中..."):
-                response = self.client.client.messages.create(
-                    model=self.model,
-                    system=system_prompt,
-                    messages=[
-                        {"role": "user", "content": user_content}
-                    ],
-                    max_tokens=1024
-                )
+            started = time.perf_counter()
+            response = ResponseProcessorUI.create_message(
+                self.client.client,
+                spinner_text="賛否比較決定中...",
+                model=self.model,
+                system=system_prompt,
+                messages=[
+                    {"role": "user", "content": user_content}
+                ],
+                max_tokens=1024
+            )
             
             # セッション状態に保存
-            st.session_state[f"decision_response_{self.safe_key}"] = response
+            st.session_state[f"decision_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
             st.success("✅ 賛否比較決定完了")
             st.rerun()
             
@@ -891,18 +899,20 @@ response = client.messages.create(
             
             user_content = f"Objective: {objective}\nComplexity Level: {complexity}"
             
-            with st.spinner("Plan-Execute-Reflect 実行中..."):
-                response = self.client.client.messages.create(
-                    model=self.model,
-                    system=system_prompt,
-                    messages=[
-                        {"role": "user", "content": user_content}
-                    ],
-                    max_tokens=1024
-                )
+            started = time.perf_counter()
+            response = ResponseProcessorUI.create_message(
+                self.client.client,
+                spinner_text="Plan-Execute-Reflect 実行中...",
+                model=self.model,
+                system=system_prompt,
+                messages=[
+                    {"role": "user", "content": user_content}
+                ],
+                max_tokens=1024
+            )
             
             # セッション状態に保存
-            st.session_state[f"reflect_response_{self.safe_key}"] = response
+            st.session_state[f"reflect_response_{self.safe_key}"] = ResponseProcessor.to_record(response, elapsed=time.perf_counter() - started)
             st.success("✅ Plan-Execute-Reflect 完了")
             st.rerun()
             
@@ -0,0 +1,74 @@
+# benchmarks/bench_base64_payload.py
+# --------------------------------------------------
+# ファイルのBase64ペイロード生成の比較
+# 旧方式（ファイル全体を読み込み → b64encode → 文字列化）と
+# Base64Payload.encode_file（mmap + チャンク単位のエンコード、算出サイズのバッファ1つ）の
+# ピークメモリ（tracemalloc）・処理時間を計測する
+#
+# 実行: python benchmarks/bench_base64_payload.py [--size-mb 20] [--repeat 5]
+# --------------------------------------------------
+
+import argparse
+import base64
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from helper_api import Base64Payload
+
+
+def legacy_encode(path: Path) -> str:
+    """旧 _encode_image / _encode_image_to_base64 のエンコード処理"""
+    with open(path, 'rb') as f:
+        return base64.b64encode(f.read()).decode('ascii')
+
+
+def payload_encode(path: Path) -> str:
+    return Base64Payload.encode_file(path)
+
+
+def measure(encoder, path: Path, repeat: int):
+    gc.collect()
+    tracemalloc.start()
+    encoded = encoder(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del encoded
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encoder(path)
+    return peak, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Base64ペイロード生成のピークメモリ・処理時間比較")
+    parser.add_argument("--size-mb", type=float, default=20, help="入力ファイルのサイズ（MB）")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "payload.bin"
+        path.write_bytes(os.urandom(int(args.size_mb * 1024 * 1024)))
+        assert legacy_encode(path) == payload_encode(path)
+
+        legacy_peak, legacy_time = measure(legacy_encode, path, args.repeat)
+        payload_peak, payload_time = measure(payload_encode, path, args.repeat)
+
+    mib = 1024 * 1024
+    print(f"入力: {args.size_mb:.1f}MB → base64 {Base64Payload.encoded_size(int(args.size_mb * mib)) / mib:.1f}MB")
+    print(f"旧方式       : ピーク {legacy_peak / mib:7.1f} MiB, {legacy_time * 1000:8.1f} ms")
+    print(f"Base64Payload: ピーク {payload_peak / mib:7.1f} MiB, {payload_time * 1000:8.1f} ms")
+    print(f"ピークメモリ: {(1 - payload_peak / legacy_peak) * 100:.0f}% 削減, "
+          f"処理時間: {legacy_time / payload_time:.2f} 倍")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# benchmarks/bench_city_index.py
+# --------------------------------------------------
+# 日本の都市データの読み込み・検索の比較
+# 旧方式（JSON解析 → DataFrame構築 → 名前でソート、検索は str.contains）と
+# CityIndex（名前順の .npy 列を memory map で読み込み・プロセス内共有）の
+# 読み込み時間（初回・2回目以降）と検索時間を計測する
+#
+# 実行: python benchmarks/bench_city_index.py [--json data/city_jp.list.json] [--repeat 20]
+# --------------------------------------------------
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from helper_api import CityIndex
+
+QUERIES = ("Tokyo", "osaka", "Sapporo", "kyo", "Naha")
+
+
+def legacy_load(json_path: Path) -> pd.DataFrame:
+    """旧 WeatherDemo._load_japanese_cities の読み込み処理"""
+    with open(json_path, "r", encoding="utf-8") as f:
+        cities_list = json.load(f)
+    df = pd.DataFrame([
+        {
+            "name": city["name"],
+            "lat" : city["coord"]["lat"],
+            "lon" : city["coord"]["lon"],
+            "id"  : city["id"]
+        }
+        for city in cities_list
+    ])
+    return df.sort_values("name").reset_index(drop=True)
+
+
+def timed(func, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="都市データの読み込み・検索時間の比較")
+    parser.add_argument("--json", type=Path, default=BASE_DIR / "data" / "city_jp.list.json")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index_dir = Path(tmp) / "city_index"
+        build_time = timed(lambda: CityIndex.build(args.json, index_dir), 1)
+
+        legacy_time = timed(lambda: legacy_load(args.json), args.repeat)
+        cold_time = timed(lambda: CityIndex(index_dir), args.repeat)
+        CityIndex.load(args.json, index_dir)
+        warm_time = timed(lambda: CityIndex.load(args.json, index_dir), args.repeat)
+
+        df = legacy_load(args.json)
+        cities = CityIndex.load(args.json, index_dir)
+        assert df["name"].tolist() == cities.name_list()
+        legacy_search = timed(lambda: [df[df["name"].str.contains(q, case=False, na=False)] for q in QUERIES],
+                              args.repeat)
+        index_search = timed(lambda: [cities.search(q) for q in QUERIES], args.repeat)
+
+    print(f"都市数: {len(cities)}（インデックス生成 {build_time * 1000:.1f} ms）")
+    print(f"旧方式（JSON + DataFrame + ソート）: {legacy_time * 1000:8.2f} ms")
+    print(f"CityIndex 初回（memory map）        : {cold_time * 1000:8.2f} ms")
+    print(f"CityIndex 2回目以降（プロセス内共有）: {warm_time * 1000:8.2f} ms")
+    print(f"部分一致検索 {len(QUERIES)}件: 旧方式 {legacy_search * 1000:.2f} ms, CityIndex {index_search * 1000:.2f} ms")
+    print(f"読み込み: 初回 {legacy_time / cold_time:.1f} 倍, 2回目以降 {legacy_time / warm_time:.0f} 倍高速")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# benchmarks/bench_city_spatial.py
+# --------------------------------------------------
+# 座標 → 都市の逆引き（最近傍 k 件・半径検索）の比較
+# 全件走査（haversine を全都市に対して計算）と CitySpatialIndex（KD-tree）の
+# 1クエリあたりの処理時間を計測し、結果の一致を確認する
+#
+# 実行: python benchmarks/bench_city_spatial.py [--queries 10000] [--k 5] [--radius-km 30]
+#       --world 指定時は city.list.json.gz（全世界）も計測する（全件走査はサンプルのみ）
+# --------------------------------------------------
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from helper_api import CityIndex, CitySpatialIndex
+
+
+def brute_nearest(lat_column, lon_column, lat: float, lon: float, k: int):
+    """全件走査の最近傍（旧来の逆引き相当）"""
+    distances = CitySpatialIndex.distance_km(lat, lon, lat_column, lon_column)
+    nearest = np.argpartition(distances, k - 1)[:k]
+    nearest = nearest[np.argsort(distances[nearest])]
+    return list(zip(nearest.tolist(), distances[nearest].tolist()))
+
+
+def brute_within(lat_column, lon_column, lat: float, lon: float, radius_km: float):
+    distances = CitySpatialIndex.distance_km(lat, lon, lat_column, lon_column)
+    inside = np.flatnonzero(distances <= radius_km)
+    inside = inside[np.argsort(distances[inside], kind='stable')]
+    return list(zip(inside.tolist(), distances[inside].tolist()))
+
+
+def random_queries(count: int, bounds, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    (lat_min, lat_max), (lon_min, lon_max) = bounds
+    return rng.uniform(lat_min, lat_max, count), rng.uniform(lon_min, lon_max, count)
+
+
+def per_query(func, lats, lons) -> float:
+    start = time.perf_counter()
+    for lat, lon in zip(lats, lons):
+        func(lat, lon)
+    return (time.perf_counter() - start) / len(lats)
+
+
+def run(label: str, json_path: Path, index_dir: Path, bounds, args):
+    cities = CityIndex.load(json_path, index_dir)
+    start = time.perf_counter()
+    spatial = cities.spatial()
+    build_time = time.perf_counter() - start
+    lat_column, lon_column = np.asarray(cities.lat), np.asarray(cities.lon)
+
+    lats, lons = random_queries(args.queries, bounds)
+    sample = min(args.queries, args.brute_sample or args.queries)
+    for lat, lon in zip(lats[:200], lons[:200]):
+        expected = [d for _, d in brute_nearest(lat_column, lon_column, lat, lon, args.k)]
+        assert np.allclose([d for _, d in spatial.nearest(lat, lon, args.k)], expected)
+        assert len(spatial.within(lat, lon, args.radius_km)) == len(
+            brute_within(lat_column, lon_column, lat, lon, args.radius_km))
+
+    brute_knn = per_query(lambda a, b: brute_nearest(lat_column, lon_column, a, b, args.k), lats[:sample], lons[:sample])
+    tree_knn = per_query(lambda a, b: spatial.nearest(a, b, args.k), lats, lons)
+    brute_radius = per_query(lambda a, b: brute_within(lat_column, lon_column, a, b, args.radius_km),
+                             lats[:sample], lons[:sample])
+    tree_radius = per_query(lambda a, b: spatial.within(a, b, args.radius_km), lats, lons)
+
+    print(f"[{label}] 都市数 {len(cities)}、KD-tree 構築 {build_time * 1000:.1f} ms、"
+          f"クエリ {args.queries} 件（全件走査は {sample} 件）")
+    print(f"  最近傍 k={args.k}: 全件走査 {brute_knn * 1e6:9.1f} us/件, KD-tree {tree_knn * 1e6:7.1f} us/件"
+          f"（{brute_knn / tree_knn:.0f} 倍）")
+    print(f"  半径 {args.radius_km:.0f}km : 全件走査 {brute_radius * 1e6:9.1f} us/件, KD-tree {tree_radius * 1e6:7.1f} us/件"
+          f"（{brute_radius / tree_radius:.0f} 倍）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="座標→都市の逆引き（最近傍・半径検索）の比較")
+    parser.add_argument("--queries", type=int, default=10000)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--radius-km", type=float, default=30)
+    parser.add_argument("--world", action="store_true", help="city.list.json.gz（全世界）も計測する")
+    parser.add_argument("--brute-sample", type=int, default=500, help="全世界の全件走査を計測するクエリ数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jp_args = argparse.Namespace(**{**vars(args), 'brute_sample': None})
+        run("日本", BASE_DIR / "data" / "city_jp.list.json", Path(tmp) / "city_jp",
+            ((24.0, 46.0), (123.0, 146.0)), jp_args)
+        if args.world:
+            run("全世界", BASE_DIR / "data" / "city.list.json.gz", Path(tmp) / "city",
+                ((-60.0, 75.0), (-180.0, 180.0)), args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# benchmarks/bench_conversation_steps.py
+# --------------------------------------------------
+# MemoryResponseDemo の会話ステップ保存形式の比較
+# 旧形式（ステップごとに messages_at_step をコピー）と
+# 共有ログ + 範囲（log_range）形式のメモリ量・エクスポートサイズを計測する
+#
+# 実行: python benchmarks/bench_conversation_steps.py [--turns 200]
+# --------------------------------------------------
+
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from helper_api import ConversationLog, get_default_messages
+
+
+def make_turn(turn: int, answer_chars: int):
+    return f"質問 {turn}: " + "q" * 200, f"回答 {turn}: " + "a" * answer_chars
+
+
+def build_legacy(turns: int, answer_chars: int):
+    """旧形式: 各ステップに送信メッセージ列のコピーを保持"""
+    steps = []
+    for turn in range(turns):
+        user_input, answer = make_turn(turn, answer_chars)
+        messages = get_default_messages()
+        for step in steps:
+            messages.append({"role": "user", "content": step['user_input']})
+            messages.append({"role": "assistant", "content": step['assistant_response']})
+        messages.append({"role": "user", "content": user_input})
+        steps.append({
+            'step_number'       : turn + 1,
+            'user_input'        : user_input,
+            'assistant_response': answer,
+            'messages_at_step'  : [dict(msg) for msg in messages],
+        })
+    return {"conversation_steps": steps}
+
+
+def build_shared(turns: int, answer_chars: int):
+    """新形式: 共有ログ + ステップごとの範囲"""
+    log = ConversationLog(get_default_messages())
+    steps = []
+    for turn in range(turns):
+        user_input, answer = make_turn(turn, answer_chars)
+        log.append({"role": "user", "content": user_input})
+        end = len(log)
+        log.append({"role": "assistant", "content": answer})
+        steps.append({
+            'step_number'       : turn + 1,
+            'user_input'        : user_input,
+            'assistant_response': answer,
+            'log_range'         : [0, end],
+        })
+    return {"conversation_steps": steps, "message_log": log.to_list()}
+
+
+def measure(builder, turns: int, answer_chars: int):
+    gc.collect()
+    tracemalloc.start()
+    data = builder(turns, answer_chars)
+    gc.collect()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    export_size = len(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+    return memory, export_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会話ステップ保存形式のメモリ・エクスポートサイズ比較")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--chars", type=int, default=1500, help="1回答あたりの文字数")
+    args = parser.parse_args()
+
+    legacy_memory, legacy_export = measure(build_legacy, args.turns, args.chars)
+    shared_memory, shared_export = measure(build_shared, args.turns, args.chars)
+
+    print(f"ターン数: {args.turns}（1回答 {args.chars} 文字）")
+    print(f"メモリ      : 旧形式 {legacy_memory / 1024:9.1f} KiB → 共有ログ {shared_memory / 1024:9.1f} KiB"
+          f"（{(1 - shared_memory / legacy_memory) * 100:.1f}% 削減）")
+    print(f"エクスポート: 旧形式 {legacy_export / 1024:9.1f} KiB → 共有ログ {shared_export / 1024:9.1f} KiB"
+          f"（{(1 - shared_export / legacy_export) * 100:.1f}% 削減）")
+
+
+if __name__ == "__main__":
+    main()
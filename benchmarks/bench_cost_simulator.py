@@ -0,0 +1,52 @@
+# benchmarks/bench_cost_simulator.py
+# --------------------------------------------------
+# 全モデル一括コスト試算の速度比較（estimate_cost ループ vs CostSimulator）
+#
+# 実行: python benchmarks/bench_cost_simulator.py [--requests 50000]
+# --------------------------------------------------
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from helper_api import CostSimulator, TokenManager
+
+
+def main():
+    parser = argparse.ArgumentParser(description="全モデル一括コスト試算の速度比較")
+    parser.add_argument("--requests", type=int, default=50000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    tokens = np.column_stack([
+        rng.integers(100, 20000, args.requests),   # input
+        rng.integers(50, 4000, args.requests),     # output
+    ])
+    simulator = CostSimulator()
+
+    started = time.perf_counter()
+    loop_totals = {
+        model: sum(TokenManager.estimate_cost(int(i), int(o), model) for i, o in tokens)
+        for model in simulator.models
+    }
+    loop_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    totals = simulator.cost_matrix(tokens).sum(axis=0)
+    vector_time = time.perf_counter() - started
+
+    assert np.allclose(totals, [loop_totals[model] for model in simulator.models])
+
+    print(f"リクエスト数: {args.requests:,} × モデル数: {len(simulator.models)}")
+    print(f"estimate_cost ループ: {loop_time * 1000:9.1f} ms")
+    print(f"CostSimulator        : {vector_time * 1000:9.1f} ms  ({loop_time / vector_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
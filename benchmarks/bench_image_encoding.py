@@ -0,0 +1,133 @@
+# benchmarks/bench_image_encoding.py
+# --------------------------------------------------
+# 画像のサイズ制限対応エンコードの比較
+# 旧方式（品質を固定幅で下げた後に0.9倍ずつ縮小、毎回base64化してサイズ確認）と
+# ImageEncoder.fit_within（base64サイズを算出し、品質→縮小率を二分探索）の
+# エンコード回数・処理時間を計測する
+#
+# 実行: python benchmarks/bench_image_encoding.py [--dir 画像フォルダ] [--limit-mb 5]
+#       --dir 未指定時は写真相当の大きな JPEG/PNG/WebP を生成して計測する
+# --------------------------------------------------
+
+import argparse
+import base64
+import io
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from helper_api import ImageEncoder
+
+EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def make_corpus(directory: Path, count: int, width: int, height: int):
+    """グラデーション + ノイズの写真相当画像を各形式で生成"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    formats = [('jpg', 'JPEG', {'quality': 98}), ('png', 'PNG', {}), ('webp', 'WebP', {'quality': 98})]
+    paths = []
+    for i in range(count):
+        base = np.stack([(x * (i + 1)) % 256, (y * 2) % 256, ((x + y) // 3) % 256], axis=-1)
+        noise = rng.normal(0, 24, size=base.shape)
+        pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+        ext, fmt, options = formats[i % len(formats)]
+        path = directory / f"sample_{i:02d}.{ext}"
+        Image.fromarray(pixels).save(path, format=fmt, **options)
+        paths.append(path)
+    return paths
+
+
+def legacy_encode(img: Image.Image, save_format: str, max_base64_bytes: int):
+    """旧 _resize_and_encode_image の探索ループ（表示処理を除く）"""
+    quality = 90 if save_format == 'JPEG' else None
+    attempt, encodes = 0, 0
+    while attempt < 15:
+        buffer = io.BytesIO()
+        if save_format == 'JPEG':
+            img.save(buffer, format=save_format, quality=quality, optimize=True)
+        elif save_format == 'PNG':
+            img.save(buffer, format=save_format, optimize=True)
+        else:
+            img.save(buffer, format=save_format, quality=quality or 90, optimize=True)
+        encodes += 1
+        buffer.seek(0)
+        encoded = base64.b64encode(buffer.read()).decode('utf-8')
+        if len(encoded.encode('utf-8')) <= max_base64_bytes:
+            return encoded, encodes
+        attempt += 1
+        if attempt <= 5:
+            if save_format in ['JPEG', 'WebP'] and quality:
+                quality = max(60, quality - 10)
+        else:
+            new_size = (int(img.width * 0.9), int(img.height * 0.9))
+            if min(new_size) < 100:
+                return "", encodes
+            img = img.resize(new_size, Image.Resampling.LANCZOS)
+            if save_format in ['JPEG', 'WebP'] and quality:
+                quality = max(40, quality - 5)
+    return "", encodes
+
+
+def search_encode(img: Image.Image, save_format: str, max_base64_bytes: int):
+    result = ImageEncoder.fit_within(img, save_format, max_base64_bytes)
+    if result is None:
+        return "", 0
+    return base64.b64encode(result['data']).decode('ascii'), result['encodes']
+
+
+def run(paths, max_base64_bytes: int, encoder):
+    total_time, total_encodes, sizes = 0.0, 0, []
+    for path in paths:
+        save_format, _ = ImageEncoder.output_format(path)
+        with Image.open(path) as img:
+            img.load()
+            prepared = ImageEncoder.prepare_mode(img, save_format)
+            start = time.perf_counter()
+            encoded, encodes = encoder(prepared, save_format, max_base64_bytes)
+            total_time += time.perf_counter() - start
+        total_encodes += encodes
+        sizes.append(len(encoded))
+    return total_time, total_encodes, sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="サイズ制限対応エンコードの探索方式比較")
+    parser.add_argument("--dir", type=Path, default=None, help="計測する画像フォルダ")
+    parser.add_argument("--count", type=int, default=6, help="生成する画像数（--dir未指定時）")
+    parser.add_argument("--width", type=int, default=3000)
+    parser.add_argument("--height", type=int, default=2000)
+    parser.add_argument("--limit-mb", type=float, default=1.0, help="base64後のサイズ制限（MB）")
+    args = parser.parse_args()
+
+    max_base64_bytes = int(args.limit_mb * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.dir:
+            paths = sorted(p for p in args.dir.iterdir() if p.suffix.lower() in EXTENSIONS)
+        else:
+            paths = make_corpus(Path(tmp), args.count, args.width, args.height)
+        paths = [p for p in paths if ImageEncoder.base64_size(p.stat().st_size) > max_base64_bytes]
+        if not paths:
+            print("制限を超える画像がありません")
+            return
+
+        legacy_time, legacy_encodes, legacy_sizes = run(paths, max_base64_bytes, legacy_encode)
+        search_time, search_encodes, search_sizes = run(paths, max_base64_bytes, search_encode)
+
+    print(f"対象画像: {len(paths)} 枚（制限 {args.limit_mb:.1f}MB）")
+    print(f"旧方式  : エンコード {legacy_encodes:4d} 回, {legacy_time:7.2f} 秒, "
+          f"平均 {np.mean(legacy_sizes) / 1024:8.1f} KiB")
+    print(f"二分探索: エンコード {search_encodes:4d} 回, {search_time:7.2f} 秒, "
+          f"平均 {np.mean(search_sizes) / 1024:8.1f} KiB")
+    print(f"処理時間: {legacy_time / search_time:.1f} 倍高速")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# benchmarks/bench_jpeg_draft.py
+# --------------------------------------------------
+# 大きなJPEG写真の縮小処理の比較
+# 全解像度デコード + LANCZOS縮小（従来）と、draftモードで縮小デコード + 最終LANCZOS縮小の
+# 処理時間・ピークメモリ（子プロセスの最大RSSの増分）を計測する
+#
+# 実行: python benchmarks/bench_jpeg_draft.py [--megapixels 24] [--long-edge 1568]
+# --------------------------------------------------
+
+import argparse
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from helper_api import ImageEncoder
+
+
+def make_photo(path: Path, megapixels: float):
+    """3:2 の写真相当JPEG（グラデーション + ノイズ）を生成"""
+    height = int((megapixels * 1_000_000 / 1.5) ** 0.5)
+    width = int(height * 1.5)
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x % 256, y % 256, ((x + y) // 4) % 256], axis=-1).astype(np.int16)
+    pixels = np.clip(base + rng.integers(-20, 20, size=base.shape), 0, 255).astype(np.uint8)
+    Image.fromarray(pixels).save(path, quality=92)
+    return width, height
+
+
+def shrink(path: str, long_edge: int, draft: bool):
+    with Image.open(path) as img:
+        target = ImageEncoder.target_size(img.size, long_edge, max_pixels=10 ** 12)
+        if draft:
+            ImageEncoder.draft_for(img, target)
+        img.load()
+        img = img.convert("RGB")
+        if draft:
+            return img.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0).size
+        return img.resize(target, Image.Resampling.LANCZOS).size
+
+
+def peak_rss_kib() -> int:
+    """プロセスの最大RSS（KiB）。ru_maxrss は exec 前の値を引き継ぐため VmHWM を優先"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def worker(path: str, long_edge: int, draft: bool, repeat: int, queue):
+    """別プロセスで実行し、最大RSSを他の計測と分離する"""
+    baseline = peak_rss_kib()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        size = shrink(path, long_edge, draft)
+    elapsed = (time.perf_counter() - start) / repeat
+    queue.put((elapsed, peak_rss_kib() - baseline, size))
+
+
+def measure(path: Path, long_edge: int, draft: bool, repeat: int):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=worker, args=(str(path), long_edge, draft, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JPEG draftモードによる縮小デコードの比較")
+    parser.add_argument("--megapixels", type=float, default=24)
+    parser.add_argument("--long-edge", type=int, default=1568)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "photo.jpg"
+        width, height = make_photo(path, args.megapixels)
+        full_time, full_rss, size = measure(path, args.long_edge, False, args.repeat)
+        draft_time, draft_rss, _ = measure(path, args.long_edge, True, args.repeat)
+
+    print(f"入力: {width}x{height} JPEG → {size[0]}x{size[1]}")
+    print(f"全解像度デコード: {full_time * 1000:8.1f} ms, 最大RSS増分 {full_rss / 1024:7.1f} MiB")
+    print(f"draftデコード   : {draft_time * 1000:8.1f} ms, 最大RSS増分 {draft_rss / 1024:7.1f} MiB")
+    print(f"処理時間: {full_time / draft_time:.1f} 倍高速, 最大RSS増分: {(1 - draft_rss / full_rss) * 100:.0f}% 削減")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# benchmarks/bench_response_records.py
+# --------------------------------------------------
+# セッション保存時のメモリ使用量比較（Message vs ResponseRecord）
+# 100ターン分のレスポンスをセッション状態（dict）に保持した場合の使用量を計測する
+#
+# 実行: python benchmarks/bench_response_records.py [--turns 100] [--chars 1500]
+# --------------------------------------------------
+
+import argparse
+import gc
+import sys
+import tracemalloc
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from anthropic.types import Message
+
+from helper_api import ResponseProcessor
+
+
+def make_message(turn: int, chars: int) -> Message:
+    """APIレスポンス相当のMessageを生成"""
+    return Message.model_validate({
+        "id"           : f"msg_{turn:024d}",
+        "type"         : "message",
+        "role"         : "assistant",
+        "model"        : "claude-sonnet-4-20250514",
+        "content"      : [{"type": "text", "text": f"回答 {turn}: " + "あ" * chars}],
+        "stop_reason"  : "end_turn",
+        "stop_sequence": None,
+        "usage"        : {"input_tokens": 1200 + turn * 40, "output_tokens": 600},
+    })
+
+
+def measure(turns: int, chars: int, slim: bool) -> int:
+    """セッション状態に turns 件を保持した時点の確保済みメモリ（バイト）"""
+    gc.collect()
+    tracemalloc.start()
+    session_state = {}
+    for turn in range(turns):
+        response = make_message(turn, chars)
+        session_state[f"response_{turn}"] = ResponseProcessor.to_record(response) if slim else response
+        del response
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message と ResponseRecord のセッション保持量比較")
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--chars", type=int, default=1500, help="1回答あたりの文字数")
+    args = parser.parse_args()
+
+    full = measure(args.turns, args.chars, slim=False)
+    slim = measure(args.turns, args.chars, slim=True)
+
+    print(f"ターン数: {args.turns}（1回答 {args.chars} 文字）")
+    print(f"Message保持       : {full / 1024:8.1f} KiB  ({full / args.turns:8.0f} B/turn)")
+    print(f"ResponseRecord保持: {slim / 1024:8.1f} KiB  ({slim / args.turns:8.0f} B/turn)")
+    print(f"削減率            : {(1 - slim / full) * 100:5.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -20,5 +20,15 @@ with open(output_file, 'w', encoding='utf-8') as f:
 
 print(f"日本の都市データを {output_file} に保存しました。件数: {len(jp_cities)}")
 
+# 名前順の列指向インデックス（WeatherDemo等が memory map で読み込む）を再生成
+from helper_api import CityIndex
+
+index_dir = CityIndex.build(output_file)
+print(f"都市インデックスを {index_dir} に生成しました。")
+
+# 座標→都市の逆引き（全世界）用のインデックス（未生成の場合、画面では日本の都市データで代用）
+world_index_dir = CityIndex.build(input_file)
+print(f"全世界の都市インデックスを {world_index_dir} に生成しました。")
+
 # data/cities_list.csv
 
@@ -1,8 +1,9 @@
 # helper_api.py - Anthropic API専用版
 # OpenAI helper_api.py を参考にしたAnthropic API専用の実装
-from typing import List, Dict, Any, Optional, Union, Tuple, Literal, Callable
+from typing import List, Dict, Any, Optional, Union, Tuple, Literal, Callable, Iterator
 from pathlib import Path
 from dataclasses import dataclass
+from collections import deque, OrderedDict
 from functools import wraps
 from datetime import datetime
 from abc import ABC, abstractmethod
@@ -13,11 +14,29 @@ import logging
 import logging.handlers
 import yaml
 import os
+import sys
 import time
+import types
 import json
+import math
 import re
-
+import pickle
+import threading
+import io
+import binascii
+from urllib.parse import urljoin, urlsplit
+import mmap
+import gzip
+import heapq
+import socket
+import ipaddress
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, CancelledError, wait, FIRST_COMPLETED
+
+import numpy as np
+import requests
 import tiktoken
+from PIL import Image, ImageOps
 from anthropic import Anthropic
 
 # -----------------------------------------------------
@@ -285,6 +304,669 @@ class MemoryCache:
 cache = MemoryCache()
 
 
+# ==================================================
+# LRUキャッシュ（セッション層・共有層）
+# ==================================================
+# キャッシュ未命中を表す番兵（Noneを正規の結果として扱うため）
+_CACHE_MISS = object()
+
+class LRUCache:
+    """TTL付きLRUキャッシュ（OrderedDictによりget/set/削除がO(1)）"""
+
+    def __init__(self, max_size: int = 100, ttl: int = 3600):
+        self._storage: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, default: Any = None, ttl: int = None) -> Any:
+        """キャッシュから値を取得（ttlで呼び出し側ごとの有効期限を指定可能）"""
+        with self._lock:
+            entry = self._storage.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            timestamp, value = entry
+            if time.time() - timestamp > (ttl if ttl is not None else self.ttl):
+                del self._storage[key]
+                self.misses += 1
+                return default
+
+            self._storage.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        """キャッシュに値を設定（上限超過時は最も使われていないエントリを削除）"""
+        with self._lock:
+            self._storage[key] = (time.time(), value)
+            self._storage.move_to_end(key)
+            while len(self._storage) > self.max_size:
+                self._storage.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        """エントリの削除"""
+        with self._lock:
+            self._storage.pop(key, None)
+
+    def clear(self) -> None:
+        """キャッシュクリア"""
+        with self._lock:
+            self._storage.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def size(self) -> int:
+        """キャッシュサイズ"""
+        return len(self._storage)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._storage
+
+    def __len__(self) -> int:
+        return len(self._storage)
+
+
+class DiskCache:
+    """ディスク永続キャッシュ（pickle形式・件数上限 / 任意の合計バイト数上限のLRU）"""
+
+    def __init__(self, directory: Union[str, Path], max_size: int = 1000, ttl: int = 86400,
+                 max_bytes: Optional[int] = None):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self._lock = threading.RLock()
+        self._index: Optional[OrderedDict] = None
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.pkl"
+
+    def _load_index(self) -> OrderedDict:
+        """既存ファイルのインデックス（ファイル名 → バイト数）を初回のみ構築（更新時刻の古い順）"""
+        if self._index is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            stats = sorted(((p.name, p.stat()) for p in self.directory.glob("*.pkl")),
+                           key=lambda item: item[1].st_mtime)
+            self._index = OrderedDict((name, stat.st_size) for name, stat in stats)
+            self.total_bytes = sum(self._index.values())
+        return self._index
+
+    def get(self, key: str, default: Any = None, ttl: int = None) -> Any:
+        """キャッシュから値を取得"""
+        with self._lock:
+            index = self._load_index()
+            path = self._path(key)
+            if path.name not in index:
+                return default
+            try:
+                with open(path, 'rb') as f:
+                    timestamp, stored_key, value = pickle.load(f)
+            except Exception as e:
+                logger.warning(f"ディスクキャッシュ読み込みエラー: {e}")
+                self._remove(path)
+                return default
+
+            if stored_key != key or time.time() - timestamp > (ttl if ttl is not None else self.ttl):
+                self._remove(path)
+                return default
+
+            index.move_to_end(path.name)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        """キャッシュに値を保存（一時ファイル経由でアトミックに書き込み）"""
+        with self._lock:
+            index = self._load_index()
+            path = self._path(key)
+            tmp_path = path.with_suffix(".tmp")
+            try:
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump((time.time(), key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.warning(f"ディスクキャッシュ保存エラー: {e}")
+                tmp_path.unlink(missing_ok=True)
+                return
+
+            size = path.stat().st_size
+            self.total_bytes += size - (index.get(path.name) or 0)
+            index[path.name] = size
+            index.move_to_end(path.name)
+            while len(index) > 1 and (len(index) > self.max_size or
+                                      (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                oldest, oldest_size = index.popitem(last=False)
+                self.total_bytes -= oldest_size or 0
+                (self.directory / oldest).unlink(missing_ok=True)
+
+    def _remove(self, path: Path) -> None:
+        self.total_bytes -= self._load_index().pop(path.name, None) or 0
+        path.unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        """キャッシュクリア"""
+        with self._lock:
+            for name in list(self._load_index()):
+                (self.directory / name).unlink(missing_ok=True)
+            self._index.clear()
+            self.total_bytes = 0
+
+    def size(self) -> int:
+        """キャッシュサイズ"""
+        return len(self._load_index())
+
+
+class SharedResultCache:
+    """プロセス内の全セッションで共有する結果キャッシュ（メモリLRU + 任意のディスク層）
+
+    ユーザー固有のデータを含まない結果のみを格納すること。
+    """
+
+    def __init__(self):
+        self.memory = LRUCache(
+            max_size=config.get("cache.shared.max_size", 500),
+            ttl=config.get("cache.shared.ttl", 86400)
+        )
+        self.disk: Optional[DiskCache] = None
+        if config.get("cache.shared.disk_enabled", False):
+            self.disk = DiskCache(
+                Path(config.get("paths.cache_dir", "cache")) / "results",
+                max_size=config.get("cache.shared.disk_max_size", 1000),
+                ttl=config.get("cache.shared.ttl", 86400)
+            )
+
+    def get(self, key: str, default: Any = None, ttl: int = None) -> Any:
+        """メモリ層→ディスク層の順に検索（ディスク命中時はメモリ層へ昇格）"""
+        value = self.memory.get(key, _CACHE_MISS, ttl=ttl)
+        if value is not _CACHE_MISS:
+            return value
+
+        if self.disk is not None:
+            value = self.disk.get(key, _CACHE_MISS, ttl=ttl)
+            if value is not _CACHE_MISS:
+                self.memory.set(key, value)
+                return value
+
+        return default
+
+    def set(self, key: str, value: Any, persist: bool = False) -> None:
+        """キャッシュに値を設定（persist=Trueでディスク層にも保存）"""
+        self.memory.set(key, value)
+        if persist and self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self) -> None:
+        """キャッシュクリア"""
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def size(self) -> int:
+        """キャッシュサイズ（メモリ層）"""
+        return self.memory.size()
+
+
+# セッション間共有キャッシュインスタンス
+shared_cache = SharedResultCache()
+
+
+def make_cache_key(name: str, args: tuple = (), kwargs: Dict[str, Any] = None) -> str:
+    """正規化したキャッシュキーの生成（キーワード引数の順序に依存しない）"""
+    payload = json.dumps(
+        [list(args), kwargs or {}],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(',', ':'),
+        default=safe_json_serializer
+    )
+    return f"{name}_{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+# ==================================================
+# パフォーマンス計測（リングバッファ + ストリーミング分位点）
+# ==================================================
+class StreamingQuantile:
+    """P²アルゴリズムによる分位点のストリーミング推定
+
+    サンプルを保持せず5つのマーカーのみを更新するため、
+    観測数に関わらずメモリ・更新コストともにO(1)。
+    """
+
+    def __init__(self, p: float):
+        if not 0.0 < p < 1.0:
+            raise ValueError(f"Invalid quantile: {p}. Must be between 0 and 1")
+        self.p = p
+        self.count = 0
+        self._heights: List[float] = []
+        self._positions = [0, 1, 2, 3, 4]
+        self._desired = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]
+        self._increments = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def add(self, value: float) -> None:
+        """観測値の追加"""
+        self.count += 1
+        q = self._heights
+
+        # 最初の5件はそのまま保持してマーカーを初期化
+        if self.count <= 5:
+            q.append(value)
+            q.sort()
+            return
+
+        n = self._positions
+        if value < q[0]:
+            q[0] = value
+            k = 0
+        elif value >= q[4]:
+            q[4] = value
+            k = 3
+        else:
+            k = 0
+            while value >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        # 中間マーカーの位置調整
+        for i in range(1, 4):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                step = 1 if d > 0 else -1
+                height = self._parabolic(i, step)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = self._linear(i, step)
+                q[i] = height
+                n[i] += step
+
+    def _parabolic(self, i: int, step: int) -> float:
+        """区分放物線（P²）補間"""
+        q, n = self._heights, self._positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def _linear(self, i: int, step: int) -> float:
+        """線形補間（放物線補間が単調性を崩す場合）"""
+        q, n = self._heights, self._positions
+        return q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+
+    def value(self) -> Optional[float]:
+        """現在の分位点推定値"""
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            index = min(int(round(self.p * (self.count - 1))), self.count - 1)
+            return self._heights[index]
+        return self._heights[2]
+
+
+class PerformanceStats:
+    """関数単位の実行時間統計（直近サンプルのリングバッファ + 分位点スケッチ）"""
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, name: str, buffer_size: int = 100):
+        self.name = name
+        self.recent = deque(maxlen=buffer_size)
+        self.count = 0
+        self.total_time = 0.0
+        self.min_time: Optional[float] = None
+        self.max_time: Optional[float] = None
+        self._quantiles = {p: StreamingQuantile(p) for p in self.QUANTILES}
+
+    def record(self, execution_time: float, timestamp: datetime = None,
+               function_name: str = None) -> Dict[str, Any]:
+        """実行時間の記録"""
+        sample = {
+            'function'      : function_name or self.name,
+            'execution_time': execution_time,
+            'timestamp'     : timestamp or datetime.now()
+        }
+        self.recent.append(sample)
+        self.count += 1
+        self.total_time += execution_time
+        self.min_time = execution_time if self.min_time is None else min(self.min_time, execution_time)
+        self.max_time = execution_time if self.max_time is None else max(self.max_time, execution_time)
+        for estimator in self._quantiles.values():
+            estimator.add(execution_time)
+        return sample
+
+    @property
+    def avg_time(self) -> float:
+        """平均実行時間（全期間）"""
+        return self.total_time / self.count if self.count else 0.0
+
+    def quantile(self, p: float) -> Optional[float]:
+        """分位点の取得（QUANTILESで定義したもののみ）"""
+        if p not in self._quantiles:
+            raise ValueError(f"Unsupported quantile: {p}. Must be one of {self.QUANTILES}")
+        return self._quantiles[p].value()
+
+    def summary(self) -> Dict[str, Any]:
+        """統計サマリー（JSON serializable）"""
+        return {
+            'function': self.name,
+            'count'   : self.count,
+            'avg'     : self.avg_time,
+            'min'     : self.min_time,
+            'max'     : self.max_time,
+            'p50'     : self.quantile(0.5),
+            'p95'     : self.quantile(0.95),
+            'p99'     : self.quantile(0.99),
+        }
+
+
+class PerformanceTracker:
+    """実行時間メトリクスの集約（セッション内でメモリ使用量が一定）"""
+
+    def __init__(self, buffer_size: int = None):
+        self.buffer_size = buffer_size or config.get("performance.buffer_size", 100)
+        self._overall = PerformanceStats("*", self.buffer_size)
+        self._stats: Dict[str, PerformanceStats] = {}
+
+    def record(self, function_name: str, execution_time: float, timestamp: datetime = None) -> None:
+        """実行時間の記録"""
+        stats = self._stats.get(function_name)
+        if stats is None:
+            stats = self._stats[function_name] = PerformanceStats(function_name, self.buffer_size)
+        sample = stats.record(execution_time, timestamp)
+        self._overall.record(execution_time, sample['timestamp'], function_name)
+
+    @property
+    def total_count(self) -> int:
+        """全関数の実行回数"""
+        return self._overall.count
+
+    @property
+    def overall(self) -> PerformanceStats:
+        """全関数を合算した統計"""
+        return self._overall
+
+    def get_stats(self, function_name: str) -> Optional[PerformanceStats]:
+        """関数単位の統計の取得"""
+        return self._stats.get(function_name)
+
+    def recent(self, limit: int = None) -> List[Dict[str, Any]]:
+        """直近サンプルの取得（古い順）"""
+        samples = list(self._overall.recent)
+        return samples[-limit:] if limit else samples
+
+    def latest(self) -> Optional[Dict[str, Any]]:
+        """最新サンプルの取得"""
+        return self._overall.recent[-1] if self._overall.recent else None
+
+    def summaries(self) -> List[Dict[str, Any]]:
+        """関数別サマリー（実行回数の多い順）"""
+        return sorted((s.summary() for s in self._stats.values()),
+                      key=lambda row: row['count'], reverse=True)
+
+    def clear(self) -> None:
+        """メトリクスのクリア"""
+        self._overall = PerformanceStats("*", self.buffer_size)
+        self._stats.clear()
+
+    def __len__(self) -> int:
+        return self.total_count
+
+
+# ==================================================
+# メモリ計測
+# ==================================================
+_SIZE_SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                    types.MethodType, types.CodeType, types.FrameType)
+_SIZE_LEAF_TYPES = (str, bytes, bytearray, int, float, complex, bool, type(None), range)
+# 属性まで辿るペイロード型（このモジュールの履歴・レコード・キャッシュ類）。
+# それ以外のオブジェクト（クライアント・ロック等）は本体のサイズのみ数え、参照先は辿らない
+_SIZE_PAYLOAD_TYPE_NAMES = ("LRUCache", "MessageHistory", "ConversationLog", "ConversationBuilder",
+                            "ResponseRecord", "PerformanceTracker", "PerformanceStats", "StreamingQuantile")
+_size_payload_types: Optional[tuple] = None
+
+
+def _payload_types() -> tuple:
+    global _size_payload_types
+    if _size_payload_types is None:
+        from pydantic import BaseModel
+        _size_payload_types = tuple(globals()[name] for name in _SIZE_PAYLOAD_TYPE_NAMES) + (BaseModel,)
+    return _size_payload_types
+
+
+def deep_sizeof(obj: Any, seen: set = None, max_bytes: int = None) -> int:
+    """オブジェクトが参照する値を含めた概算サイズ（バイト）
+
+    dict/list/tuple/set/deque と、ペイロード型（履歴・レコード・キャッシュ・APIレスポンスの
+    pydanticモデル）の __dict__ / __slots__ を辿る。NumPy配列は nbytes を数える。
+    その他のオブジェクトは本体のみ数える。max_bytes に達した時点で走査を打ち切る（値は下限）。
+    seen を共有すると複数オブジェクト間で重複して数えない。
+    """
+    seen = set() if seen is None else seen
+    payload_types = _payload_types()
+    total = 0
+    stack = [obj]
+    while stack:
+        if max_bytes is not None and total >= max_bytes:
+            break
+        current = stack.pop()
+        if id(current) in seen or isinstance(current, _SIZE_SKIP_TYPES):
+            continue
+        seen.add(id(current))
+        try:
+            total += sys.getsizeof(current)
+        except TypeError:
+            continue
+
+        if isinstance(current, _SIZE_LEAF_TYPES):
+            continue
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset, deque, OrderedDict)):
+            stack.extend(current)
+        elif isinstance(current, np.ndarray):
+            if current.base is None:
+                total += current.nbytes
+        elif isinstance(current, payload_types):
+            attrs = getattr(current, '__dict__', None)
+            if isinstance(attrs, dict):
+                stack.append(attrs)
+            for klass in type(current).__mro__:
+                for slot in getattr(klass, '__slots__', ()):
+                    if isinstance(slot, str) and hasattr(current, slot):
+                        stack.append(getattr(current, slot))
+    return total
+
+
+def format_bytes(size: Union[int, float]) -> str:
+    """バイト数を読みやすい単位に変換"""
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def process_memory_usage() -> Optional[int]:
+    """プロセスの常駐メモリ（RSS、バイト）。取得できない環境ではNone"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linuxはキロバイト、macOSはバイト単位（こちらはピーク値）
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+
+class MemoryAccountant:
+    """セッション状態のメモリ計測と上限管理
+
+    キーごとの深いサイズ（上限 cap_bytes で打ち切り）を計測し、値が変化した（または touch された）
+    時刻を最終使用時刻として記録する。上限超過時は明示的に指定されたキーのうち、最終使用時刻の
+    古い大きなものから破棄する（いずれも末尾 * は前方一致）。
+
+    - evictable_keys: キャッシュ（LRUCache・dict）の中身をクリアする（キーは残す）
+    - rebuildable_keys: 持ち主が次の使用時に再構築する値（送信用ビルダー等）で、キーごと削除する
+
+    指定外の値（会話ログ・表示中のレスポンス等）は破棄しないため、それらで上限を超えている
+    場合は計測値の表示（警告）のみとなる。
+    """
+
+    def __init__(self, cap_bytes: int = None, min_evict_bytes: int = None,
+                 evictable_keys: List[str] = None, exclude_keys: List[str] = None,
+                 rebuildable_keys: List[str] = None):
+        if cap_bytes is None:
+            cap_bytes = int(config.get("memory.session_cap_mb", 256) * 1024 * 1024)
+        if min_evict_bytes is None:
+            min_evict_bytes = int(config.get("memory.evict_min_kb", 64) * 1024)
+        if evictable_keys is None:
+            evictable_keys = config.get("memory.evictable_keys", ["ui_cache"])
+        self.cap_bytes = cap_bytes
+        self.min_evict_bytes = min_evict_bytes
+        self.evictable_keys = list(evictable_keys)
+        if rebuildable_keys is None:
+            rebuildable_keys = config.get("memory.rebuildable_keys", [])
+        self.rebuildable_keys = list(rebuildable_keys)
+        self.exclude_keys = set(exclude_keys or [])
+        self.evicted: deque = deque(maxlen=50)
+        self.last_total = 0
+        self.last_measured: Optional[float] = None
+        self._last_used: Dict[str, Tuple[Tuple[int, int], float]] = {}
+
+    def touch(self, key: str):
+        """キーの使用を記録（LRU順序の更新）"""
+        fingerprint = self._last_used.get(key, ((0, 0), 0.0))[0]
+        self._last_used[key] = (fingerprint, time.time())
+
+    @staticmethod
+    def _matches(key: str, patterns: List[str]) -> bool:
+        return any(key.startswith(entry[:-1]) if entry.endswith("*") else key == entry
+                   for entry in patterns)
+
+    def is_rebuildable(self, key: str) -> bool:
+        """キーごと削除してよい（持ち主が再構築する）値か"""
+        return self._matches(key, self.rebuildable_keys)
+
+    def is_evictable(self, key: str, value: Any = None) -> bool:
+        """破棄対象か（再構築される値、または指定されたキーのキャッシュ（LRUCache・dict））"""
+        if self.is_rebuildable(key):
+            return True
+        if value is not None and not isinstance(value, (LRUCache, dict)):
+            return False
+        return self._matches(key, self.evictable_keys)
+
+    def measure(self, state) -> List[Dict[str, Any]]:
+        """キーごとのサイズ（降順）"""
+        now = time.time()
+        rows = []
+        for key in list(state.keys()):
+            if key in self.exclude_keys:
+                continue
+            value = state[key]
+            size = deep_sizeof(value, max_bytes=self.cap_bytes)
+            fingerprint = (id(value), size)
+            previous = self._last_used.get(key)
+            last_used = previous[1] if previous and previous[0] == fingerprint else now
+            self._last_used[key] = (fingerprint, last_used)
+            rows.append({
+                "key"      : key,
+                "type"     : type(value).__name__,
+                "size"     : size,
+                "last_used": last_used,
+                "evictable": self.is_evictable(key, value),
+            })
+
+        # 削除されたキーの記録を破棄
+        live = {row["key"] for row in rows}
+        for key in [k for k in self._last_used if k not in live]:
+            del self._last_used[key]
+
+        rows.sort(key=lambda row: row["size"], reverse=True)
+        self.last_total = sum(row["size"] for row in rows)
+        self.last_measured = now
+        return rows
+
+    def enforce(self, state, rows: List[Dict[str, Any]] = None) -> List[str]:
+        """上限を超えている場合に古い大きなキャッシュ成果物を破棄し、破棄したキーを返す"""
+        if rows is None:
+            rows = self.measure(state)
+        total = sum(row["size"] for row in rows)
+        if total <= self.cap_bytes:
+            return []
+
+        candidates = sorted(
+            (row for row in rows if row["evictable"] and row["size"] >= self.min_evict_bytes),
+            key=lambda row: (row["last_used"], -row["size"])
+        )
+        evicted = []
+        for row in candidates:
+            if total <= self.cap_bytes:
+                break
+            key = row["key"]
+            if self.is_rebuildable(key):
+                if key not in state:
+                    continue
+                del state[key]
+                total -= row["size"]
+            else:
+                value = state.get(key)
+                if not isinstance(value, (LRUCache, dict)):
+                    continue
+                value.clear()
+                total -= row["size"] - deep_sizeof(value)
+            evicted.append(key)
+            self.evicted.append({"key": key, "size": row["size"], "timestamp": time.time()})
+
+        if evicted:
+            logger.info(f"Session memory cap exceeded: evicted {evicted} ({format_bytes(total)} remaining)")
+        self.last_total = total
+        return evicted
+
+
+class SessionMemoryRegistry:
+    """プロセス内の全セッションのメモリ使用量の集計（スレッドセーフ）"""
+
+    def __init__(self, ttl: float = 3600):
+        self.ttl = ttl
+        self._sessions: Dict[str, Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def update(self, session_id: str, total_bytes: int):
+        with self._lock:
+            self._sessions[session_id] = (time.time(), total_bytes)
+
+    def remove(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def summary(self) -> Dict[str, Any]:
+        """セッション数・合計・最大（ttl以上更新のないセッションは除外）"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for session_id in [s for s, (ts, _) in self._sessions.items() if ts < cutoff]:
+                del self._sessions[session_id]
+            sizes = [size for _, size in self._sessions.values()]
+        return {
+            "sessions"   : len(sizes),
+            "total_bytes": sum(sizes),
+            "max_bytes"  : max(sizes) if sizes else 0,
+            "rss_bytes"  : process_memory_usage(),
+        }
+
+
+session_memory = SessionMemoryRegistry()
+
+
 # ==================================================
 # 安全なJSON処理関数
 # ==================================================
@@ -443,6 +1125,375 @@ def append_assistant_message(append_text: str) -> List[MessageParam]:
 # ==================================================
 # メッセージ管理
 # ==================================================
+class MessageHistory:
+    """上限付きメッセージ履歴
+
+    先頭の system/developer メッセージは履歴とは別に固定保持し（上限超過時も破棄しない）、
+    それ以外は2件目以降の system/developer を含めて追加順に maxlen付きdequeで保持する
+    （追加・古いメッセージの破棄はO(1)）。
+    snapshot() は変更があるまで同じタプルを返すため、API呼び出しごとに履歴全体を
+    コピーしない。
+    """
+
+    PINNED_ROLES = ("system", "developer")
+
+    def __init__(self, messages: List[Dict[str, Any]] = None, limit: int = 50):
+        self._pinned: Optional[Dict[str, Any]] = None
+        self._messages: deque = deque(maxlen=max(1, int(limit)))
+        self._snapshot: Optional[Tuple[Dict[str, Any], ...]] = None
+        self.extend(messages or [])
+
+    @property
+    def limit(self) -> int:
+        return self._messages.maxlen
+
+    @property
+    def pinned(self) -> Optional[Dict[str, Any]]:
+        """固定保持中の先頭の system/developer メッセージ"""
+        return self._pinned
+
+    def append(self, message: Dict[str, Any]):
+        """メッセージの追加（先頭の system/developer のみ固定し、以降は追加順に保持）"""
+        if message.get("role") in self.PINNED_ROLES and self._pinned is None and not self._messages:
+            self._pinned = message
+        else:
+            self._messages.append(message)
+        self._snapshot = None
+
+    def extend(self, messages: List[Dict[str, Any]]):
+        for message in messages:
+            self.append(message)
+
+    def clear(self):
+        self._pinned = None
+        self._messages.clear()
+        self._snapshot = None
+
+    def snapshot(self) -> Tuple[Dict[str, Any], ...]:
+        """読み取り専用ビュー（固定メッセージ + 履歴）"""
+        if self._snapshot is None:
+            head = (self._pinned,) if self._pinned is not None else ()
+            self._snapshot = head + tuple(self._messages)
+        return self._snapshot
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return list(self.snapshot())
+
+    def __len__(self) -> int:
+        return len(self._messages) + (1 if self._pinned is not None else 0)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+
+class ConversationLog:
+    """追記専用の共有メッセージログ
+
+    会話ステップは送信したメッセージ列のコピーを持たず、このログ上の範囲 [start, end) だけを
+    記録する。各ステップの送信内容は slice(start, end) で必要な時に再構成する。
+    """
+
+    def __init__(self, messages: List[Dict[str, Any]] = None):
+        self._messages: List[Dict[str, Any]] = list(messages or [])
+
+    def append(self, message: Dict[str, Any]) -> int:
+        """メッセージを追記し、その位置を返す"""
+        self._messages.append(message)
+        return len(self._messages) - 1
+
+    def extend(self, messages: List[Dict[str, Any]]):
+        self._messages.extend(messages)
+
+    def slice(self, start: int, end: int) -> List[Dict[str, Any]]:
+        """範囲 [start, end) のメッセージ列を再構成"""
+        return self._messages[start:end]
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return list(self._messages)
+
+    def clear(self):
+        self._messages = []
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+
+class ConversationBuilder:
+    """送信用メッセージ列のインクリメンタル構築
+
+    送信可能な状態のメッセージ列とトークン数を保持し、ターン追加時は追加分のみを処理する
+    （毎ターンの再構築・再カウントをしない）。新しいユーザーメッセージを追加するたびに、
+    その直前までを安定したプレフィックスとして cache_control を付け替える（プロンプトキャッシュ）。
+    max_messages を超えた場合は先頭から破棄し、先頭が user メッセージになるよう揃える。
+    プレフィックスキャッシュ有効時は trim_block 件まとめて破棄し、次の破棄まで先頭を固定する
+    （1件ずつずらすとプレフィックスが毎ターン変わり、キャッシュが当たらないため）。
+    """
+
+    CACHE_CONTROL = {"type": "ephemeral"}
+
+    def __init__(self, prefix: List[MessageParam] = None, model: str = None,
+                 max_messages: int = None, cache_prefix: bool = None, min_cache_tokens: int = None,
+                 trim_block: int = None):
+        if model is None:
+            model = config.get("models.default", "claude-sonnet-4-20250514")
+        if cache_prefix is None:
+            cache_prefix = config.get("prompt_cache.enabled", True) is True
+        if min_cache_tokens is None:
+            min_cache_tokens = config.get("prompt_cache.min_tokens", 1024)
+        self.model = model
+        if trim_block is None:
+            trim_block = config.get("prompt_cache.trim_block_messages", 4)
+        self.max_messages = max_messages
+        self.trim_block = trim_block if cache_prefix else 0
+        self.cache_prefix = cache_prefix
+        self.min_cache_tokens = min_cache_tokens
+        self.total_tokens = 0
+        self._messages: List[MessageParam] = []
+        self._tokens: List[int] = []
+        self._marked: Optional[Tuple[int, MessageParam]] = None
+        self.extend(prefix or [])
+
+    @staticmethod
+    def _content_text(content: Any) -> str:
+        if isinstance(content, str):
+            return content
+        if isinstance(content, list):
+            return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+        return ""
+
+    def append(self, role: str, content: Any) -> List[MessageParam]:
+        """メッセージの追加（送信用メッセージ列を返す）"""
+        message = {"role": role, "content": content}
+        count = TokenManager.count_tokens(self._content_text(content), self.model)
+        self._messages.append(message)
+        self._tokens.append(count)
+        self.total_tokens += count
+        self._trim()
+        if role == "user":
+            self._mark_prefix()
+        return self._messages
+
+    def extend(self, messages: List[MessageParam]):
+        for message in messages:
+            self.append(message["role"], message["content"])
+
+    def pop(self) -> Optional[MessageParam]:
+        """末尾メッセージの取り消し（API呼び出し失敗時のロールバック用）"""
+        if not self._messages:
+            return None
+        if self._marked and self._marked[0] == len(self._messages) - 1:
+            self._unmark()
+        message = self._messages.pop()
+        self.total_tokens -= self._tokens.pop()
+        return message
+
+    def messages(self) -> List[MessageParam]:
+        """送信用メッセージ列（コピーしない。呼び出し側で変更しないこと）"""
+        return self._messages
+
+    def plain_messages(self) -> List[MessageParam]:
+        """cache_control を付与する前の形のメッセージ列（コピー）"""
+        messages = list(self._messages)
+        if self._marked:
+            index, original = self._marked
+            messages[index] = original
+        return messages
+
+    def replace_head(self, count: int, messages: List[MessageParam]):
+        """先頭 count 件を messages で置き換える（コンパクション結果の適用用）"""
+        count = min(count, len(self._messages))
+        marked_last = bool(self._marked) and self._marked[0] == len(self._messages) - 2
+        self._unmark()
+        counts = [TokenManager.count_tokens(self._content_text(msg["content"]), self.model)
+                  for msg in messages]
+        self.total_tokens += sum(counts) - sum(self._tokens[:count])
+        self._messages[:count] = [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+        self._tokens[:count] = counts
+        if marked_last and self._messages and self._messages[-1]["role"] == "user":
+            self._mark_prefix()
+
+    @property
+    def prefix_index(self) -> Optional[int]:
+        """cache_control を付与したメッセージの位置（未付与はNone）"""
+        return self._marked[0] if self._marked else None
+
+    def clear(self):
+        self._messages = []
+        self._tokens = []
+        self._marked = None
+        self.total_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def _mark_prefix(self):
+        """最新のユーザーメッセージ直前までをキャッシュ対象としてマーク"""
+        index = len(self._messages) - 2
+        if self._marked and self._marked[0] == index:
+            return
+        self._unmark()
+        if not self.cache_prefix or index < 0:
+            return
+        if self.total_tokens - self._tokens[-1] < self.min_cache_tokens:
+            return
+
+        original = self._messages[index]
+        content = original["content"]
+        if isinstance(content, str):
+            blocks = [{"type": "text", "text": content}]
+        elif isinstance(content, list) and content:
+            blocks = [dict(block) if isinstance(block, dict) else block for block in content]
+        else:
+            return
+        if not isinstance(blocks[-1], dict):
+            return
+        blocks[-1]["cache_control"] = self.CACHE_CONTROL
+        self._messages[index] = {"role": original["role"], "content": blocks}
+        self._marked = (index, original)
+
+    def _unmark(self):
+        if self._marked:
+            index, original = self._marked
+            self._messages[index] = original
+            self._marked = None
+
+    def _trim(self):
+        if not self.max_messages or len(self._messages) <= self.max_messages:
+            return
+        # 上限超過時は trim_block 件の余裕ができるまで破棄（最低2件は残す）
+        keep = max(min(self.max_messages, 2), self.max_messages - self.trim_block)
+        drop = len(self._messages) - keep
+        while drop < len(self._messages) - 1 and self._messages[drop]["role"] != "user":
+            drop += 1
+        self._unmark()
+        self.total_tokens -= sum(self._tokens[:drop])
+        del self._messages[:drop]
+        del self._tokens[:drop]
+
+
+class ConversationCompactor:
+    """会話履歴のバックグラウンド要約（コンパクション）
+
+    履歴のトークン数が閾値を超えたら、直近 keep_messages 件を残して古いメッセージを
+    fastカテゴリのモデルでバックグラウンド要約する。要約の完了を待たずにターンを進め、
+    完了後の次のターンで poll() の結果を使って古いメッセージを要約メッセージに置き換える。
+    """
+
+    SUMMARY_HEADER = "[これまでの会話の要約]"
+    SUMMARY_PROMPT = (
+        "あなたは会話の要約担当です。以下の会話ログを、後続の会話で参照できるよう日本語で簡潔に要約してください。"
+        "ユーザーの目的・前提条件・決定事項・未解決の質問・固有名詞や数値は必ず残してください。"
+    )
+
+    _executor: Optional[ThreadPoolExecutor] = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, model: str = None, threshold_tokens: int = None,
+                 keep_messages: int = None, max_summary_tokens: int = None):
+        if model is None:
+            model = config.get("compaction.model") or \
+                (config.get("models.categories.fast") or ["claude-3-5-haiku-20241022"])[0]
+        self.model = model
+        self.threshold_tokens = threshold_tokens or config.get("compaction.threshold_tokens", 8000)
+        self.keep_messages = keep_messages or config.get("compaction.keep_messages", 6)
+        self.max_summary_tokens = max_summary_tokens or config.get("compaction.max_summary_tokens", 1024)
+        self._pending: Optional[Tuple[Any, int, Future]] = None
+        self.compactions = 0
+
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=config.get("compaction.max_workers", 2),
+                    thread_name_prefix="compaction",
+                )
+            return cls._executor
+
+    @property
+    def pending(self) -> bool:
+        """要約処理の実行中（未適用）か"""
+        return self._pending is not None
+
+    def cut_index(self, messages: List[MessageParam]) -> int:
+        """要約対象の件数（残す側の先頭が user メッセージになる位置）"""
+        cut = len(messages) - self.keep_messages
+        while cut > 0 and messages[cut]["role"] != "user":
+            cut -= 1
+        return max(cut, 0)
+
+    def submit(self, client: Anthropic, messages: List[MessageParam], total_tokens: int,
+               owner: Any = None) -> bool:
+        """閾値超過時に古いメッセージの要約をバックグラウンドで開始（開始したらTrue）
+
+        owner には履歴の保持オブジェクトを渡す。参照を保持し、poll() 時に同一オブジェクトの場合のみ結果を返す
+        （id() は解放後に再利用されるため比較に使わない）。
+        """
+        if self._pending is not None or total_tokens <= self.threshold_tokens:
+            return False
+        cut = self.cut_index(messages)
+        if cut < 2:
+            return False
+        snapshot = [{"role": msg["role"], "content": msg["content"]} for msg in messages[:cut]]
+        future = self._get_executor().submit(self._summarize, client, snapshot, UsageLog.current())
+        self._pending = (owner, cut, future)
+        return True
+
+    def poll(self, owner: Any = None) -> Optional[Tuple[int, MessageParam]]:
+        """完了した要約の取得（(置き換える件数, 要約メッセージ) / 未完了・失敗はNone）"""
+        if self._pending is None:
+            return None
+        pending_owner, cut, future = self._pending
+        if not future.done():
+            return None
+        self._pending = None
+        if pending_owner is not owner:
+            return None
+        try:
+            summary = future.result()
+        except Exception as e:
+            logger.warning(f"Conversation compaction failed: {e}")
+            return None
+        if not summary:
+            return None
+        self.compactions += 1
+        return cut, self.summary_message(summary)
+
+    def discard(self):
+        """実行中の要約結果を破棄（履歴のクリア・インポート・新規会話時）"""
+        if self._pending is not None:
+            self._pending[2].cancel()
+        self._pending = None
+
+    @classmethod
+    def summary_message(cls, summary: str) -> MessageParam:
+        return {"role": "user", "content": f"{cls.SUMMARY_HEADER}\n{summary}"}
+
+    @staticmethod
+    def _transcript(messages: List[MessageParam]) -> str:
+        lines = []
+        for msg in messages:
+            text = ConversationBuilder._content_text(msg["content"])
+            if text:
+                lines.append(f"{msg['role']}: {text}")
+        return "\n\n".join(lines)
+
+    def _summarize(self, client: Anthropic, messages: List[MessageParam], log: "UsageLog" = None) -> str:
+        """要約の実行（ワーカースレッドで実行される。Streamlit APIは呼ばない）
+
+        使用量は submit 時点のセッションの記録先（log）へ記録する。
+        """
+        response = client.messages.create(
+            model=self.model,
+            max_tokens=self.max_summary_tokens,
+            system=self.SUMMARY_PROMPT,
+            messages=[{"role": "user", "content": self._transcript(messages)}],
+        )
+        if log is not None:
+            log.record_response(response)
+        return "\n".join(ResponseProcessor.extract_text(response)).strip()
+
+
 class MessageManager:
     """メッセージ履歴の管理（Anthropic API用）"""
 
@@ -520,20 +1571,123 @@ class TokenManager:
         "claude-3-haiku-20240307"    : "cl100k_base",
     }
 
+    # (テキストハッシュ, エンコーディング) → トークン数 のメモ（プロセス共有）
+    _count_cache = LRUCache(max_size=config.get("tokens.cache_size", 256), ttl=float("inf"))
+    _count_executor: Optional[ThreadPoolExecutor] = None
+    _pending_counts: Dict[str, Future] = {}
+    _pending_lock = threading.Lock()
+    # 入力欄ごと（スロット）の最新テキストキーと初回観測時刻（入力中の計算要求をまとめる）
+    _slot_keys: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+    MAX_SLOTS = 1024
+
+    @classmethod
+    def _count_key(cls, text: str, model: str) -> Tuple[str, str]:
+        """メモ用キー（同じエンコーディングのモデル間で共有）"""
+        encoding_name = cls.MODEL_ENCODINGS.get(model, "cl100k_base")
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+        return f"{encoding_name}_{digest}", encoding_name
+
+    @staticmethod
+    def _encode_count(text: str, encoding_name: str) -> int:
+        """トークン数の計算（tiktoken）"""
+        enc = tiktoken.get_encoding(encoding_name)
+        return len(enc.encode(text))
+
     @classmethod
     def count_tokens(cls, text: str, model: str = None) -> int:
-        """テキストのトークン数をカウント"""
+        """テキストのトークン数をカウント（同一テキストの再計算はメモから返す）"""
         if model is None:
             model = config.get("models.default", "claude-sonnet-4-20250514")
 
+        key, encoding_name = cls._count_key(text, model)
+        cached = cls._count_cache.get(key)
+        if cached is not None:
+            return cached
+
+        # バックグラウンドで計算中なら、その結果を待って再利用
+        pending = cls._pending_counts.get(key)
+        if pending is not None:
+            try:
+                return pending.result()
+            except (Exception, CancelledError):
+                pass
+
         try:
-            encoding_name = cls.MODEL_ENCODINGS.get(model, "cl100k_base")
-            enc = tiktoken.get_encoding(encoding_name)
-            return len(enc.encode(text))
+            count = cls._encode_count(text, encoding_name)
         except Exception as e:
             logger.error(f"トークンカウントエラー: {e}")
             # 簡易的な推定（1文字 = 0.5トークン）
-            return len(text) // 2
+            return cls.estimate_tokens(text)
+
+        cls._count_cache.set(key, count)
+        return count
+
+    @classmethod
+    def count_tokens_async(cls, text: str, model: str = None, slot: str = "default") -> Optional[int]:
+        """トークン数の取得（UIプレビュー用）
+
+        メモ済み・短いテキストは即座に返す。長いテキストは別スレッドで計算を開始して
+        Noneを返し、次回以降の呼び出し（送信時のcount_tokensを含む）で結果を再利用する。
+        入力中の再実行で計算要求が積み上がらないよう、スロット（入力欄）ごとに同じテキストが
+        tokens.async_debounce 秒続いてから計算を開始し、テキストが変わった時点で
+        開始前の古い計算は取り消す。
+        """
+        if model is None:
+            model = config.get("models.default", "claude-sonnet-4-20250514")
+
+        if len(text) < config.get("tokens.async_threshold", 20000):
+            return cls.count_tokens(text, model)
+
+        key, encoding_name = cls._count_key(text, model)
+        cached = cls._count_cache.get(key)
+        if cached is not None:
+            return cached
+
+        debounce = config.get("tokens.async_debounce", 0.5)
+        now = time.monotonic()
+        stale = None
+        with cls._pending_lock:
+            previous = cls._slot_keys.get(slot)
+            if previous is None or previous[0] != key:
+                cls._slot_keys[slot] = (key, now)
+                cls._slot_keys.move_to_end(slot)
+                while len(cls._slot_keys) > cls.MAX_SLOTS:
+                    cls._slot_keys.popitem(last=False)
+                if previous is not None and all(k != previous[0] for k, _ in cls._slot_keys.values()):
+                    stale = cls._pending_counts.get(previous[0])
+                started = debounce <= 0
+            else:
+                started = now - previous[1] >= debounce
+
+            future = None
+            if started and key not in cls._pending_counts:
+                if cls._count_executor is None:
+                    cls._count_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="token_count")
+                future = cls._count_executor.submit(cls._encode_count, text, encoding_name)
+                cls._pending_counts[key] = future
+
+        # cancel・完了済みFutureへの登録はコールバックが呼び出しスレッドで即時実行されるため、ロック外で行う
+        if stale is not None:
+            stale.cancel()
+        if future is not None:
+            future.add_done_callback(lambda f, k=key: cls._on_count_done(k, f))
+        return None
+
+    @classmethod
+    def _on_count_done(cls, key: str, future: Future) -> None:
+        """バックグラウンド計算完了時にメモへ格納（取り消された計算は破棄）"""
+        if not future.cancelled():
+            try:
+                cls._count_cache.set(key, future.result())
+            except Exception as e:
+                logger.error(f"トークンカウントエラー: {e}")
+        with cls._pending_lock:
+            cls._pending_counts.pop(key, None)
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """簡易的なトークン数推定（1文字 = 0.5トークン）"""
+        return len(text) // 2
 
     @classmethod
     def truncate_text(cls, text: str, max_tokens: int, model: str = None) -> str:
@@ -585,58 +1739,360 @@ class TokenManager:
 
 
 # ==================================================
-# レスポンス処理
+# コスト計算
 # ==================================================
-class ResponseProcessor:
-    """Anthropic API レスポンスの処理"""
-
-    @staticmethod
-    def extract_text(response: Message) -> List[str]:
-        """レスポンスからテキストを抽出"""
-        texts = []
+USAGE_COLUMNS = ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
 
-        if hasattr(response, 'content'):
-            for content in response.content:
-                if hasattr(content, 'type') and content.type == "text":
-                    if hasattr(content, 'text'):
-                        texts.append(content.text)
 
-        return texts
+class UsageLog:
+    """リクエスト単位の使用量記録（列指向・上限付き）
 
-    @staticmethod
-    def _serialize_usage(usage_obj) -> Dict[str, Any]:
-        """ResponseUsageオブジェクトを辞書に変換"""
-        if usage_obj is None:
-            return {}
+    model / timestamp と USAGE_COLUMNS の4種類のトークン数を列ごとの deque で保持し、
+    to_arrays() でまとめてNumPy配列に変換する。
+    記録はセッションごとに分ける。UI層が set_resolver() で「呼び出し元セッションの記録」を返す
+    関数を登録し、APIクライアントは record_current() でそこへ記録する（セッション外では記録しない）。
+    """
 
-        # Pydantic モデルの場合
-        if hasattr(usage_obj, 'model_dump'):
-            try:
-                return usage_obj.model_dump()
-            except Exception:
-                pass
+    _resolver: Optional[Callable[[], Optional["UsageLog"]]] = None
 
-        # dict() メソッドがある場合
-        if hasattr(usage_obj, 'dict'):
-            try:
-                return usage_obj.dict()
-            except Exception:
-                pass
+    def __init__(self, max_entries: int = None):
+        if max_entries is None:
+            max_entries = config.get("cost.usage_log_size", 10000)
+        self.max_entries = max_entries
+        self._models: deque = deque(maxlen=max_entries)
+        self._timestamps: deque = deque(maxlen=max_entries)
+        self._tokens: deque = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
 
-        # 手動で属性を抽出
-        usage_dict = {}
-        for attr in ['prompt_tokens', 'completion_tokens', 'total_tokens']:
-            if hasattr(usage_obj, attr):
-                usage_dict[attr] = getattr(usage_obj, attr)
+    def record(self, model: str, usage: Any, timestamp: float = None):
+        """使用量の記録（usage は SDK の Usage オブジェクトまたは辞書）"""
+        if usage is None:
+            return
+        getter = usage.get if isinstance(usage, dict) else (lambda name, default=0: getattr(usage, name, default))
+        row = tuple(int(getter(column, 0) or 0) for column in USAGE_COLUMNS)
+        with self._lock:
+            self._models.append(model)
+            self._timestamps.append(time.time() if timestamp is None else timestamp)
+            self._tokens.append(row)
 
-        return usage_dict
+    def record_response(self, response: Any):
+        """レスポンス（Message / ResponseRecord）の使用量を記録"""
+        self.record(getattr(response, "model", None), getattr(response, "usage", None))
 
-    @staticmethod
-    def format_response(response: Message) -> Dict[str, Any]:
-        """レスポンスを整形（JSON serializable）"""
-        # usage オブジェクトを安全に変換
-        usage_obj = getattr(response, "usage", None)
-        usage_dict = ResponseProcessor._serialize_usage(usage_obj)
+    @classmethod
+    def set_resolver(cls, resolver: Optional[Callable[[], Optional["UsageLog"]]]):
+        """呼び出し元セッションの記録を返す関数の登録（UI層から）"""
+        cls._resolver = resolver
+
+    @classmethod
+    def current(cls) -> Optional["UsageLog"]:
+        """呼び出し元セッションの記録（未登録・セッション外ではNone）"""
+        if cls._resolver is None:
+            return None
+        try:
+            return cls._resolver()
+        except Exception as e:
+            logger.debug(f"UsageLog resolver failed: {e}")
+            return None
+
+    @classmethod
+    def record_current(cls, response: Any):
+        """呼び出し元セッションの記録へレスポンスの使用量を記録"""
+        log = cls.current()
+        if log is not None:
+            log.record_response(response)
+
+    def extend(self, records: List[Dict[str, Any]]):
+        """辞書のリスト（model, timestamp, USAGE_COLUMNS）から記録"""
+        for item in records:
+            self.record(item.get("model"), item, item.get("timestamp"))
+
+    def load_jsonl(self, filepath: Union[str, Path]) -> int:
+        """JSONL形式の使用量記録を読み込み、読み込んだ件数を返す"""
+        count = 0
+        with open(filepath, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    self.record(item.get("model"), item, item.get("timestamp"))
+                    count += 1
+        return count
+
+    def to_arrays(self) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """(models, timestamps[n], tokens[n, 4]) のスナップショット"""
+        with self._lock:
+            models = list(self._models)
+            timestamps = np.fromiter(self._timestamps, dtype=np.float64, count=len(self._timestamps))
+            tokens = np.array(self._tokens, dtype=np.float64).reshape(-1, len(USAGE_COLUMNS))
+        return models, timestamps, tokens
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._timestamps.clear()
+            self._tokens.clear()
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+
+
+class CostSimulator:
+    """全モデル一括のコスト試算（NumPy行列演算）
+
+    料金行列 P[モデル, 4]（USAGE_COLUMNS順・1Kトークンあたりのドル）と使用量行列 U[リクエスト, 4]
+    の積 U @ P.T で、記録済みの全リクエストを全モデルの料金で一度に再計算する。
+    キャッシュ読み書きの単価は model_pricing に cache_read / cache_write があればそれを使い、
+    なければ入力単価の cost.cache_read_multiplier / cost.cache_write_multiplier 倍とする。
+    """
+
+    def __init__(self, pricing: Dict[str, Dict[str, float]] = None):
+        if pricing is None:
+            pricing = config.get("model_pricing", {})
+        read_multiplier = config.get("cost.cache_read_multiplier", 0.1)
+        write_multiplier = config.get("cost.cache_write_multiplier", 1.25)
+
+        self.models: List[str] = list(pricing.keys())
+        self.model_index: Dict[str, int] = {model: i for i, model in enumerate(self.models)}
+        self.prices = np.array([
+            [
+                prices["input"],
+                prices["output"],
+                prices.get("cache_read", prices["input"] * read_multiplier),
+                prices.get("cache_write", prices["input"] * write_multiplier),
+            ]
+            for prices in pricing.values()
+        ], dtype=np.float64).reshape(-1, len(USAGE_COLUMNS))
+
+    @staticmethod
+    def usage_matrix(tokens: Any) -> np.ndarray:
+        """使用量行列への変換（列が2つの場合は入力・出力のみとみなす）"""
+        matrix = np.asarray(tokens, dtype=np.float64)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
+        if matrix.shape[1] < len(USAGE_COLUMNS):
+            matrix = np.pad(matrix, ((0, 0), (0, len(USAGE_COLUMNS) - matrix.shape[1])))
+        return matrix
+
+    def cost_matrix(self, tokens: Any) -> np.ndarray:
+        """リクエスト×モデルのコスト行列 [n, モデル数]"""
+        return self.usage_matrix(tokens) @ self.prices.T / 1000
+
+    def compare(self, tokens: Any, models: List[str] = None, timestamps: np.ndarray = None,
+                days: int = 30) -> Dict[str, Any]:
+        """全モデルでのWhat-if比較
+
+        models（リクエストごとの実際のモデル）があれば実績コストと各モデルとの差額、
+        timestamps があれば記録期間のリクエスト頻度から days 日あたりの推定コストを付ける。
+        """
+        costs = self.cost_matrix(tokens)
+        totals = costs.sum(axis=0)
+        n_requests = costs.shape[0]
+
+        result = {
+            "models"     : self.models,
+            "requests"   : n_requests,
+            "totals"     : totals,
+            "per_request": totals / n_requests if n_requests else np.zeros_like(totals),
+            "actual"     : None,
+            "projection" : None,
+        }
+
+        if models is not None and n_requests:
+            index = np.array([self.model_index.get(model, -1) for model in models])
+            known = index >= 0
+            result["actual"] = float(costs[np.nonzero(known)[0], index[known]].sum())
+
+        if timestamps is not None and n_requests:
+            span_days = max((float(np.max(timestamps)) - float(np.min(timestamps))) / 86400, 1 / 24)
+            result["projection"] = totals / span_days * days
+
+        return result
+
+    def compare_log(self, log: "UsageLog", days: int = 30) -> Dict[str, Any]:
+        """UsageLog（セッションの記録）の全体を比較"""
+        models, timestamps, tokens = log.to_arrays()
+        return self.compare(tokens, models=models, timestamps=timestamps, days=days)
+
+
+# ==================================================
+# レスポンス処理
+# ==================================================
+class ResponseRecord:
+    """セッション保存用の軽量レスポンス（SDKのMessageオブジェクトの代わりに保持）
+
+    表示に必要なテキスト・使用量（キャッシュの読み込み・書き込みを含む）・モデル・停止理由・
+    所要時間のみを持つ。Raw payload はspill時のみディスクへ書き出し、必要になったら load_raw() で読み戻す。
+    """
+
+    __slots__ = ("id", "model", "role", "texts", "stop_reason",
+                 "input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens",
+                 "elapsed", "created_at", "raw_path")
+
+    def __init__(self, id: str = None, model: str = None, role: str = "assistant",
+                 texts: Tuple[str, ...] = (), stop_reason: str = None,
+                 input_tokens: int = 0, output_tokens: int = 0,
+                 elapsed: Optional[float] = None, created_at: str = None, raw_path: str = None,
+                 cache_read_input_tokens: int = 0, cache_creation_input_tokens: int = 0):
+        self.id = id
+        self.model = model
+        self.role = role
+        self.texts = tuple(texts)
+        self.stop_reason = stop_reason
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cache_read_input_tokens = cache_read_input_tokens
+        self.cache_creation_input_tokens = cache_creation_input_tokens
+        self.elapsed = elapsed
+        self.created_at = created_at or datetime.now().isoformat()
+        self.raw_path = raw_path
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.texts)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    @property
+    def usage(self) -> Dict[str, int]:
+        return {
+            "input_tokens"               : self.input_tokens,
+            "output_tokens"              : self.output_tokens,
+            "cache_read_input_tokens"    : self.cache_read_input_tokens,
+            "cache_creation_input_tokens": self.cache_creation_input_tokens,
+            "total_tokens"               : self.total_tokens,
+        }
+
+    def __setstate__(self, state):
+        # キャッシュ使用量の追加前にpickleされたレコード（ディスクキャッシュ）は 0 として読み込む
+        self.cache_read_input_tokens = 0
+        self.cache_creation_input_tokens = 0
+        if isinstance(state, tuple):
+            state = state[1]
+        for name, value in (state or {}).items():
+            setattr(self, name, value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id"         : self.id,
+            "model"      : self.model,
+            "role"       : self.role,
+            "text"       : list(self.texts),
+            "usage"      : self.usage,
+            "stop_reason": self.stop_reason,
+            "elapsed"    : self.elapsed,
+            "created_at" : self.created_at,
+        }
+
+    def load_raw(self) -> Optional[Dict[str, Any]]:
+        """spill済みのRaw payloadを読み込む（未保存の場合はNone）"""
+        if not self.raw_path:
+            return None
+        return load_json_file(self.raw_path)
+
+    def __repr__(self) -> str:
+        return (f"ResponseRecord(id={self.id!r}, model={self.model!r}, "
+                f"stop_reason={self.stop_reason!r}, tokens={self.total_tokens})")
+
+
+class ResponseProcessor:
+    """Anthropic API レスポンスの処理"""
+
+    @staticmethod
+    def extract_text(response: Message) -> List[str]:
+        """レスポンスからテキストを抽出"""
+        if isinstance(response, ResponseRecord):
+            return list(response.texts)
+
+        texts = []
+
+        if hasattr(response, 'content'):
+            for content in response.content:
+                if hasattr(content, 'type') and content.type == "text":
+                    if hasattr(content, 'text'):
+                        texts.append(content.text)
+
+        return texts
+
+    @staticmethod
+    def _serialize_usage(usage_obj) -> Dict[str, Any]:
+        """ResponseUsageオブジェクトを辞書に変換"""
+        if usage_obj is None:
+            return {}
+
+        # Pydantic モデルの場合
+        if hasattr(usage_obj, 'model_dump'):
+            try:
+                return usage_obj.model_dump()
+            except Exception:
+                pass
+
+        # dict() メソッドがある場合
+        if hasattr(usage_obj, 'dict'):
+            try:
+                return usage_obj.dict()
+            except Exception:
+                pass
+
+        # 手動で属性を抽出
+        usage_dict = {}
+        for attr in ['prompt_tokens', 'completion_tokens', 'total_tokens']:
+            if hasattr(usage_obj, attr):
+                usage_dict[attr] = getattr(usage_obj, attr)
+
+        return usage_dict
+
+    @staticmethod
+    def to_record(response: Message, elapsed: Optional[float] = None,
+                  spill: Optional[bool] = None) -> ResponseRecord:
+        """Messageから軽量レコードを作成
+
+        spill=True（未指定時は config の responses.spill_raw）の場合は Raw payload を
+        paths.cache_dir/responses に書き出し、レコードにはそのパスのみを保持する。
+        """
+        if isinstance(response, ResponseRecord):
+            return response
+
+        usage = getattr(response, "usage", None)
+        record = ResponseRecord(
+            id=getattr(response, "id", None),
+            model=getattr(response, "model", None),
+            role=getattr(response, "role", None) or "assistant",
+            texts=ResponseProcessor.extract_text(response),
+            stop_reason=getattr(response, "stop_reason", None),
+            input_tokens=getattr(usage, "input_tokens", 0) or 0,
+            output_tokens=getattr(usage, "output_tokens", 0) or 0,
+            cache_read_input_tokens=getattr(usage, "cache_read_input_tokens", 0) or 0,
+            cache_creation_input_tokens=getattr(usage, "cache_creation_input_tokens", 0) or 0,
+            elapsed=elapsed,
+        )
+
+        if spill is None:
+            spill = config.get("responses.spill_raw", False) is True
+        if spill and hasattr(response, "model_dump"):
+            try:
+                spill_dir = Path(config.get("paths.cache_dir", "cache")) / "responses"
+                spill_dir.mkdir(parents=True, exist_ok=True)
+                filename = sanitize_key(record.id or datetime.now().strftime("%Y%m%d_%H%M%S_%f"))
+                filepath = spill_dir / f"{filename}.json"
+                if save_json_file(response.model_dump(), str(filepath)):
+                    record.raw_path = str(filepath)
+            except Exception as e:
+                logger.warning(f"Raw payload spill failed: {e}")
+
+        return record
+
+    @staticmethod
+    def format_response(response: Message) -> Dict[str, Any]:
+        """レスポンスを整形（JSON serializable）"""
+        if isinstance(response, ResponseRecord):
+            return response.to_dict()
+
+        # usage オブジェクトを安全に変換
+        usage_obj = getattr(response, "usage", None)
+        usage_dict = ResponseProcessor._serialize_usage(usage_obj)
 
         return {
             "id"        : getattr(response, "id", None),
@@ -721,7 +2177,9 @@ class AnthropicClient:
             
         params.update(kwargs)
 
-        return self.client.messages.create(**params)
+        response = self.client.messages.create(**params)
+        UsageLog.record_current(response)
+        return response
 
     @error_handler
     @timer
@@ -756,7 +2214,9 @@ class AnthropicClient:
             
         params.update(kwargs)
 
-        return self.client.messages.create(**params)
+        response = self.client.messages.create(**params)
+        UsageLog.record_current(response)
+        return response
 
     @error_handler
     @timer
@@ -791,6 +2251,1827 @@ class AnthropicClient:
         return self.client.messages.create(**params)
 
 
+# ==================================================
+# 画像処理
+# ==================================================
+class Base64Payload:
+    """ファイル・バイト列のBase64ペイロード生成（画像・音声共通）
+
+    ファイルは mmap で参照し、3の倍数バイトのチャンク単位でエンコードする。
+    出力先はbase64後のサイズ（算出値）で確保した1つのバッファのみで、
+    ファイル全体の読み込みや中間のbase64バイト列を持たないため、ピークメモリを抑えられる。
+    """
+
+    # 3の倍数にするとチャンク境界でパディングが入らず、連結結果が一括エンコードと一致する
+    CHUNK_BYTES = 3 * 256 * 1024
+
+    @staticmethod
+    def encoded_size(num_bytes: int) -> int:
+        """base64エンコード後のバイト数（パディング込み）"""
+        return 4 * ((num_bytes + 2) // 3)
+
+    @classmethod
+    def iter_buffer(cls, data, chunk_bytes: int = None) -> Iterator[bytes]:
+        """バッファ（bytes・memoryview・mmap）をチャンク単位でBase64化して順に返す"""
+        chunk_bytes = chunk_bytes or cls.CHUNK_BYTES
+        if chunk_bytes % 3:
+            raise ValueError("chunk_bytes must be a multiple of 3")
+        with memoryview(data) as view:
+            for start in range(0, len(view), chunk_bytes):
+                yield binascii.b2a_base64(view[start:start + chunk_bytes], newline=False)
+
+    @classmethod
+    def iter_file(cls, path: Union[str, Path], chunk_bytes: int = None) -> Iterator[bytes]:
+        """ファイルを mmap で参照し、チャンク単位のBase64を順に返す（ストリーミング送信・書き出し用）"""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield from cls.iter_buffer(mapped, chunk_bytes)
+
+    @classmethod
+    def _join(cls, chunks: Iterator[bytes], num_bytes: int) -> str:
+        """算出サイズで確保したバッファへチャンクを詰め、ASCII文字列として返す"""
+        out = bytearray(cls.encoded_size(num_bytes))
+        position = 0
+        for chunk in chunks:
+            out[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        return out.decode('ascii')
+
+    @classmethod
+    def encode_bytes(cls, data) -> str:
+        """バイト列をBase64文字列化"""
+        return cls._join(cls.iter_buffer(data), len(data))
+
+    @classmethod
+    def encode_file(cls, path: Union[str, Path]) -> str:
+        """ファイルをBase64文字列化（ファイル全体をメモリへ読み込まない）"""
+        return cls._join(cls.iter_file(path), os.path.getsize(path))
+
+
+class ImageEncoder:
+    """画像のBase64エンコード（Anthropic APIのサイズ制限対応）
+
+    base64後のサイズはバイト長から算出し（4 * ceil(n / 3)）、エンコード結果の文字列化は
+    最終結果の1回のみ行う。制限超過時は品質→縮小率の順に二分探索し、少ないエンコード回数で
+    制限をわずかに下回る設定を求める。
+    """
+
+    MEDIA_TYPES = {
+        '.jpg' : 'image/jpeg',
+        '.jpeg': 'image/jpeg',
+        '.png' : 'image/png',
+        '.webp': 'image/webp',
+        '.gif' : 'image/gif',
+    }
+    SAVE_FORMATS = {'image/jpeg': 'JPEG', 'image/png': 'PNG', 'image/webp': 'WebP'}
+
+    @staticmethod
+    def base64_size(num_bytes: int) -> int:
+        """base64エンコード後のバイト数（パディング込み）"""
+        return Base64Payload.encoded_size(num_bytes)
+
+    @staticmethod
+    def max_raw_bytes(max_base64_bytes: int) -> int:
+        """base64後に max_base64_bytes 以下となる元データの最大バイト数"""
+        return (max_base64_bytes // 4) * 3
+
+    @classmethod
+    def media_type_for(cls, path: Union[str, Path]) -> str:
+        """拡張子からメディアタイプを判定（不明な場合はJPEG）"""
+        return cls.MEDIA_TYPES.get(Path(path).suffix.lower(), 'image/jpeg')
+
+    @classmethod
+    def output_format(cls, path: Union[str, Path]) -> Tuple[str, str]:
+        """再エンコード時の保存形式とメディアタイプ（PNG/WebPは透明度保持のため維持、他はJPEG）"""
+        media_type = cls.media_type_for(path)
+        if media_type in ('image/png', 'image/webp'):
+            return cls.SAVE_FORMATS[media_type], media_type
+        return 'JPEG', 'image/jpeg'
+
+    # 内容の種類・透明度ごとの候補形式（最小サイズのものを採用）
+    FORMAT_CANDIDATES = {
+        ('photo', False)  : ('JPEG', 'WebP'),
+        ('photo', True)   : ('WebP', 'PNG'),
+        ('graphic', False): ('PNG', 'WebP', 'JPEG'),
+        ('graphic', True) : ('PNG', 'WebP'),
+    }
+    METADATA_KEYS = ('exif', 'icc_profile', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop')
+
+    @staticmethod
+    def prepare_mode(img: Image.Image, save_format: str) -> Image.Image:
+        """保存形式に合わせたモード変換（JPEGは透明部分を白背景で合成してRGB化）"""
+        if save_format == 'WebP' and img.mode not in ('RGB', 'RGBA'):
+            return img.convert('RGBA' if ImageEncoder.has_alpha(img) else 'RGB')
+        if save_format != 'JPEG':
+            return img
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        if img.mode in ('RGBA', 'LA'):
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            return background
+        if img.mode != 'RGB':
+            return img.convert('RGB')
+        return img
+
+    @staticmethod
+    def encode_bytes(img: Image.Image, save_format: str, quality: Optional[int] = None,
+                     lossless: bool = False) -> bytes:
+        """指定形式・品質でのエンコード結果（バイト列）"""
+        buffer = io.BytesIO()
+        if save_format == 'PNG':
+            img.save(buffer, format=save_format, optimize=True)
+        elif save_format == 'WebP' and lossless:
+            img.save(buffer, format=save_format, lossless=True, method=4)
+        else:
+            img.save(buffer, format=save_format, quality=quality or 90, optimize=True)
+        return buffer.getvalue()
+
+    # --------------------------------------------------
+    # 送信前の最適化（向き補正・メタデータ除去・最小形式の選択）
+    # --------------------------------------------------
+    @staticmethod
+    def optimize_enabled() -> bool:
+        return config.get("images.optimize", True) is True
+
+    @classmethod
+    def has_metadata(cls, img: Image.Image) -> bool:
+        """EXIF・ICCプロファイル等のメタデータを含むか"""
+        return any(img.info.get(key) for key in cls.METADATA_KEYS)
+
+    @staticmethod
+    def has_alpha(img: Image.Image) -> bool:
+        """実際に透明な画素を含むか（全画素不透明のアルファチャンネルは透明扱いしない）"""
+        if img.mode in ('RGBA', 'LA', 'PA'):
+            return img.getchannel('A').getextrema()[0] < 255
+        return img.mode == 'P' and 'transparency' in img.info
+
+    @staticmethod
+    def content_kind(img: Image.Image) -> str:
+        """写真（'photo'）かスクリーンショット・図版（'graphic'）かを色数で判定"""
+        scale = min(1.0, 256 / max(img.size))
+        sample = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))),
+                            Image.Resampling.NEAREST)  # 補間で中間色を作らない
+        max_colors = min(config.get("images.graphic_max_colors", 1024), sample.width * sample.height // 4)
+        colors = sample.convert('RGB').getcolors(maxcolors=max(max_colors, 1))
+        return 'graphic' if colors is not None else 'photo'
+
+    @classmethod
+    def normalize(cls, img: Image.Image) -> Image.Image:
+        """EXIFの向きを適用し、メタデータを除去（透明色の指定のみ残す）"""
+        img = ImageOps.exif_transpose(img)
+        img.info = {key: value for key, value in img.info.items() if key == 'transparency'}
+        if img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            img = img.convert('RGBA' if 'A' in img.mode else 'RGB')
+        return img
+
+    @classmethod
+    def choose_format(cls, img: Image.Image, quality: int = None) -> Dict[str, Any]:
+        """内容に応じた候補形式でエンコードし、最小のものを選ぶ
+
+        Returns:
+            {'data': bytes, 'format': str, 'media_type': str, 'kind': str, 'quality': int|None, 'encodes': int}
+        """
+        if quality is None:
+            quality = config.get("images.optimize_quality", 85)
+        alpha = cls.has_alpha(img)
+        kind = cls.content_kind(img)
+        best = None
+        candidates = cls.FORMAT_CANDIDATES[(kind, alpha)]
+        for save_format in candidates:
+            lossless = save_format == 'WebP' and kind == 'graphic'
+            prepared = cls.prepare_mode(img, save_format)
+            data = cls.encode_bytes(prepared, save_format, quality, lossless=lossless)
+            if best is None or len(data) < len(best['data']):
+                media_type = next(m for m, f in cls.SAVE_FORMATS.items() if f == save_format)
+                best = {'data': data, 'format': save_format, 'media_type': media_type, 'kind': kind,
+                        'quality': None if save_format == 'PNG' or lossless else quality}
+        best['encodes'] = len(candidates)
+        return best
+
+    @classmethod
+    def fit_within(cls, img: Image.Image, save_format: str, max_base64_bytes: int,
+                   max_quality: int = None, min_quality: int = None,
+                   min_side: int = None) -> Optional[Dict[str, Any]]:
+        """base64後のサイズが制限以下になる最良の設定でエンコード
+
+        1. 品質（JPEG/WebP）を [min_quality, max_quality] で二分探索
+        2. 最低品質でも超過する場合は縮小率を二分探索（元画像から1回だけリサイズ）
+
+        Returns:
+            {'data': bytes, 'size': (w, h), 'quality': int|None, 'scale': float, 'encodes': int}
+            最小サイズまで縮小しても収まらない場合はNone
+        """
+        if max_quality is None:
+            max_quality = config.get("images.max_quality", 90)
+        if min_quality is None:
+            min_quality = config.get("images.min_quality", 40)
+        if min_side is None:
+            min_side = config.get("images.min_side", 100)
+        limit = cls.max_raw_bytes(max_base64_bytes)
+        lossy = save_format != 'PNG'
+        encodes = 0
+
+        def encode(image, quality):
+            nonlocal encodes
+            encodes += 1
+            return cls.encode_bytes(image, save_format, quality)
+
+        def result(data, image, quality, scale):
+            return {'data': data, 'size': image.size, 'quality': quality if lossy else None,
+                    'scale': scale, 'encodes': encodes}
+
+        # 1. 品質の二分探索
+        quality = max_quality if lossy else None
+        data = encode(img, quality)
+        if len(data) <= limit:
+            return result(data, img, quality, 1.0)
+
+        if lossy:
+            low_data = encode(img, min_quality)
+            if len(low_data) <= limit:
+                best, best_quality = low_data, min_quality
+                low, high = min_quality, max_quality      # low は収まる・high は超過
+                while high - low > 2:
+                    mid = (low + high) // 2
+                    data = encode(img, mid)
+                    if len(data) <= limit:
+                        best, best_quality, low = data, mid, mid
+                    else:
+                        high = mid
+                return result(best, img, best_quality, 1.0)
+            quality, data = min_quality, low_data
+
+        # 2. 縮小率の二分探索（バイト数は面積にほぼ比例するため、推定値から探索を始める）
+        min_scale = min_side / min(img.size)
+        if min_scale >= 1.0:
+            return None
+        low, high = min_scale, 1.0                        # high は超過
+        estimate = (limit / len(data)) ** 0.5 * 0.95
+        best = None
+        for _ in range(config.get("images.max_scale_steps", 6)):
+            scale = estimate if estimate is not None and low < estimate < high else (low + high) / 2
+            estimate = None
+            resized = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))),
+                                 Image.Resampling.LANCZOS)
+            data = encode(resized, quality)
+            if len(data) <= limit:
+                best = (data, resized, scale)
+                low = scale
+                if len(data) >= limit * 0.9:
+                    break
+            else:
+                high = scale
+            if high - low < 0.01:
+                break
+
+        if best is None:
+            # 探索した縮小率ではいずれも超過したため、最小サイズで確認
+            resized = img.resize((max(1, int(img.width * min_scale)), max(1, int(img.height * min_scale))),
+                                 Image.Resampling.LANCZOS)
+            data = encode(resized, quality)
+            if len(data) > limit:
+                return None
+            best = (data, resized, min_scale)
+        data, resized, scale = best
+        return result(data, resized, quality, scale)
+
+    @classmethod
+    def resize_and_encode(cls, path: Union[str, Path], max_base64_bytes: int,
+                          target_size: Optional[Tuple[int, int]] = None) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+        """画像を制限内に収めてBase64エンコード（target_size 指定時は先にその大きさへ縮小）
+
+        Returns:
+            (base64文字列, メディアタイプ, 統計情報) 収まらない場合は ("", メディアタイプ, None)
+        """
+        save_format, media_type = cls.output_format(path)
+        optimize = cls.optimize_enabled()
+        with Image.open(path) as img:
+            original_size = img.size
+            original_media_type = cls.media_type_for(path)
+            keep_original = (target_size is None and not cls.has_metadata(img)
+                             and original_media_type in cls.SAVE_FORMATS)
+            if target_size:
+                cls.draft_for(img, target_size)
+            img.load()
+            if optimize:
+                img = cls.normalize(img)
+                if target_size and target_size != img.size:
+                    # EXIFの向き補正で縦横が入れ替わった場合に合わせる
+                    if (img.width > img.height) != (target_size[0] > target_size[1]):
+                        target_size = (target_size[1], target_size[0])
+                    if img.mode == 'P':
+                        img = img.convert('RGBA' if cls.has_alpha(img) else 'RGB')
+                    img = img.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+                choice = cls.choose_format(img)
+                save_format, media_type = choice['format'], choice['media_type']
+                limit = cls.max_raw_bytes(max_base64_bytes)
+                file_size = os.path.getsize(path)
+                if keep_original and file_size <= min(len(choice['data']), limit):
+                    # メタデータのない元ファイルの方が小さければそのまま送る
+                    return Base64Payload.encode_file(path), original_media_type, {
+                        'encodes': choice['encodes'], 'size': original_size, 'quality': None, 'scale': 1.0,
+                        'format': 'original', 'kind': choice['kind'],
+                        'original_size': original_size, 'base64_bytes': cls.base64_size(file_size)}
+                if len(choice['data']) <= limit:
+                    fitted = {'data': choice['data'], 'size': img.size, 'quality': choice['quality'],
+                              'scale': 1.0, 'encodes': choice['encodes']}
+                else:
+                    fitted = cls.fit_within(cls.prepare_mode(img, save_format), save_format, max_base64_bytes)
+                    if fitted is not None:
+                        fitted['encodes'] += choice['encodes']
+                if fitted is not None:
+                    fitted['format'], fitted['kind'] = save_format, choice['kind']
+            else:
+                prepared = cls.prepare_mode(img, save_format)
+                if target_size and target_size != prepared.size:
+                    prepared = prepared.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+                fitted = cls.fit_within(prepared, save_format, max_base64_bytes)
+        if fitted is None:
+            return "", media_type, None
+        data = fitted.pop('data')
+        fitted['original_size'] = original_size
+        fitted['base64_bytes'] = cls.base64_size(len(data))
+        return Base64Payload.encode_bytes(data), media_type, fitted
+
+    @classmethod
+    def encode_image(cls, img: Image.Image, max_base64_bytes: int,
+                     target_size: Optional[Tuple[int, int]] = None) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+        """メモリ上の画像（抽出フレーム・タイル画像など）を最小形式で制限内にBase64エンコード
+
+        Returns:
+            (base64文字列, メディアタイプ, 統計情報) 収まらない場合は ("", メディアタイプ, None)
+        """
+        if target_size and target_size != img.size:
+            if img.mode == 'P':
+                img = img.convert('RGBA' if cls.has_alpha(img) else 'RGB')
+            img = img.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        choice = cls.choose_format(img)
+        if len(choice['data']) <= cls.max_raw_bytes(max_base64_bytes):
+            data = choice['data']
+            stats = {'size': img.size, 'quality': choice['quality'], 'scale': 1.0, 'encodes': choice['encodes']}
+        else:
+            stats = cls.fit_within(cls.prepare_mode(img, choice['format']), choice['format'], max_base64_bytes)
+            if stats is None:
+                return "", choice['media_type'], None
+            data = stats.pop('data')
+            stats['encodes'] += choice['encodes']
+        stats.update(format=choice['format'], kind=choice['kind'], base64_bytes=cls.base64_size(len(data)))
+        return Base64Payload.encode_bytes(data), choice['media_type'], stats
+
+    @staticmethod
+    def image_block(data: str, media_type: str) -> Dict[str, Any]:
+        """Base64画像のコンテンツブロック"""
+        return {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": data}}
+
+    @staticmethod
+    def draft_for(img: Image.Image, target_size: Tuple[int, int]) -> bool:
+        """JPEGを縮小デコード（1/2・1/4・1/8）するよう設定（読み込み前に呼ぶ）
+
+        縮小後も target_size 以上の解像度でデコードされるため、最終的な高品質リサイズは呼び出し側で行う。
+        DCT段階で縮小するため、大きな写真ではデコード時間・メモリが大幅に減る。
+        """
+        if img.format != 'JPEG' or config.get("images.draft_decode", True) is not True:
+            return False
+        if target_size[0] * 2 > img.width and target_size[1] * 2 > img.height:
+            return False
+        img.draft(img.mode, target_size)
+        return True
+
+    @classmethod
+    def encode_file(cls, path: Union[str, Path], max_base64_bytes: int,
+                    max_long_edge: Optional[int] = None) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+        """画像ファイルのBase64エンコード
+
+        max_long_edge 指定時はモデルの実効解像度を超える画像を先に縮小する。
+        images.optimize が有効なら向き補正・メタデータ除去・最小形式の選択を行う。
+        いずれも不要かつ制限内ならファイルをそのままエンコードする。
+        """
+        target_size = None
+        if max_long_edge:
+            target_size = cls.target_size(cls.image_size(path), max_long_edge)
+        file_size = os.path.getsize(path)
+        if (target_size is not None or cls.optimize_enabled()
+                or cls.base64_size(file_size) > max_base64_bytes):
+            return cls.resize_and_encode(path, max_base64_bytes, target_size)
+        encoded = Base64Payload.encode_file(path)
+        return encoded, cls.media_type_for(path), {'encodes': 0, 'base64_bytes': len(encoded)}
+
+    # --------------------------------------------------
+    # ビジョン入力のトークン見積もり
+    # --------------------------------------------------
+    @staticmethod
+    def default_max_long_edge() -> Optional[int]:
+        """自動縮小の長辺上限（vision.auto_downscale が無効ならNone）"""
+        if config.get("vision.auto_downscale", True) is not True:
+            return None
+        return config.get("vision.max_long_edge", 1568)
+
+    @staticmethod
+    def image_size(path: Union[str, Path]) -> Tuple[int, int]:
+        """画像の幅・高さ（ヘッダーのみ読み込み）"""
+        with Image.open(path) as img:
+            return img.size
+
+    @staticmethod
+    def target_size(size: Tuple[int, int], max_long_edge: int = None,
+                    max_pixels: int = None) -> Optional[Tuple[int, int]]:
+        """モデルの実効最大解像度に収まる縮小後サイズ（縦横比維持・縮小不要ならNone）"""
+        if max_long_edge is None:
+            max_long_edge = config.get("vision.max_long_edge", 1568)
+        if max_pixels is None:
+            max_pixels = config.get("vision.max_pixels", 1_150_000)
+        width, height = size
+        scale = min(1.0, max_long_edge / max(width, height), (max_pixels / (width * height)) ** 0.5)
+        if scale >= 1.0:
+            return None
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    @classmethod
+    def estimate_tokens(cls, size: Tuple[int, int]) -> int:
+        """画像入力のトークン数見積もり（実効解像度へ縮小後の 幅×高さ / 750）"""
+        width, height = cls.target_size(size) or size
+        divisor = config.get("vision.pixels_per_token", 750)
+        return -(-(width * height) // divisor)
+
+    @classmethod
+    def preflight(cls, path: Union[str, Path], model: str = None,
+                  max_long_edge: Optional[int] = None) -> Dict[str, Any]:
+        """送信前の見積もり（元サイズ・送信サイズ・推定トークン数・推定入力コスト）"""
+        size = cls.image_size(path)
+        target = cls.target_size(size, max_long_edge) if max_long_edge else None
+        tokens = cls.estimate_tokens(size)
+        return {
+            'original_size' : size,
+            'send_size'     : target or size,
+            'downscale'     : target is not None,
+            'file_bytes'    : os.path.getsize(path),
+            'tokens'        : tokens,
+            'cost_usd'      : TokenManager.estimate_cost(tokens, 0, model),
+        }
+
+
+class AnimationSampler:
+    """アニメーションGIF/WebPの代表フレーム抽出
+
+    モデルには先頭フレームしか意味を持たないため、ファイルをそのまま送らず、
+    直前の代表フレームとの差分（縮小グレースケールの平均画素差）が大きいフレームを
+    場面の切り替わりとして選び、1枚にタイル状に並べるか複数の画像ブロックとして送る。
+    """
+
+    EXTENSIONS = ('.gif', '.webp')
+
+    @staticmethod
+    def enabled() -> bool:
+        return config.get("animation.enabled", True) is True
+
+    @classmethod
+    def is_animated(cls, path: Union[str, Path]) -> bool:
+        """複数フレームを持つGIF/WebPか（ヘッダーのみ読み込み）"""
+        if Path(path).suffix.lower() not in cls.EXTENSIONS:
+            return False
+        with Image.open(path) as img:
+            return getattr(img, 'n_frames', 1) > 1
+
+    @classmethod
+    def applies_to(cls, path: Union[str, Path]) -> bool:
+        return cls.enabled() and cls.is_animated(path)
+
+    @staticmethod
+    def _signature(frame: Image.Image, sample_size: int) -> np.ndarray:
+        """差分計算用の縮小グレースケール画像"""
+        small = frame.convert('L').resize((sample_size, sample_size), Image.Resampling.BILINEAR)
+        return np.asarray(small, dtype=np.float32)
+
+    @classmethod
+    def select_frames(cls, img: Image.Image, max_frames: int = None, min_change: float = None,
+                      sample_size: int = None) -> List[int]:
+        """代表フレームのインデックス（時系列順・先頭フレームは常に含む）
+
+        直前の代表フレームとの平均画素差が min_change を超えたフレームを候補とし、
+        候補が多い場合は差分の大きいものから max_frames - 1 個を選ぶ。
+        """
+        if max_frames is None:
+            max_frames = config.get("animation.max_frames", 4)
+        if min_change is None:
+            min_change = config.get("animation.min_change", 8.0)
+        if sample_size is None:
+            sample_size = config.get("animation.sample_size", 64)
+        total = getattr(img, 'n_frames', 1)
+        img.seek(0)
+        reference = cls._signature(img, sample_size)
+        candidates = []
+        for index in range(1, total):
+            img.seek(index)
+            signature = cls._signature(img, sample_size)
+            change = float(np.abs(signature - reference).mean())
+            if change > min_change:
+                candidates.append((change, index))
+                reference = signature
+        chosen = sorted(candidates, reverse=True)[:max(max_frames - 1, 0)]
+        return [0] + sorted(index for _, index in chosen)
+
+    @staticmethod
+    def extract(img: Image.Image, indices: List[int]) -> List[Image.Image]:
+        """指定フレームを合成済みの画像として取り出す"""
+        frames = []
+        for index in indices:
+            img.seek(index)
+            frames.append(img.convert('RGBA'))
+        return frames
+
+    @staticmethod
+    def tile(frames: List[Image.Image], columns: int = None) -> Image.Image:
+        """フレームを左上から時系列順に格子状へ並べた1枚の画像（透明部分は白背景）"""
+        if columns is None:
+            columns = math.ceil(math.sqrt(len(frames)))
+        rows = math.ceil(len(frames) / columns)
+        width, height = frames[0].size
+        sheet = Image.new('RGB', (width * columns, height * rows), (255, 255, 255))
+        for position, frame in enumerate(frames):
+            if frame.size != (width, height):
+                frame = frame.resize((width, height), Image.Resampling.LANCZOS)
+            sheet.paste(frame, ((position % columns) * width, (position // columns) * height), frame)
+        return sheet
+
+    @classmethod
+    def encode(cls, path: Union[str, Path], max_base64_bytes: int, max_long_edge: Optional[int] = None,
+               max_frames: int = None, mode: str = None) -> Tuple[List[Dict[str, str]], Optional[Dict[str, Any]]]:
+        """代表フレームを抽出してBase64化
+
+        Args:
+            mode: 'tile'（1枚に並べる）/ 'blocks'（フレームごとの画像ブロック）
+
+        Returns:
+            ([{'data', 'media_type'}, ...], 統計情報) 制限内に収まらない場合は ([], None)
+        """
+        if mode is None:
+            mode = config.get("animation.mode", "tile")
+        with Image.open(path) as img:
+            total = getattr(img, 'n_frames', 1)
+            indices = cls.select_frames(img, max_frames)
+            frames = cls.extract(img, indices)
+        if len(frames) == 1:
+            mode = 'single'
+        images = [cls.tile(frames)] if mode == 'tile' else frames
+        payloads = []
+        for image in images:
+            target_size = ImageEncoder.target_size(image.size, max_long_edge) if max_long_edge else None
+            data, media_type, _ = ImageEncoder.encode_image(image, max_base64_bytes, target_size)
+            if not data:
+                return [], None
+            payloads.append({'data': data, 'media_type': media_type})
+        return payloads, {
+            'frames'        : total,
+            'selected'      : indices,
+            'mode'          : mode,
+            'original_bytes': os.path.getsize(path),
+            'base64_bytes'  : sum(len(payload['data']) for payload in payloads),
+        }
+
+    @staticmethod
+    def content_blocks(payloads: List[Dict[str, str]], stats: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """抽出結果のコンテンツブロック（フレームの並びを説明するテキスト + 画像）"""
+        count = len(stats['selected'])
+        if stats['mode'] == 'tile':
+            note = (f"次の画像は、アニメーション（全{stats['frames']}フレーム）から抽出した{count}フレームを"
+                    f"左上から時系列順にタイル状に並べたものです。")
+        elif stats['mode'] == 'blocks':
+            note = f"次の{count}枚の画像は、アニメーション（全{stats['frames']}フレーム）から抽出したフレームを時系列順に並べたものです。"
+        else:
+            note = f"次の画像は、アニメーション（全{stats['frames']}フレーム・動きなし）の先頭フレームです。"
+        return [{"type": "text", "text": note}] + [
+            ImageEncoder.image_block(payload['data'], payload['media_type']) for payload in payloads]
+
+
+class PerceptualHash:
+    """知覚ハッシュ（dHash, 64ビット）
+
+    9x8 のグレースケールに縮小し、横方向に隣接する画素の大小関係をビット化する。
+    再圧縮・軽微な縮小・メタデータの違いではほとんど変化しないため、
+    ハミング距離が小さい画像を同じ内容とみなせる。
+    """
+
+    HASH_SIZE = 8
+
+    @classmethod
+    def dhash(cls, img: Image.Image) -> int:
+        gray = img.convert('L').resize((cls.HASH_SIZE + 1, cls.HASH_SIZE), Image.Resampling.LANCZOS)
+        pixels = np.asarray(gray, dtype=np.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path]) -> int:
+        """画像ファイルの dHash（JPEGは縮小デコード・EXIFの向きを適用・アニメーションは先頭フレーム）"""
+        with Image.open(path) as img:
+            ImageEncoder.draft_for(img, (cls.HASH_SIZE * 16, cls.HASH_SIZE * 16))
+            img.load()
+            return cls.dhash(ImageOps.exif_transpose(img))
+
+    @staticmethod
+    def distances(hashes: np.ndarray, value: int) -> np.ndarray:
+        """ハッシュ配列（uint64）の各要素と value のハミング距離"""
+        xor = np.bitwise_xor(hashes, np.uint64(value))
+        return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class ImageHashIndex:
+    """知覚ハッシュ → 内容ハッシュの索引（近似重複の検索）
+
+    ハッシュは uint64 配列で保持し、全件とのハミング距離をNumPyで一括計算する。
+    索引は DiskCache の1エントリとして永続化し、上限件数を超えた分は古いものから削除する。
+    """
+
+    KEY = "image_phash_index"
+
+    def __init__(self, disk: DiskCache, max_distance: int = None, max_entries: int = None):
+        self.disk = disk
+        self.max_distance = max_distance if max_distance is not None else config.get("images.dedup_max_distance", 2)
+        self.max_entries = max_entries or config.get("images.cache_max_entries", 500)
+        self._lock = threading.RLock()
+        self._hashes: Optional[np.ndarray] = None
+        self._digests: List[str] = []
+
+    def _load(self) -> None:
+        if self._hashes is None:
+            stored = self.disk.get(self.KEY) or {'hashes': b"", 'digests': []}
+            self._hashes = np.frombuffer(stored['hashes'], dtype=np.uint64).copy()
+            self._digests = list(stored['digests'])
+
+    def find(self, value: int) -> Optional[Tuple[str, int]]:
+        """ハミング距離が max_distance 以下で最も近い画像の (内容ハッシュ, 距離)"""
+        with self._lock:
+            self._load()
+            if not self._digests:
+                return None
+            distances = PerceptualHash.distances(self._hashes, value)
+            nearest = int(np.argmin(distances))
+            if distances[nearest] > self.max_distance:
+                return None
+            return self._digests[nearest], int(distances[nearest])
+
+    def add(self, value: int, digest: str) -> None:
+        with self._lock:
+            self._load()
+            self._hashes = np.append(self._hashes, np.uint64(value))[-self.max_entries:]
+            self._digests = (self._digests + [digest])[-self.max_entries:]
+            self.disk.set(self.KEY, {'hashes': self._hashes.tobytes(), 'digests': self._digests})
+
+    def clear(self) -> None:
+        with self._lock:
+            self._hashes = np.empty(0, dtype=np.uint64)
+            self._digests = []
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._load()
+            return len(self._digests)
+
+
+class ImagePayloadCache:
+    """前処理済み画像ペイロードのディスクキャッシュ
+
+    キーはファイル内容のハッシュと前処理の制約（最大バイト数・出力形式など）。
+    同じ画像への再質問では読み込み・リサイズ・Base64化をすべて省略する。
+    内容ハッシュは (パス, サイズ, 更新時刻) 単位でメモし、未変更ファイルの再ハッシュも省略する。
+    images.dedup_enabled が有効なら、知覚ハッシュが近い画像（再アップロード・再圧縮版）は
+    最初に処理した画像の内容ハッシュに寄せ、前処理結果を再利用する。回答の再利用
+    （images.dedup_answers）は内容ハッシュが完全に一致する画像に限る。
+    """
+
+    def __init__(self, directory: Union[str, Path] = None, max_bytes: int = None,
+                 max_entries: int = None, ttl: int = None):
+        if directory is None:
+            directory = Path(config.get("paths.cache_dir", "cache")) / "images"
+        if max_bytes is None:
+            max_bytes = int(config.get("images.cache_max_mb", 200) * 1024 * 1024)
+        self.disk = DiskCache(
+            directory,
+            max_size=max_entries or config.get("images.cache_max_entries", 500),
+            ttl=ttl or config.get("images.cache_ttl", 604800),
+            max_bytes=max_bytes,
+        )
+        self._hashes = LRUCache(max_size=1024, ttl=ttl or config.get("images.cache_ttl", 604800))
+        self._canonical = LRUCache(max_size=1024, ttl=ttl or config.get("images.cache_ttl", 604800))
+        self.phash_index = ImageHashIndex(self.disk, max_entries=max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.answer_hits = 0
+
+    def content_hash(self, path: Union[str, Path]) -> str:
+        """ファイル内容のSHA-256（未変更ファイルはメモから返す）"""
+        path = Path(path)
+        stat = path.stat()
+        stat_key = f"{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+        digest = self._hashes.get(stat_key)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+            digest = hasher.hexdigest()
+            self._hashes.set(stat_key, digest)
+        return digest
+
+    @staticmethod
+    def dedup_enabled() -> bool:
+        return config.get("images.dedup_enabled", True) is True
+
+    def canonical_hash(self, path: Union[str, Path]) -> str:
+        """キャッシュキーに使う内容ハッシュ（近似重複の画像は最初に処理した画像のもの）"""
+        digest = self.content_hash(path)
+        if not self.dedup_enabled():
+            return digest
+        canonical = self._canonical.get(digest)
+        if canonical is None:
+            try:
+                value = PerceptualHash.from_file(path)
+            except Exception as e:
+                logger.warning(f"知覚ハッシュ計算エラー: {e}")
+                return digest
+            match = self.phash_index.find(value)
+            if match is None:
+                self.phash_index.add(value, digest)
+                canonical = digest
+            else:
+                canonical = match[0]
+            self._canonical.set(digest, canonical)
+        return canonical
+
+    def remember_hash(self, path: Union[str, Path], size: int, mtime_ns: int, digest: str) -> None:
+        """計算済みの内容ハッシュを登録（画像インデックスの値を再利用し、送信時の再ハッシュを省略）"""
+        if digest:
+            self._hashes.set(f"{Path(path).resolve()}:{size}:{mtime_ns}", digest)
+
+    def is_near_duplicate(self, path: Union[str, Path]) -> bool:
+        """内容は異なるが、以前に処理した画像の近似重複として扱われるか"""
+        return self.canonical_hash(path) != self.content_hash(path)
+
+    def make_key(self, path: Union[str, Path], **constraints) -> str:
+        # 最適化時の出力形式は内容から決まるため、形式の異なる近似重複でも同じキーになる
+        constraints.setdefault("optimize", ImageEncoder.optimize_enabled())
+        if not constraints["optimize"]:
+            constraints.setdefault("format", ImageEncoder.output_format(path)[1])
+        return make_cache_key("image_payload", (self.canonical_hash(path),), constraints)
+
+    def get(self, path: Union[str, Path], **constraints) -> Optional[Dict[str, Any]]:
+        """キャッシュ済みペイロード（{'data', 'media_type', 'stats'}）/ 未登録はNone"""
+        value = self.disk.get(self.make_key(path, **constraints))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, path: Union[str, Path], data: str, media_type: str,
+            stats: Optional[Dict[str, Any]] = None, **constraints) -> None:
+        if not data:
+            return
+        self.disk.set(self.make_key(path, **constraints),
+                      {'data': data, 'media_type': media_type, 'stats': stats or {}})
+
+    def get_or_encode(self, path: Union[str, Path], max_base64_bytes: int,
+                      max_long_edge: Optional[int] = None) -> Tuple[str, str, Dict[str, Any]]:
+        """キャッシュを優先してBase64ペイロードを取得（stats['cached'] で命中を判別）"""
+        cached = self.get(path, max_base64_bytes=max_base64_bytes, max_long_edge=max_long_edge)
+        if cached is not None:
+            return cached['data'], cached['media_type'], dict(
+                cached['stats'], cached=True, near_duplicate=self.is_near_duplicate(path))
+        data, media_type, stats = ImageEncoder.encode_file(path, max_base64_bytes, max_long_edge)
+        self.set(path, data, media_type, stats, max_base64_bytes=max_base64_bytes, max_long_edge=max_long_edge)
+        return data, media_type, dict(stats or {}, cached=False)
+
+    def get_or_encode_animation(self, path: Union[str, Path], max_base64_bytes: int,
+                                max_long_edge: Optional[int] = None) -> Tuple[List[Dict[str, str]], Optional[Dict[str, Any]]]:
+        """アニメーションの代表フレーム抽出結果（キャッシュ優先・stats['cached'] で命中を判別）"""
+        key = self.make_key(
+            path, kind="animation", max_base64_bytes=max_base64_bytes, max_long_edge=max_long_edge,
+            max_frames=config.get("animation.max_frames", 4), mode=config.get("animation.mode", "tile"),
+            min_change=config.get("animation.min_change", 8.0))
+        cached = self.disk.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached['payloads'], dict(cached['stats'], cached=True)
+        self.misses += 1
+        payloads, stats = AnimationSampler.encode(path, max_base64_bytes, max_long_edge)
+        if payloads:
+            self.disk.set(key, {'payloads': payloads, 'stats': stats})
+            stats = dict(stats, cached=False)
+        return payloads, stats
+
+    # --------------------------------------------------
+    # 回答の再利用（同じ画像・同じ質問）
+    # --------------------------------------------------
+    @staticmethod
+    def answers_enabled() -> bool:
+        return (config.get("images.cache_enabled", True) is True
+                and config.get("images.dedup_answers", False) is True)
+
+    def answer_key(self, path: Union[str, Path], prompt: str, **params) -> str:
+        # 近似重複（文字だけ異なるスクリーンショット等）の回答は流用しないよう、正確な内容ハッシュを使う
+        return make_cache_key("image_answer", (self.content_hash(path), prompt), params)
+
+    def get_answer(self, path: Union[str, Path], prompt: str, **params) -> Optional[ResponseRecord]:
+        """同じ内容の画像・同じ質問・同じパラメータでの過去の回答"""
+        record = self.disk.get(self.answer_key(path, prompt, **params))
+        if record is not None:
+            self.answer_hits += 1
+        return record
+
+    def set_answer(self, path: Union[str, Path], prompt: str, response: Any, **params) -> None:
+        record = ResponseProcessor.to_record(response, spill=False)
+        if record.texts:
+            self.disk.set(self.answer_key(path, prompt, **params), record)
+
+    def clear(self):
+        self.disk.clear()
+        self._hashes.clear()
+        self._canonical.clear()
+        self.phash_index.clear()
+
+
+# 前処理済み画像キャッシュインスタンス
+image_cache = ImagePayloadCache()
+
+
+def _preprocess_image_job(path: str, max_base64_bytes: int, max_long_edge: Optional[int] = None) -> Dict[str, Any]:
+    """画像の前処理（ワーカープロセスで実行: デコード・リサイズ・エンコード）"""
+    start = time.perf_counter()
+    data, media_type, stats = ImageEncoder.encode_file(path, max_base64_bytes, max_long_edge)
+    return {'data': data, 'media_type': media_type, 'stats': stats or {},
+            'preprocess_sec': time.perf_counter() - start}
+
+
+class VisionBatchProcessor:
+    """画像フォルダの一括解析
+
+    前処理（CPU処理）はプロセスプールで並列実行し、完了した画像から順に
+    上限付きの並列数でAPIへ送信する。結果は完了順に返し、JSONLにも逐次追記する。
+    """
+
+    def __init__(self, client: "AnthropicClient", model: str = None, max_tokens: int = 1024,
+                 max_concurrency: int = None, process_workers: int = None,
+                 max_base64_bytes: int = None, use_cache: bool = None):
+        self.client = client
+        self.model = model or config.get("models.default", "claude-sonnet-4-20250514")
+        self.max_tokens = max_tokens
+        self.max_concurrency = max_concurrency or config.get("batch.max_concurrency", 4)
+        self.process_workers = process_workers or config.get("batch.process_workers") or min(4, os.cpu_count() or 1)
+        if max_base64_bytes is None:
+            max_base64_bytes = config.get("limits.max_image_size_mb", 5) * 1024 * 1024
+        self.max_base64_bytes = max_base64_bytes
+        self.max_long_edge = ImageEncoder.default_max_long_edge()
+        if use_cache is None:
+            use_cache = config.get("images.cache_enabled", True) is True
+        self.use_cache = use_cache
+
+    @staticmethod
+    def list_images(directory: Union[str, Path]) -> List[Path]:
+        """フォルダ内の対応画像（ファイル名順）"""
+        directory = Path(directory)
+        if not directory.is_dir():
+            return []
+        return sorted(p for p in directory.iterdir()
+                      if p.is_file() and p.suffix.lower() in ImageEncoder.MEDIA_TYPES)
+
+    @staticmethod
+    def default_output_path() -> Path:
+        output_dir = Path(config.get("batch.output_dir", "logs/batch"))
+        return output_dir / f"vision_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+
+    def _preprocess_executor(self):
+        """前処理用のプロセスプール（作成できない環境ではスレッドプール）
+
+        Streamlitサーバー（スレッド・ソケットを保持）を fork しないよう spawn で起動する。
+        """
+        try:
+            return ProcessPoolExecutor(max_workers=self.process_workers,
+                                       mp_context=multiprocessing.get_context("spawn"))
+        except (OSError, NotImplementedError, ValueError) as e:
+            logger.warning(f"Process pool unavailable, falling back to threads: {e}")
+            return ThreadPoolExecutor(max_workers=self.process_workers, thread_name_prefix="vision_prep")
+
+    def _request(self, path: Path, prompt: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """1枚分のAPI呼び出し（スレッドプールで実行）"""
+        messages = [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                ImageEncoder.image_block(payload['data'], payload['media_type']),
+            ],
+        }]
+        start = time.perf_counter()
+        response = self.client.create_message(messages, model=self.model, max_tokens=self.max_tokens)
+        latency = time.perf_counter() - start
+        record = ResponseProcessor.to_record(response, elapsed=latency, spill=False)
+        return self._row(path, payload, latency=latency, record=record)
+
+    def _row(self, path: Path, payload: Optional[Dict[str, Any]], latency: float = None,
+             record: "ResponseRecord" = None, error: Exception = None) -> Dict[str, Any]:
+        payload = payload or {}
+        stats = payload.get('stats', {})
+        row = {
+            'file'          : path.name,
+            'status'        : 'error' if error else 'ok',
+            'media_type'    : payload.get('media_type'),
+            'resized'       : bool(stats.get('encodes')),
+            'cached'        : bool(payload.get('cached')),
+            'preprocess_sec': round(payload.get('preprocess_sec', 0.0), 4),
+            'latency_sec'   : round(latency, 4) if latency is not None else None,
+            'input_tokens'  : record.input_tokens if record else 0,
+            'output_tokens' : record.output_tokens if record else 0,
+            'cost_usd'      : 0.0,
+            'answer'        : record.text if record else "",
+            'error'         : str(error) if error else None,
+            'timestamp'     : datetime.now().isoformat(),
+        }
+        if record:
+            row['cost_usd'] = round(TokenManager.estimate_cost(record.input_tokens, record.output_tokens,
+                                                               self.model), 6)
+        return row
+
+    def run(self, paths: List[Union[str, Path]], prompt: str,
+            output_path: Union[str, Path, None] = None) -> Iterator[Dict[str, Any]]:
+        """一括解析の実行（完了順に結果行を返す）"""
+        paths = [Path(p) for p in paths]
+        output = None
+        if output_path is not None:
+            output_path = Path(output_path)
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            output = open(output_path, "a", encoding="utf-8")
+
+        # 前処理済みペイロードの滞留を抑えるため、投入数を (プロセス数 + 並列数) までに制限
+        window = self.process_workers + self.max_concurrency
+        queue = iter(paths)
+        pending: Dict[Future, Tuple[str, Path, Optional[Dict[str, Any]]]] = {}
+        prep_pool = self._preprocess_executor()
+        api_pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="vision_api")
+
+        def submit_api(path, payload):
+            pending[api_pool.submit(self._request, path, prompt, payload)] = ('api', path, payload)
+
+        def fill():
+            while len(pending) < window:
+                path = next(queue, None)
+                if path is None:
+                    return
+                cached = None
+                if self.use_cache:
+                    try:
+                        cached = image_cache.get(path, max_base64_bytes=self.max_base64_bytes,
+                                                 max_long_edge=self.max_long_edge)
+                    except OSError:
+                        cached = None
+                if cached is not None:
+                    submit_api(path, dict(cached, cached=True, preprocess_sec=0.0))
+                else:
+                    future = prep_pool.submit(_preprocess_image_job, str(path), self.max_base64_bytes,
+                                              self.max_long_edge)
+                    pending[future] = ('prep', path, None)
+
+        try:
+            fill()
+            while pending:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, path, payload = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.warning(f"Vision batch failed for {path.name}: {e}")
+                        row = self._row(path, payload, error=e)
+                    else:
+                        if kind == 'prep':
+                            if not result['data']:
+                                row = self._row(path, result, error=ValueError("サイズ制限内に収まりません"))
+                            else:
+                                if self.use_cache:
+                                    image_cache.set(path, result['data'], result['media_type'], result['stats'],
+                                                    max_base64_bytes=self.max_base64_bytes,
+                                                    max_long_edge=self.max_long_edge)
+                                submit_api(path, result)
+                                continue
+                        else:
+                            row = result
+                    if output is not None:
+                        output.write(json.dumps(row, ensure_ascii=False) + "\n")
+                        output.flush()
+                    yield row
+                fill()
+        finally:
+            prep_pool.shutdown(wait=False, cancel_futures=True)
+            api_pool.shutdown(wait=False, cancel_futures=True)
+            if output is not None:
+                output.close()
+
+
+class VisionRequestPacker:
+    """複数画像を1回のMessagesリクエストにまとめる（ギャラリー向け）
+
+    1リクエストあたりの画像数・base64合計サイズの上限内で画像をグループ化し、
+    画像ごとの回答を画像番号付きのJSON配列で返すよう指示する。
+    応答は画像番号で分割して各画像へ戻すため、往復回数とリクエストごとのオーバーヘッドが減る。
+    """
+
+    INSTRUCTION = (
+        "これから番号付きの画像を{count}枚送ります。各画像の直前にある質問に、画像ごとに答えてください。\n"
+        "回答は次の形式のJSON配列のみで出力し、前後に説明文を付けないでください。\n"
+        '[{{"image": 1, "answer": "画像1への回答"}}, {{"image": 2, "answer": "画像2への回答"}}]'
+    )
+
+    def __init__(self, max_images: int = None, max_request_bytes: int = None,
+                 max_tokens_per_image: int = None, max_tokens_limit: int = None):
+        self.max_images = max_images or config.get("vision.pack_max_images", 20)
+        if max_request_bytes is None:
+            max_request_bytes = int(config.get("vision.pack_max_request_mb", 30) * 1024 * 1024)
+        self.max_request_bytes = max_request_bytes
+        self.max_tokens_per_image = max_tokens_per_image or config.get("vision.pack_max_tokens_per_image", 512)
+        self.max_tokens_limit = max_tokens_limit or config.get("vision.pack_max_tokens", 8192)
+
+    @staticmethod
+    def url_item(url: str, question: str = None) -> Dict[str, Any]:
+        """URL画像の項目（base64ペイロードを持たないためサイズは0とみなす）"""
+        return {'label': url, 'question': question, 'bytes': 0,
+                'block': {"type": "image", "source": {"type": "url", "url": url}}}
+
+    @staticmethod
+    def base64_item(data: str, media_type: str, question: str = None, label: str = None) -> Dict[str, Any]:
+        return {'label': label, 'question': question, 'bytes': len(data),
+                'block': ImageEncoder.image_block(data, media_type)}
+
+    def pack(self, items: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """画像数・合計サイズの上限を超えないよう入力順にグループ化（単独で上限を超える画像は1枚で送る）"""
+        groups, current, current_bytes = [], [], 0
+        for item in items:
+            if current and (len(current) >= self.max_images
+                            or current_bytes + item['bytes'] > self.max_request_bytes):
+                groups.append(current)
+                current, current_bytes = [], 0
+            current.append(item)
+            current_bytes += item['bytes']
+        if current:
+            groups.append(current)
+        return groups
+
+    def build_messages(self, group: List[Dict[str, Any]], prompt: str) -> List[MessageParam]:
+        """1グループ分のメッセージ（画像ごとの質問が未指定なら prompt を使う）"""
+        content = [{"type": "text", "text": self.INSTRUCTION.format(count=len(group))}]
+        for number, item in enumerate(group, 1):
+            content.append({"type": "text", "text": f"画像 {number} の質問: {item.get('question') or prompt}"})
+            content.append(item['block'])
+        return [{"role": "user", "content": content}]
+
+    def max_tokens_for(self, group: List[Dict[str, Any]]) -> int:
+        return min(self.max_tokens_limit, self.max_tokens_per_image * len(group))
+
+    @staticmethod
+    def split_answer(text: str, count: int) -> List[Optional[str]]:
+        """応答を画像ごとの回答に分割（JSON配列 → 「画像 N」見出しの順に解釈・欠けた画像はNone）"""
+        answers: List[Optional[str]] = [None] * count
+        start, end = text.find('['), text.rfind(']')
+        entries = None
+        if 0 <= start < end:
+            try:
+                entries = json.loads(text[start:end + 1])
+            except json.JSONDecodeError:
+                entries = None
+        if isinstance(entries, list):
+            for position, entry in enumerate(entries):
+                if isinstance(entry, dict):
+                    number, answer = entry.get('image', position + 1), entry.get('answer')
+                else:
+                    number, answer = position + 1, entry
+                if isinstance(number, int) and 1 <= number <= count and answer is not None:
+                    answers[number - 1] = str(answer).strip()
+            return answers
+
+        # JSONで返らなかった場合は「画像 N」の見出しで分割
+        parts = re.split(r'^[#*\s]*画像\s*(\d+)[^\n:：]*[:：]?', text, flags=re.MULTILINE)
+        for number, answer in zip(parts[1::2], parts[2::2]):
+            index = int(number) - 1
+            if 0 <= index < count and answers[index] is None:
+                answers[index] = answer.strip().strip('*').strip()
+        if count == 1 and answers[0] is None and text.strip():
+            answers[0] = text.strip()
+        return answers
+
+
+class URLImagePrefetcher:
+    """URL画像の事前取得・検証（API送信前に到達性・形式・サイズ・解像度を確認）
+
+    接続プール付きの共有セッションで複数URLを並列に HEAD / GET し、タイムアウトと
+    取得サイズの上限により、遅い・巨大・到達不能なURLをモデル呼び出しの前に除外する。
+    API制限内の画像はURLのまま送り、制限を超える・非対応形式の画像は縮小・最適化した
+    Base64ペイロードに変換する。結果はURL単位でキャッシュし、ETag / Last-Modified による
+    条件付きGETで再検証する。
+    サーバー側からの取得になるため、http(s) 以外のスキームと、プライベート・ループバック・
+    リンクローカル等のアドレスに解決されるホストは（リダイレクト先も含めて）取得しない。
+    """
+
+    FORMAT_MEDIA_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'GIF': 'image/gif', 'WEBP': 'image/webp'}
+
+    _session: Optional[requests.Session] = None
+    _session_lock = threading.Lock()
+
+    def __init__(self, max_workers: int = None, timeout: float = None, max_download_bytes: int = None,
+                 max_base64_bytes: int = None, convert_oversize: bool = None, cache: DiskCache = None,
+                 max_dimension: int = None, allow_private_hosts: bool = None):
+        self.max_workers = max_workers or config.get("url_images.max_workers", 8)
+        self.timeout = (config.get("url_images.connect_timeout", 5),
+                        timeout or config.get("url_images.read_timeout", 10))
+        if max_download_bytes is None:
+            max_download_bytes = int(config.get("url_images.max_download_mb", 20) * 1024 * 1024)
+        self.max_download_bytes = max_download_bytes
+        if max_base64_bytes is None:
+            max_base64_bytes = config.get("limits.max_image_size_mb", 5) * 1024 * 1024
+        self.max_base64_bytes = max_base64_bytes
+        if convert_oversize is None:
+            convert_oversize = config.get("url_images.convert_oversize", True) is True
+        self.convert_oversize = convert_oversize
+        self.max_long_edge = ImageEncoder.default_max_long_edge()
+        self.max_dimension = max_dimension or config.get("url_images.max_dimension", 8000)
+        if allow_private_hosts is None:
+            allow_private_hosts = config.get("url_images.allow_private_hosts", False) is True
+        self.allow_private_hosts = allow_private_hosts
+        self.max_redirects = config.get("url_images.max_redirects", 5)
+        if cache is None:
+            cache = DiskCache(
+                Path(config.get("paths.cache_dir", "cache")) / "url_images",
+                max_size=config.get("url_images.cache_max_entries", 200),
+                ttl=config.get("url_images.cache_ttl", 86400),
+                max_bytes=int(config.get("url_images.cache_max_mb", 100) * 1024 * 1024),
+            )
+        self.cache = cache
+
+    @classmethod
+    def session(cls) -> requests.Session:
+        """プロセス共有のHTTPセッション（接続を再利用）"""
+        with cls._session_lock:
+            if cls._session is None:
+                pool_size = config.get("url_images.max_workers", 8)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["User-Agent"] = config.get(
+                    "url_images.user_agent", "Mozilla/5.0 (compatible; anthropic-vision-demo/1.0)")
+                cls._session = session
+            return cls._session
+
+    def prefetch(self, urls: List[str]) -> Dict[str, Dict[str, Any]]:
+        """複数URLを並列に取得・検証（重複URLは1回のみ）"""
+        unique = list(dict.fromkeys(url for url in urls if url))
+        if not unique:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(unique)),
+                                thread_name_prefix="url_prefetch") as pool:
+            return dict(zip(unique, pool.map(self.fetch, unique)))
+
+    def _cache_key(self, url: str) -> str:
+        return make_cache_key("url_image", (url,), {
+            'max_base64_bytes': self.max_base64_bytes, 'max_long_edge': self.max_long_edge,
+            'max_dimension': self.max_dimension, 'convert': self.convert_oversize})
+
+    def _check_url(self, url: str):
+        """取得してよいURLか確認（http(s) 以外・内部アドレスに解決されるホストは ValueError）"""
+        parts = urlsplit(url)
+        if parts.scheme.lower() not in ("http", "https"):
+            raise ValueError(f"非対応のスキームです（{parts.scheme or 'なし'}）")
+        if not parts.hostname:
+            raise ValueError("URLにホスト名がありません")
+        if self.allow_private_hosts:
+            return
+        try:
+            infos = socket.getaddrinfo(parts.hostname, parts.port or None, proto=socket.IPPROTO_TCP)
+        except (socket.gaierror, UnicodeError) as e:
+            raise ValueError(f"ホスト名を解決できません: {e}")
+        for info in infos:
+            address = ipaddress.ip_address(info[4][0].split('%')[0])
+            if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped is not None:
+                address = address.ipv4_mapped
+            if (address.is_private or address.is_loopback or address.is_link_local or address.is_reserved
+                    or address.is_multicast or address.is_unspecified):
+                raise ValueError(f"内部ネットワークのアドレスは取得できません（{parts.hostname}）")
+
+    def _open(self, method: str, url: str, headers: Dict[str, str] = None,
+              stream: bool = False) -> requests.Response:
+        """リダイレクトを1段ずつ検証しながらリクエスト"""
+        session = self.session()
+        for _ in range(self.max_redirects + 1):
+            self._check_url(url)
+            response = session.request(method, url, headers=headers, timeout=self.timeout,
+                                       stream=stream, allow_redirects=False)
+            if not response.is_redirect:
+                return response
+            url = urljoin(response.url, response.headers['Location'])
+            response.close()
+        raise ValueError(f"リダイレクトが多すぎます（{self.max_redirects}回超）")
+
+    def fetch(self, url: str) -> Dict[str, Any]:
+        """1件のURLを取得・検証
+
+        Returns:
+            {'url', 'status': 'ok'|'error', 'mode': 'url'|'base64', 'media_type', 'size', 'bytes',
+             'data'（変換時のBase64）, 'error', 'elapsed', 'cached'}
+        """
+        start = time.perf_counter()
+        key = self._cache_key(url)
+        cached = self.cache.get(key)
+        headers = {}
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+            if not headers:
+                return dict(cached, cached=True, elapsed=time.perf_counter() - start)
+
+        try:
+            if cached is None:
+                # 本文を取得する前にヘッダーだけで形式・サイズを確認（HEAD非対応のサーバーはGETで確認）
+                with self._open("HEAD", url) as head:
+                    error = self._check_headers(head.headers) if head.status_code < 400 else None
+                if error:
+                    return self._error(url, error, start)
+            with self._open("GET", url, headers=headers, stream=True) as response:
+                if response.status_code == 304 and cached is not None:
+                    return dict(cached, cached=True, elapsed=time.perf_counter() - start)
+                response.raise_for_status()
+                error = self._check_headers(response.headers)
+                if error:
+                    return self._error(url, error, start)
+                body = self._read_capped(response)
+                result = self._validate(url, body)
+                result['etag'] = response.headers.get('ETag')
+                result['last_modified'] = response.headers.get('Last-Modified')
+        except requests.RequestException as e:
+            return self._error(url, f"取得エラー: {e}", start)
+        except ValueError as e:
+            return self._error(url, str(e), start)
+
+        if result['status'] == 'ok':
+            self.cache.set(key, result)
+        return dict(result, cached=False, elapsed=time.perf_counter() - start)
+
+    def _check_headers(self, headers) -> Optional[str]:
+        """Content-Type・Content-Length の確認（問題があればエラーメッセージ）"""
+        content_type = headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type and not content_type.startswith('image/'):
+            return f"画像ではありません（{content_type}）"
+        length = headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > self.max_download_bytes:
+            return f"サイズが上限（{self.max_download_bytes / (1024 * 1024):.0f}MB）を超えています"
+        return None
+
+    def _read_capped(self, response: requests.Response) -> bytes:
+        """上限バイト数まで本文を読み込み（超過時は途中で打ち切り ValueError）"""
+        buffer = io.BytesIO()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            buffer.write(chunk)
+            if buffer.tell() > self.max_download_bytes:
+                raise ValueError(f"サイズが上限（{self.max_download_bytes / (1024 * 1024):.0f}MB）を超えています")
+        return buffer.getvalue()
+
+    def _validate(self, url: str, body: bytes) -> Dict[str, Any]:
+        """画像としてデコードできるか・API制限内かを確認し、必要なら最適化したBase64へ変換"""
+        try:
+            img = Image.open(io.BytesIO(body))
+            size = img.size
+        except Exception as e:
+            raise ValueError(f"画像として読み込めません: {e}")
+        media_type = self.FORMAT_MEDIA_TYPES.get(img.format)
+        result = {'url': url, 'status': 'ok', 'mode': 'url', 'media_type': media_type, 'size': size,
+                  'bytes': len(body), 'data': None, 'error': None}
+        oversize_dimension = max(size) > self.max_dimension
+        if (media_type is not None and not oversize_dimension
+                and ImageEncoder.base64_size(len(body)) <= self.max_base64_bytes):
+            return result
+        if not self.convert_oversize:
+            if media_type is None:
+                reason = f"非対応の形式のため送信できません（{img.format}）"
+            elif oversize_dimension:
+                reason = f"解像度制限超過のため送信できません（{size[0]}x{size[1]}、上限 {self.max_dimension}px）"
+            else:
+                reason = f"サイズ制限超過のため送信できません（{img.format}, {len(body) / (1024 * 1024):.1f}MB）"
+            raise ValueError(reason)
+
+        img.load()
+        img = ImageEncoder.normalize(img)
+        if self.max_long_edge:
+            target_size = ImageEncoder.target_size(img.size, min(self.max_long_edge, self.max_dimension))
+        elif oversize_dimension:
+            target_size = ImageEncoder.target_size(img.size, self.max_dimension, max_pixels=img.size[0] * img.size[1])
+        else:
+            target_size = None
+        data, media_type, stats = ImageEncoder.encode_image(img, self.max_base64_bytes, target_size)
+        if stats is None:
+            raise ValueError("縮小してもサイズ制限内に収まりません")
+        result.update(mode='base64', media_type=media_type, data=data, size=stats['size'])
+        return result
+
+    @staticmethod
+    def _error(url: str, message: str, start: float) -> Dict[str, Any]:
+        return {'url': url, 'status': 'error', 'mode': None, 'media_type': None, 'size': None,
+                'bytes': 0, 'data': None, 'error': message, 'cached': False,
+                'elapsed': time.perf_counter() - start}
+
+    @staticmethod
+    def content_block(result: Dict[str, Any]) -> Dict[str, Any]:
+        """検証済み結果の画像コンテンツブロック（URLのまま / 変換済みBase64）"""
+        if result['mode'] == 'base64':
+            return ImageEncoder.image_block(result['data'], result['media_type'])
+        return {"type": "image", "source": {"type": "url", "url": result['url']}}
+
+
+class ImageDirectoryIndex:
+    """画像フォルダの永続インデックス（サイズ・更新時刻・解像度・内容ハッシュ・サムネイル）
+
+    一覧表示のたびに glob・stat・画像ヘッダーの読み込みを行わないよう、結果を
+    paths.cache_dir/image_index に保存する。フォルダの更新時刻が変わったか一定時間が
+    経過した場合のみ走査し、サイズ・更新時刻が変わったファイルだけを再計算する。
+    """
+
+    _instances: Dict[str, "ImageDirectoryIndex"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, directory: Union[str, Path], index_dir: Union[str, Path] = None,
+                 rescan_interval: float = None, thumbnail_size: int = None, workers: int = None):
+        self.root = Path(directory)
+        resolved = str(self.root.resolve())
+        if index_dir is None:
+            index_dir = Path(config.get("paths.cache_dir", "cache")) / "image_index"
+        self.index_path = Path(index_dir) / f"{hashlib.sha256(resolved.encode('utf-8')).hexdigest()[:16]}.pkl"
+        self.rescan_interval = (rescan_interval if rescan_interval is not None
+                                else config.get("image_index.rescan_interval", 30))
+        self.thumbnail_size = thumbnail_size or config.get("image_index.thumbnail_size", 128)
+        self.workers = workers or config.get("image_index.workers", 4)
+        self._lock = threading.RLock()
+        self._entries: Optional[Dict[str, Dict[str, Any]]] = None
+        self._dir_mtime: Optional[int] = None
+        self._scanned_at: Optional[float] = None
+        self.updated = 0
+
+    @classmethod
+    def for_directory(cls, directory: Union[str, Path]) -> "ImageDirectoryIndex":
+        """フォルダごとのインスタンス（プロセス内で共有し、再実行時はメモリ上の索引を使う）"""
+        key = str(Path(directory).resolve())
+        with cls._instances_lock:
+            instance = cls._instances.get(key)
+            if instance is None:
+                instance = cls._instances[key] = cls(directory)
+            return instance
+
+    def _load(self) -> None:
+        if self._entries is not None:
+            return
+        try:
+            with open(self.index_path, 'rb') as f:
+                stored = pickle.load(f)
+            self._entries, self._dir_mtime = stored['entries'], stored['dir_mtime']
+        except FileNotFoundError:
+            self._entries = {}
+        except Exception as e:
+            logger.warning(f"画像インデックス読み込みエラー: {e}")
+            self._entries = {}
+
+    def _save(self) -> None:
+        """一時ファイル経由でアトミックに保存"""
+        tmp_path = self.index_path.with_suffix(".tmp")
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'entries': self._entries, 'dir_mtime': self._dir_mtime}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            logger.warning(f"画像インデックス保存エラー: {e}")
+            tmp_path.unlink(missing_ok=True)
+
+    def refresh(self, force: bool = False) -> int:
+        """変更のあったファイルのみ差分更新（追加・更新・削除したファイル数を返す）"""
+        with self._lock:
+            self._load()
+            try:
+                dir_mtime = self.root.stat().st_mtime_ns
+            except OSError:
+                self._entries = {}
+                return 0
+            now = time.monotonic()
+            if (not force and self._scanned_at is not None and dir_mtime == self._dir_mtime
+                    and now - self._scanned_at < self.rescan_interval):
+                return 0
+
+            current = {}
+            with os.scandir(self.root) as scanner:
+                for item in scanner:
+                    if item.is_file() and Path(item.name).suffix.lower() in ImageEncoder.MEDIA_TYPES:
+                        stat = item.stat()
+                        current[item.name] = (stat.st_size, stat.st_mtime_ns)
+            changed = []
+            for name, signature in current.items():
+                entry = self._entries.get(name)
+                if entry is None or (entry['size'], entry['mtime_ns']) != signature:
+                    changed.append(name)
+            removed = [name for name in self._entries if name not in current]
+            for name in removed:
+                del self._entries[name]
+            if changed:
+                with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image_index") as pool:
+                    for name, entry in zip(changed, pool.map(self._describe, changed)):
+                        if entry is None:
+                            self._entries.pop(name, None)
+                        else:
+                            self._entries[name] = entry
+
+            modified = bool(changed or removed or dir_mtime != self._dir_mtime)
+            self._dir_mtime, self._scanned_at = dir_mtime, now
+            self.updated = len(changed)
+            if modified:
+                self._save()
+            return len(changed) + len(removed)
+
+    def _describe(self, name: str) -> Optional[Dict[str, Any]]:
+        """1ファイル分のエントリ（解像度・内容ハッシュ・サムネイル / 走査後に削除されたファイルはNone）"""
+        path = self.root / name
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        entry = {'name': name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                 'width': None, 'height': None, 'content_hash': None, 'thumbnail': None, 'error': None}
+        try:
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+            entry['content_hash'] = hasher.hexdigest()
+            with Image.open(path) as img:
+                entry['width'], entry['height'] = img.size
+                ImageEncoder.draft_for(img, (self.thumbnail_size, self.thumbnail_size))
+                img.thumbnail((self.thumbnail_size, self.thumbnail_size))
+                thumbnail = ImageEncoder.prepare_mode(img, 'JPEG')
+                entry['thumbnail'] = ImageEncoder.encode_bytes(thumbnail, 'JPEG', 70)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            entry['error'] = str(e)
+        return entry
+
+    def _with_path(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(entry, path=str(self.root / entry['name']))
+
+    def list(self, query: str = "", offset: int = 0, limit: int = None) -> Tuple[List[Dict[str, Any]], int]:
+        """ファイル名順の一覧（query で部分一致の絞り込み・offset/limit でページ分割）
+
+        Returns:
+            (エントリのリスト, 絞り込み後の総件数)
+        """
+        self.refresh()
+        with self._lock:
+            names = self._matching(query)
+            page = names[offset:offset + limit] if limit else names[offset:]
+            return [self._with_path(self._entries[name]) for name in page], len(names)
+
+    def count(self, query: str = "") -> int:
+        """絞り込み後の件数（ページ数の計算用・エントリは複製しない）"""
+        self.refresh()
+        with self._lock:
+            return len(self._matching(query))
+
+    def _matching(self, query: str) -> List[str]:
+        names = sorted(self._entries)
+        if query:
+            needle = query.lower()
+            names = [name for name in names if needle in name.lower()]
+        return names
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        """ファイル名のエントリ（未登録はNone）"""
+        self.refresh()
+        with self._lock:
+            entry = self._entries.get(Path(name).name)
+            return self._with_path(entry) if entry is not None else None
+
+    def __len__(self) -> int:
+        self.refresh()
+        return len(self._entries)
+
+
+# ==================================================
+# 都市データ（列指向インデックス）
+# ==================================================
+class CityIndex:
+    """都市データの列指向インデックス（日本: city_jp.list.json / 全世界: city.list.json.gz）
+
+    元JSONを名前順にソートした列（名前・緯度・経度・ID・国コード）の .npy ファイルへ
+    事前変換し、読み込み時は memory map で参照する。元JSONごとに別の成果物を持つ。再実行・検索のたびに JSON の解析・
+    DataFrame の構築・ソートを行わず、プロセス内では1つのインスタンスを全デモで共有する。
+    """
+
+    VERSION = 2
+    COLUMNS = ('names', 'lat', 'lon', 'ids', 'countries')
+
+    _instances: Dict[str, "CityIndex"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        with open(self.directory / "meta.json", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.names = np.load(self.directory / "names.npy", mmap_mode='r')
+        self.lat = np.load(self.directory / "lat.npy", mmap_mode='r')
+        self.lon = np.load(self.directory / "lon.npy", mmap_mode='r')
+        self.ids = np.load(self.directory / "ids.npy", mmap_mode='r')
+        self.countries = np.load(self.directory / "countries.npy", mmap_mode='r')
+        self._name_list: Optional[List[str]] = None
+        self._names_lower: Optional[List[str]] = None
+        self._spatial: Optional["CitySpatialIndex"] = None
+
+    @staticmethod
+    def resolve_paths(json_path: Union[str, Path] = None,
+                      index_dir: Union[str, Path] = None) -> Tuple[Path, Path]:
+        """(元JSON, 成果物ディレクトリ)。成果物は元JSONごとに city_index/<ファイル名> へ置く"""
+        json_path = Path(json_path or config.get("paths.cities_json", "data/city_jp.list.json"))
+        if index_dir is None:
+            base_dir = config.get("paths.city_index_dir") or Path(config.get("paths.cache_dir", "cache")) / "city_index"
+            index_dir = Path(base_dir) / json_path.name.split('.')[0]
+        return json_path, Path(index_dir)
+
+    @staticmethod
+    def source_signature(json_path: Union[str, Path]) -> Dict[str, int]:
+        stat = Path(json_path).stat()
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    @classmethod
+    def is_current(cls, json_path: Union[str, Path], index_dir: Union[str, Path]) -> bool:
+        """成果物が存在し、元JSON（サイズ・更新時刻）と形式のバージョンが一致するか"""
+        index_dir = Path(index_dir)
+        try:
+            with open(index_dir / "meta.json", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return False
+        return (meta.get('version') == cls.VERSION
+                and meta.get('source') == cls.source_signature(json_path)
+                and all((index_dir / f"{column}.npy").exists() for column in cls.COLUMNS))
+
+    @classmethod
+    def build(cls, json_path: Union[str, Path] = None, index_dir: Union[str, Path] = None) -> Path:
+        """元JSON（.gz 可）から名前順の列ファイルを生成（meta.json は最後に書き、途中の失敗は未生成として扱う）"""
+        json_path, index_dir = cls.resolve_paths(json_path, index_dir)
+        opener = gzip.open if json_path.suffix == '.gz' else open
+        with opener(json_path, "rt", encoding="utf-8") as f:
+            cities = json.load(f)
+
+        names = np.array([city["name"] for city in cities], dtype=str)
+        order = np.argsort(names, kind='stable')
+        columns = {
+            'names': names[order],
+            'lat'  : np.array([city["coord"]["lat"] for city in cities], dtype=np.float64)[order],
+            'lon'  : np.array([city["coord"]["lon"] for city in cities], dtype=np.float64)[order],
+            'ids'  : np.array([city["id"] for city in cities], dtype=np.int64)[order],
+            'countries': np.array([city.get("country", "") for city in cities], dtype=str)[order],
+        }
+
+        index_dir.mkdir(parents=True, exist_ok=True)
+        (index_dir / "meta.json").unlink(missing_ok=True)
+        for column, values in columns.items():
+            tmp_path = index_dir / f"{column}.tmp.npy"
+            np.save(tmp_path, values)
+            os.replace(tmp_path, index_dir / f"{column}.npy")
+        meta = {'version': cls.VERSION, 'count': len(names), 'source': cls.source_signature(json_path)}
+        with open(index_dir / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        logger.info(f"都市インデックスを生成しました: {index_dir} ({len(names)}件)")
+        return index_dir
+
+    @classmethod
+    def load(cls, json_path: Union[str, Path] = None, index_dir: Union[str, Path] = None) -> "CityIndex":
+        """プロセス内共有のインデックス（成果物が無い・元JSONが更新された場合は生成してから読み込む）"""
+        json_path, index_dir = cls.resolve_paths(json_path, index_dir)
+        key = str(index_dir.resolve())
+        with cls._instances_lock:
+            instance = cls._instances.get(key)
+            if instance is not None and instance.meta['source'] == cls.source_signature(json_path):
+                return instance
+            if not cls.is_current(json_path, index_dir):
+                cls.build(json_path, index_dir)
+            instance = cls._instances[key] = cls(index_dir)
+            return instance
+
+    @classmethod
+    def load_prebuilt(cls, json_path: Union[str, Path] = None,
+                      index_dir: Union[str, Path] = None) -> Optional["CityIndex"]:
+        """生成済みの成果物がある場合のみ読み込み（未生成・古い場合は生成せずNone）
+
+        全世界のデータなど生成に時間がかかる成果物を、画面描画中に生成しないために使う。
+        """
+        json_path, index_dir = cls.resolve_paths(json_path, index_dir)
+        if not json_path.exists() or not cls.is_current(json_path, index_dir):
+            return None
+        return cls.load(json_path, index_dir)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def name_list(self) -> List[str]:
+        """名前順の都市名リスト（選択UI用・初回のみ生成）"""
+        if self._name_list is None:
+            self._name_list = self.names.tolist()
+        return self._name_list
+
+    def row(self, position: int) -> Tuple[str, float, float]:
+        """(都市名, 緯度, 経度)"""
+        return str(self.names[position]), float(self.lat[position]), float(self.lon[position])
+
+    def position(self, name: str) -> Optional[int]:
+        """完全一致する都市の位置（ソート済みのため二分探索）"""
+        position = int(np.searchsorted(self.names, name))
+        if position < len(self.names) and self.names[position] == name:
+            return position
+        return None
+
+    def lookup(self, name: str) -> Optional[Tuple[str, float, float]]:
+        position = self.position(name)
+        return self.row(position) if position is not None else None
+
+    def search(self, query: str) -> np.ndarray:
+        """大文字小文字を区別しない部分一致の位置（名前順）"""
+        if self._names_lower is None:
+            self._names_lower = [name.lower() for name in self.name_list()]
+        query = query.lower()
+        return np.array([i for i, name in enumerate(self._names_lower) if query in name], dtype=np.intp)
+
+    def closest(self, query: str, cutoff: float = 0.6) -> Optional[int]:
+        """表記ゆれに対する類似度マッチング（difflib）"""
+        import difflib
+        matches = difflib.get_close_matches(query, self.name_list(), n=1, cutoff=cutoff)
+        return self.position(matches[0]) if matches else None
+
+    def spatial(self) -> "CitySpatialIndex":
+        """座標の空間インデックス（初回のみ構築し、インスタンスと共に共有）"""
+        if self._spatial is None:
+            self._spatial = CitySpatialIndex(self.lat, self.lon)
+        return self._spatial
+
+    def nearest(self, lat: float, lon: float, k: int = 1) -> List[Tuple[int, float]]:
+        """座標に近い順の k 都市の (位置, 距離km)"""
+        return self.spatial().nearest(lat, lon, k)
+
+    def within(self, lat: float, lon: float, radius_km: float) -> List[Tuple[int, float]]:
+        """座標から半径 radius_km 以内の都市の (位置, 距離km)（近い順）"""
+        return self.spatial().within(lat, lon, radius_km)
+
+
+class CitySpatialIndex:
+    """都市座標の空間インデックス（NumPy 実装の KD-tree）
+
+    緯度経度を単位球面上の3次元座標へ変換して KD-tree を構築する。弦の長さは大圏距離と
+    単調な関係にあるため、日付変更線・極付近でも補正なしで最近傍・半径検索ができる。
+    各ノードは点の連続区間と外接箱を持ち、葉の距離計算のみ NumPy で一括処理する。
+    """
+
+    EARTH_RADIUS_KM = 6371.0088
+    LEAF_SIZE = 32
+
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, leaf_size: int = None):
+        self.leaf_size = max(1, leaf_size or self.LEAF_SIZE)
+        points = self.to_xyz(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+        order = np.arange(len(points))
+
+        # 幅優先で分割（広がりが最大の軸の中央値で二分）。ノード i の子は children[i]
+        ranges, children, lows, highs = [], [], [], []
+        pending = [(0, len(points))] if len(points) else []
+        while len(ranges) < len(pending):
+            start, end = pending[len(ranges)]
+            segment = points[order[start:end]]
+            low, high = segment.min(axis=0), segment.max(axis=0)
+            ranges.append((start, end))
+            lows.append(tuple(low.tolist()))
+            highs.append(tuple(high.tolist()))
+            if end - start > self.leaf_size:
+                axis = int(np.argmax(high - low))
+                mid = (start + end) // 2
+                order[start:end] = order[start:end][np.argpartition(segment[:, axis], mid - start)]
+                children.append((len(pending), len(pending) + 1))
+                pending += [(start, mid), (mid, end)]
+            else:
+                children.append(None)
+
+        self.order = order
+        self.points = np.ascontiguousarray(points[order])
+        self._ranges, self._children, self._lows, self._highs = ranges, children, lows, highs
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    @staticmethod
+    def to_xyz(lat, lon) -> np.ndarray:
+        """緯度経度（度）→ 単位球面上の3次元座標"""
+        lat, lon = np.radians(lat), np.radians(lon)
+        cos_lat = np.cos(lat)
+        return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+    @classmethod
+    def distance_km(cls, lat1, lon1, lat2, lon2):
+        """大圏距離（km・haversine）。配列を渡すと要素ごとに計算する"""
+        lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        return 2 * cls.EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    @classmethod
+    def _chord_to_km(cls, chord_sq: float) -> float:
+        """弦長の2乗 → 大圏距離（km）"""
+        return 2 * cls.EARTH_RADIUS_KM * math.asin(min(math.sqrt(chord_sq) / 2, 1.0))
+
+    def _query_point(self, lat: float, lon: float) -> Tuple[np.ndarray, Tuple[float, float, float]]:
+        lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+        cos_lat = math.cos(lat_rad)
+        xyz = (cos_lat * math.cos(lon_rad), cos_lat * math.sin(lon_rad), math.sin(lat_rad))
+        return np.array(xyz), xyz
+
+    def _box_distance_sq(self, node: int, xyz: Tuple[float, float, float]) -> float:
+        """点とノードの外接箱との距離の2乗（箱内なら0）"""
+        x, y, z = xyz
+        low_x, low_y, low_z = self._lows[node]
+        high_x, high_y, high_z = self._highs[node]
+        dx = low_x - x if x < low_x else (x - high_x if x > high_x else 0.0)
+        dy = low_y - y if y < low_y else (y - high_y if y > high_y else 0.0)
+        dz = low_z - z if z < low_z else (z - high_z if z > high_z else 0.0)
+        return dx * dx + dy * dy + dz * dz
+
+    def _leaf_distances_sq(self, node: int, query: np.ndarray) -> Tuple[np.ndarray, int]:
+        start, end = self._ranges[node]
+        diff = self.points[start:end] - query
+        return np.einsum('ij,ij->i', diff, diff), start
+
+    def nearest(self, lat: float, lon: float, k: int = 1) -> List[Tuple[int, float]]:
+        """近い順の k 点の (元配列での位置, 距離km)。外接箱が近いノードから探索し、k番目より遠い箱は打ち切る"""
+        k = min(k, len(self))
+        if k <= 0:
+            return []
+        query, xyz = self._query_point(lat, lon)
+        best: List[Tuple[float, int]] = []  # (-弦長², 並べ替え後の位置) の最大ヒープ（k件）
+        bound = math.inf
+        heap = [(0.0, 0)]
+        box_distance_sq, heappush, heappop = self._box_distance_sq, heapq.heappush, heapq.heappop
+        while heap:
+            box_sq, node = heappop(heap)
+            if box_sq > bound:
+                break
+            if self._children[node] is None:
+                dist_sq, start = self._leaf_distances_sq(node, query)
+                closer = np.flatnonzero(dist_sq < bound)
+                if len(closer) > k:
+                    closer = closer[np.argpartition(dist_sq[closer], k - 1)[:k]]
+                for offset, value in zip(closer.tolist(), dist_sq[closer].tolist()):
+                    if len(best) < k:
+                        heappush(best, (-value, start + offset))
+                    elif value < -best[0][0]:
+                        heapq.heapreplace(best, (-value, start + offset))
+                if len(best) == k:
+                    bound = -best[0][0]
+                continue
+            for child in self._children[node]:
+                child_sq = box_distance_sq(child, xyz)
+                if child_sq <= bound:
+                    heappush(heap, (child_sq, child))
+
+        return [(int(self.order[index]), self._chord_to_km(value))
+                for value, index in sorted((-negative, index) for negative, index in best)]
+
+    def within(self, lat: float, lon: float, radius_km: float) -> List[Tuple[int, float]]:
+        """半径 radius_km 以内の点の (元配列での位置, 距離km)（近い順）"""
+        if radius_km < 0 or not len(self):
+            return []
+        half_angle = min(radius_km / self.EARTH_RADIUS_KM, math.pi) / 2
+        limit_sq = (2 * math.sin(half_angle)) ** 2
+        query, xyz = self._query_point(lat, lon)
+        hits_sq, hits_index = [], []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self._box_distance_sq(node, xyz) > limit_sq:
+                continue
+            if self._children[node] is not None:
+                stack.extend(self._children[node])
+                continue
+            dist_sq, start = self._leaf_distances_sq(node, query)
+            inside = np.flatnonzero(dist_sq <= limit_sq)
+            hits_sq.append(dist_sq[inside])
+            hits_index.append(inside + start)
+
+        if not hits_sq:
+            return []
+        hits_sq, hits_index = np.concatenate(hits_sq), np.concatenate(hits_index)
+        ranked = np.argsort(hits_sq, kind='stable')
+        distances = 2 * self.EARTH_RADIUS_KM * np.arcsin(np.minimum(np.sqrt(hits_sq[ranked]) / 2, 1.0))
+        return list(zip(self.order[hits_index[ranked]].tolist(), distances.tolist()))
+
+
 # ==================================================
 # ユーティリティ関数
 # ==================================================
@@ -849,11 +4130,38 @@ __all__ = [
 
     # クラス
     'ConfigManager',
+    'MessageHistory',
+    'ConversationLog',
+    'ConversationBuilder',
+    'ConversationCompactor',
     'MessageManager',
     'TokenManager',
+    'ResponseRecord',
     'ResponseProcessor',
     'AnthropicClient',
     'MemoryCache',
+    'StreamingQuantile',
+    'PerformanceStats',
+    'PerformanceTracker',
+    'LRUCache',
+    'DiskCache',
+    'SharedResultCache',
+    'UsageLog',
+    'CostSimulator',
+    'MemoryAccountant',
+    'SessionMemoryRegistry',
+    'Base64Payload',
+    'ImageEncoder',
+    'AnimationSampler',
+    'PerceptualHash',
+    'ImageHashIndex',
+    'VisionRequestPacker',
+    'URLImagePrefetcher',
+    'ImageDirectoryIndex',
+    'CityIndex',
+    'CitySpatialIndex',
+    'ImagePayloadCache',
+    'VisionBatchProcessor',
 
     # デコレータ
     'error_handler',
@@ -868,6 +4176,10 @@ __all__ = [
     'create_session_id',
     'safe_json_serializer',
     'safe_json_dumps',
+    'make_cache_key',
+    'deep_sizeof',
+    'format_bytes',
+    'process_memory_usage',
 
     # デフォルトメッセージ関数
     'get_default_messages',
@@ -879,4 +4191,7 @@ __all__ = [
     'config',
     'logger',
     'cache',
+    'shared_cache',
+    'session_memory',
+    'image_cache',
 ]
@@ -27,10 +27,17 @@ from helper_api import (
 
     # クラス
     ConfigManager,
+    MessageHistory,
     MessageManager,
     TokenManager,
     ResponseProcessor,
     AnthropicClient,
+    PerformanceTracker,
+    LRUCache,
+    MemoryAccountant,
+    CostSimulator,
+    UsageLog,
+    VisionBatchProcessor,
 
     # ユーティリティ
     sanitize_key,
@@ -38,11 +45,16 @@ from helper_api import (
     save_json_file,
     safe_json_serializer,
     safe_json_dumps,
+    make_cache_key,
+    create_session_id,
+    format_bytes,
 
     # グローバル
     config,
     logger,
     cache,
+    shared_cache,
+    session_memory,
 )
 
 
@@ -99,58 +111,50 @@ def timer_ui(func):
 
         logger.info(f"{func.__name__} took {execution_time:.2f} seconds")
 
-        # パフォーマンスモニタリングが有効な場合
+        # パフォーマンスモニタリングが有効な場合（関数ごとのリングバッファに記録）
         if config.get("experimental.performance_monitoring", True):
-            if 'performance_metrics' not in st.session_state:
-                st.session_state.performance_metrics = []
-            st.session_state.performance_metrics.append({
-                'function'      : func.__name__,
-                'execution_time': execution_time,
-                'timestamp'     : datetime.now()
-            })
+            SessionStateManager.get_performance_tracker().record(func.__name__, execution_time, end_time)
 
         return result
 
     return wrapper
 
 
-def cache_result_ui(ttl: int = None):
-    """結果をキャッシュするデコレータ（Streamlit session_state用）"""
+def cache_result_ui(ttl: int = None, shared: bool = False, shared_ttl: int = None, persist: bool = False):
+    """結果をキャッシュするデコレータ（セッション層 + 任意のセッション間共有層）
+
+    shared=True はユーザー固有のデータを含まない結果にのみ指定すること。
+    共有層のヒットは全セッションで再利用され、persist=True でディスクにも保存される。
+    """
+
+    _miss = object()
 
     def decorator(func):
+        func_name = f"{func.__module__}.{func.__qualname__}"
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             if not config.get("cache.enabled", True):
                 return func(*args, **kwargs)
 
-            # キャッシュキーの生成
-            import hashlib
-            cache_key = f"{func.__name__}_{hashlib.md5(str(args).encode() + str(kwargs).encode()).hexdigest()}"
+            cache_key = make_cache_key(func_name, args, kwargs)
 
-            # セッションステートにキャッシュ領域を確保
-            if 'ui_cache' not in st.session_state:
-                st.session_state.ui_cache = {}
+            # 共有層（全セッション）またはセッション層の確認
+            if shared:
+                store, store_ttl = shared_cache, shared_ttl
+            else:
+                store, store_ttl = SessionStateManager.get_ui_cache(), ttl
 
-            # キャッシュの確認
-            if cache_key in st.session_state.ui_cache:
-                cached_data = st.session_state.ui_cache[cache_key]
-                if time.time() - cached_data['timestamp'] < (ttl or config.get("cache.ttl", 3600)):
-                    return cached_data['result']
+            result = store.get(cache_key, _miss, ttl=store_ttl)
+            if result is not _miss:
+                return result
 
-            # 関数実行とキャッシュ保存
+            # 関数実行とキャッシュ保存（LRUのため上限超過時の削除はO(1)）
             result = func(*args, **kwargs)
-            st.session_state.ui_cache[cache_key] = {
-                'result'   : result,
-                'timestamp': time.time()
-            }
-
-            # キャッシュサイズ制限
-            max_size = config.get("cache.max_size", 100)
-            if len(st.session_state.ui_cache) > max_size:
-                # 最も古いエントリを削除
-                oldest_key = min(st.session_state.ui_cache,
-                                 key=lambda k: st.session_state.ui_cache[k]['timestamp'])
-                del st.session_state.ui_cache[oldest_key]
+            if shared:
+                shared_cache.set(cache_key, result, persist=persist)
+            else:
+                store.set(cache_key, result)
 
             return result
 
@@ -171,9 +175,12 @@ class SessionStateManager:
         try:
             if 'initialized' not in st.session_state:
                 st.session_state.initialized = True
-                st.session_state.ui_cache = {}
-                st.session_state.performance_metrics = []
+                st.session_state.ui_cache = SessionStateManager._create_ui_cache()
+                st.session_state.performance_metrics = PerformanceTracker()
                 st.session_state.user_preferences = {}
+
+            if config.get("memory.enabled", True) is True:
+                SessionStateManager.account_memory()
         except Exception:
             pass
 
@@ -189,16 +196,109 @@ class SessionStateManager:
             st.session_state.user_preferences = {}
         st.session_state.user_preferences[key] = value
 
+    @staticmethod
+    def _create_ui_cache() -> LRUCache:
+        """セッション層キャッシュの生成"""
+        return LRUCache(
+            max_size=config.get("cache.max_size", 100),
+            ttl=config.get("cache.ttl", 3600)
+        )
+
+    @staticmethod
+    def get_ui_cache() -> LRUCache:
+        """セッション層キャッシュの取得（未初期化・旧形式の辞書は置き換え）"""
+        ui_cache = st.session_state.get('ui_cache')
+        if not isinstance(ui_cache, LRUCache):
+            ui_cache = SessionStateManager._create_ui_cache()
+            st.session_state.ui_cache = ui_cache
+        return ui_cache
+
     @staticmethod
     def clear_cache():
-        """UIキャッシュのクリア"""
-        st.session_state.ui_cache = {}
+        """UIキャッシュのクリア（このセッションのセッション層・メモリキャッシュ）
+
+        共有層は他のセッションも利用するため対象外（clear_shared_cache を使用）
+        """
+        st.session_state.ui_cache = SessionStateManager._create_ui_cache()
         cache.clear()
 
+    @staticmethod
+    def clear_shared_cache():
+        """共有層キャッシュのクリア（全セッションに影響する管理者操作）"""
+        shared_cache.clear()
+        logger.info("共有キャッシュをクリアしました（全セッション）")
+
+    @staticmethod
+    def get_performance_tracker() -> PerformanceTracker:
+        """パフォーマンストラッカーの取得（未初期化・旧形式のリストは置き換え）"""
+        tracker = st.session_state.get('performance_metrics')
+        if not isinstance(tracker, PerformanceTracker):
+            tracker = PerformanceTracker()
+            st.session_state.performance_metrics = tracker
+        return tracker
+
     @staticmethod
     def get_performance_metrics() -> List[Dict[str, Any]]:
-        """パフォーマンスメトリクスの取得"""
-        return st.session_state.get('performance_metrics', [])
+        """パフォーマンスメトリクスの取得（直近サンプル、古い順）"""
+        return SessionStateManager.get_performance_tracker().recent()
+
+    @staticmethod
+    def get_session_id() -> str:
+        """セッションIDの取得（プロセス内集計用）"""
+        if 'session_id' not in st.session_state:
+            st.session_state.session_id = create_session_id()
+        return st.session_state.session_id
+
+    @staticmethod
+    def get_usage_log() -> UsageLog:
+        """このセッションの使用量記録（コスト試算用・他のセッションとは共有しない）"""
+        log = st.session_state.get('usage_log')
+        if not isinstance(log, UsageLog):
+            log = UsageLog()
+            st.session_state.usage_log = log
+        return log
+
+    @staticmethod
+    def _session_usage_log() -> Optional[UsageLog]:
+        """UsageLog のリゾルバ（スクリプト実行スレッド外ではNone）"""
+        try:
+            from streamlit.runtime.scriptrunner import get_script_run_ctx
+            if get_script_run_ctx() is None:
+                return None
+        except ImportError:
+            pass
+        return SessionStateManager.get_usage_log()
+
+    @staticmethod
+    def get_memory_accountant() -> MemoryAccountant:
+        """メモリ計測器の取得（計測器自身は計測対象外）"""
+        accountant = st.session_state.get('memory_accountant')
+        if not isinstance(accountant, MemoryAccountant):
+            accountant = MemoryAccountant(exclude_keys=['memory_accountant'])
+            st.session_state.memory_accountant = accountant
+        return accountant
+
+    @staticmethod
+    def account_memory(force: bool = False) -> Optional[List[Dict[str, Any]]]:
+        """セッション状態のメモリ計測・上限超過時の破棄・プロセス集計への登録
+
+        memory.check_interval 秒以内の再呼び出しは計測を省略してNoneを返す（force=True で常に計測）。
+        """
+        accountant = SessionStateManager.get_memory_accountant()
+        interval = config.get("memory.check_interval", 5)
+        if (not force and accountant.last_measured is not None
+                and time.time() - accountant.last_measured < interval):
+            return None
+
+        rows = accountant.measure(st.session_state)
+        if accountant.enforce(st.session_state, rows):
+            rows = accountant.measure(st.session_state)
+        session_memory.update(SessionStateManager.get_session_id(), accountant.last_total)
+        return rows
+
+
+# APIクライアントの使用量を呼び出し元セッションの記録へ振り分ける
+UsageLog.set_resolver(SessionStateManager._session_usage_log)
 
 
 # ==================================================
@@ -216,43 +316,48 @@ class MessageManagerUI(MessageManager):
         """メッセージ履歴の初期化"""
         try:
             if self.session_key not in st.session_state:
-                st.session_state[self.session_key] = self.get_default_messages()
+                st.session_state[self.session_key] = self._new_history(self.get_default_messages())
         except Exception:
             # st.session_state may be mocked during tests
             pass
 
+    @staticmethod
+    def _new_history(messages: List[EasyInputMessageParam] = None) -> MessageHistory:
+        limit = config.get("ui.message_display_limit", 50)
+        return MessageHistory(messages, limit=limit if isinstance(limit, int) else 50)
+
+    def _history(self) -> MessageHistory:
+        """セッションの履歴ストア（旧形式のリストは変換して置き換える）"""
+        history = st.session_state.get(self.session_key)
+        if not isinstance(history, MessageHistory):
+            history = self._new_history(history if isinstance(history, list) else None)
+            st.session_state[self.session_key] = history
+        return history
+
     def add_message(self, role: RoleType, content: str):
-        """メッセージの追加"""
+        """メッセージの追加（追加順に保持し、上限超過分は先頭の system/developer を除いて古い順に破棄）"""
         valid_roles: List[RoleType] = ["user", "assistant", "system", "developer"]
         if role not in valid_roles:
             raise ValueError(f"Invalid role: {role}. Must be one of {valid_roles}")
 
-        st.session_state[self.session_key].append(
-            {"role": role, "content": content}
-        )
-
-        # メッセージ数制限
-        limit = config.get("ui.message_display_limit", 50)
-        if len(st.session_state[self.session_key]) > limit:
-            # 最初のdeveloperメッセージは保持
-            messages = st.session_state[self.session_key]
-            developer_msg = messages[0] if messages and messages[0].get('role') == 'developer' else None
-            st.session_state[self.session_key] = messages[-limit:]
-            if developer_msg and st.session_state[self.session_key][0].get('role') != 'developer':
-                st.session_state[self.session_key].insert(0, developer_msg)
+        self._history().append({"role": role, "content": content})
 
     def get_messages(self) -> List[EasyInputMessageParam]:
-        """メッセージ履歴の取得"""
-        return st.session_state.get(self.session_key, [])
+        """メッセージ履歴の取得（コピー）"""
+        return self._history().to_list()
+
+    def snapshot(self) -> Tuple[EasyInputMessageParam, ...]:
+        """メッセージ履歴の読み取り専用ビュー（API呼び出し・表示用、変更がなければコピーしない）"""
+        return self._history().snapshot()
 
     def clear_messages(self):
         """メッセージ履歴のクリア"""
-        st.session_state[self.session_key] = self.get_default_messages()
+        st.session_state[self.session_key] = self._new_history(self.get_default_messages())
 
     def import_messages(self, data: Dict[str, Any]):
         """メッセージ履歴のインポート"""
         if 'messages' in data:
-            st.session_state[self.session_key] = data['messages']
+            st.session_state[self.session_key] = self._new_history(data['messages'])
 
     def export_messages_ui(self) -> str:
         """メッセージ履歴のエクスポート（UI用）"""
@@ -426,20 +531,45 @@ class UIHelper:
 
     @staticmethod
     def show_token_info(text: str, model: str = None, position: str = "sidebar"):
-        """トークン情報の表示（拡張版）"""
+        """トークン情報の表示（拡張版・メモ化）
+
+        トークン数はテキストハッシュ単位でメモされるため、無関係なウィジェット操作による
+        再実行や送信時の再計算は発生しない。長いテキストは入力が落ち着いてから別スレッドで
+        計算し、完了までは文字数からの概算を表示する（フラグメントで定期的に完了を確認し、
+        完了したらアプリを再実行して確定値に切り替える）。
+        """
         if not text:
             return
 
-        token_count = TokenManager.count_tokens(text, model)
-        limits = TokenManager.get_model_limits(model)
-
         # 表示位置の選択
         container = st.sidebar if position == "sidebar" else st
+        slot = f"{SessionStateManager.get_session_id()}:{position}"
 
+        token_count = TokenManager.count_tokens_async(text, model, slot=slot)
         with container.container():
+            if token_count is None:
+                poll = st.fragment(run_every=config.get("tokens.async_poll_interval", 1.0))(
+                    UIHelper._poll_token_count)
+                poll(text, model, slot)
+            else:
+                UIHelper._render_token_info(token_count, model, is_estimate=False)
+
+    @staticmethod
+    def _poll_token_count(text: str, model: str, slot: str):
+        """バックグラウンド計算中の表示（フラグメントとして定期実行）"""
+        if TokenManager.count_tokens_async(text, model, slot=slot) is not None:
+            st.rerun()
+        UIHelper._render_token_info(TokenManager.estimate_tokens(text), model, is_estimate=True)
+
+    @staticmethod
+    def _render_token_info(token_count: int, model: str, is_estimate: bool):
+        """トークン数・使用率・推定コストの表示"""
+        limits = TokenManager.get_model_limits(model)
+
+        with st.container():
             col1, col2 = st.columns(2)
             with col1:
-                st.metric("トークン数", f"{token_count:,}")
+                st.metric("トークン数（概算）" if is_estimate else "トークン数", f"{token_count:,}")
             with col2:
                 usage_percent = (token_count / limits['max_tokens']) * 100
                 st.metric("使用率", f"{usage_percent:.1f}%")
@@ -453,6 +583,9 @@ class UIHelper:
             progress_value = min(usage_percent / 100, 1.0)
             st.progress(progress_value)
 
+            if is_estimate:
+                st.caption("⏳ 正確なトークン数をバックグラウンドで計算中です")
+
             # 警告表示
             if usage_percent > 90:
                 st.warning("⚠️ トークン使用率が高いです")
@@ -591,46 +724,55 @@ class UIHelper:
             st.write("**キャッシュ管理**")
             col1, col2 = st.columns(2)
             with col1:
-                if st.button("キャッシュクリア", help="全キャッシュをクリア"):
+                if st.button("キャッシュクリア", help="このセッションのキャッシュをクリア"):
                     SessionStateManager.clear_cache()
                     st.success("キャッシュをクリアしました")
             with col2:
-                cache_size = cache.size()
-                st.metric("キャッシュ数", cache_size)
+                st.metric("キャッシュ数", cache.size() + SessionStateManager.get_ui_cache().size())
+
+            # 共有層のクリアは全セッションに影響するため、デバッグモード時のみ表示
+            if debug_mode:
+                st.caption(f"共有キャッシュ（全セッション）: {shared_cache.size()}件")
+                if st.button("共有キャッシュをクリア", help="全セッション共通のキャッシュをクリア（管理者操作）"):
+                    SessionStateManager.clear_shared_cache()
+                    st.success("共有キャッシュをクリアしました")
 
     @staticmethod
     def show_performance_panel():
         """パフォーマンスパネルの表示"""
-        metrics = SessionStateManager.get_performance_metrics()
-        if not metrics:
+        tracker = SessionStateManager.get_performance_tracker()
+        if not tracker.total_count:
             st.info("パフォーマンスデータがありません")
             return
 
         with st.expander("📈 パフォーマンス情報", expanded=False):
-            # 最近の実行時間
-            recent_metrics = metrics[-10:]
-            avg_time = sum(m['execution_time'] for m in recent_metrics) / len(recent_metrics)
-            max_time = max(m['execution_time'] for m in recent_metrics)
-            min_time = min(m['execution_time'] for m in recent_metrics)
-
-            col1, col2, col3 = st.columns(3)
+            # 全期間の分位点（ストリーミング推定）
+            overall = tracker.overall
+            col1, col2, col3, col4 = st.columns(4)
             with col1:
-                st.metric("平均実行時間", f"{avg_time:.2f}s")
+                st.metric("p50", f"{overall.quantile(0.5):.2f}s")
             with col2:
-                st.metric("最大実行時間", f"{max_time:.2f}s")
+                st.metric("p95", f"{overall.quantile(0.95):.2f}s")
             with col3:
-                st.metric("最小実行時間", f"{min_time:.2f}s")
+                st.metric("p99", f"{overall.quantile(0.99):.2f}s")
+            with col4:
+                st.metric("最大実行時間", f"{overall.max_time:.2f}s")
 
-            # 実行時間の推移
-            if len(metrics) > 1:
-                try:
-                    import pandas as pd
-                    df = pd.DataFrame(metrics)
+            try:
+                import pandas as pd
+
+                # 関数別サマリー（行数は関数の種類数で頭打ち）
+                st.dataframe(pd.DataFrame(tracker.summaries()), use_container_width=True)
+
+                # 実行時間の推移（リングバッファ内の直近サンプルのみ）
+                recent = tracker.recent()
+                if len(recent) > 1:
+                    df = pd.DataFrame(recent)
                     st.line_chart(df.set_index('timestamp')['execution_time'])
-                except ImportError:
-                    st.info("pandas が必要です：pip install pandas")
-                except Exception as e:
-                    st.error(f"チャート表示エラー: {e}")
+            except ImportError:
+                st.info("pandas が必要です：pip install pandas")
+            except Exception as e:
+                st.error(f"チャート表示エラー: {e}")
 
 
 # ==================================================
@@ -663,70 +805,235 @@ class ResponseProcessorUI(ResponseProcessor):
 
         # 詳細情報の表示
         if show_details:
-            with st.expander("📊 詳細情報", expanded=False):
-                try:
-                    formatted = ResponseProcessor.format_response(response)
-
-                    # 使用状況の表示（安全なアクセス）
-                    usage_data = formatted.get('usage', {})
-                    if usage_data and isinstance(usage_data, dict):
-                        st.write("**トークン使用量**")
-                        col1, col2, col3 = st.columns(3)
-                        with col1:
-                            prompt_tokens = usage_data.get('prompt_tokens', 0)
-                            st.metric("入力", prompt_tokens)
-                        with col2:
-                            completion_tokens = usage_data.get('completion_tokens', 0)
-                            st.metric("出力", completion_tokens)
-                        with col3:
-                            total_tokens = usage_data.get('total_tokens', 0)
-                            st.metric("合計", total_tokens)
-
-                        # コスト計算
-                        model = formatted.get('model')
-                        if model and (prompt_tokens > 0 or completion_tokens > 0):
-                            try:
-                                cost = TokenManager.estimate_cost(
-                                    prompt_tokens,
-                                    completion_tokens,
-                                    model
-                                )
-                                st.metric("推定コスト", f"${cost:.6f}")
-                            except Exception as e:
-                                st.error(f"コスト計算エラー: {e}")
-
-                    # レスポンス情報
-                    st.write("**レスポンス情報**")
-                    info_data = {
-                        "ID"      : formatted.get('id', 'N/A'),
-                        "モデル"  : formatted.get('model', 'N/A'),
-                        "作成日時": formatted.get('created_at', 'N/A')
-                    }
-
-                    for key, value in info_data.items():
-                        st.write(f"- **{key}**: {value}")
-
-                    # Raw JSON表示（安全なJSON処理）
-                    if show_raw:
-                        st.write("**Raw JSON**")
-                        safe_streamlit_json(formatted)
-
-                    # ダウンロードボタン
-                    try:
-                        UIHelper.create_download_button(
-                            formatted,
-                            f"response_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                            "application/json",
-                            "📥 JSONダウンロード"
-                        )
-                    except Exception as e:
-                        st.error(f"ダウンロードボタン作成エラー: {e}")
+            ResponseProcessorUI.display_details(response, show_raw=show_raw)
 
+    @staticmethod
+    def display_details(response: Response, show_raw: bool = False):
+        """詳細情報（使用量・コスト・レスポンス情報）の表示"""
+        with st.expander("📊 詳細情報", expanded=False):
+            try:
+                formatted = ResponseProcessor.format_response(response)
+
+                # 使用状況の表示（安全なアクセス）
+                usage_data = formatted.get('usage', {})
+                if usage_data and isinstance(usage_data, dict):
+                    st.write("**トークン使用量**")
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        prompt_tokens = usage_data.get('prompt_tokens', usage_data.get('input_tokens', 0)) or 0
+                        st.metric("入力", prompt_tokens)
+                    with col2:
+                        completion_tokens = usage_data.get('completion_tokens', usage_data.get('output_tokens', 0)) or 0
+                        st.metric("出力", completion_tokens)
+                    with col3:
+                        total_tokens = usage_data.get('total_tokens', prompt_tokens + completion_tokens)
+                        st.metric("合計", total_tokens)
+
+                    # コスト計算
+                    model = formatted.get('model')
+                    if model and (prompt_tokens > 0 or completion_tokens > 0):
+                        try:
+                            cost = TokenManager.estimate_cost(
+                                prompt_tokens,
+                                completion_tokens,
+                                model
+                            )
+                            st.metric("推定コスト", f"${cost:.6f}")
+                        except Exception as e:
+                            st.error(f"コスト計算エラー: {e}")
+
+                # レスポンス情報
+                st.write("**レスポンス情報**")
+                info_data = {
+                    "ID"      : formatted.get('id', 'N/A'),
+                    "モデル"  : formatted.get('model', 'N/A'),
+                    "作成日時": formatted.get('created_at', 'N/A')
+                }
+                if formatted.get('stop_reason'):
+                    info_data["停止理由"] = formatted['stop_reason']
+                if formatted.get('elapsed') is not None:
+                    info_data["所要時間"] = f"{formatted['elapsed']:.2f}s"
+
+                for key, value in info_data.items():
+                    st.write(f"- **{key}**: {value}")
+
+                # Raw JSON表示（安全なJSON処理）
+                if show_raw:
+                    st.write("**Raw JSON**")
+                    safe_streamlit_json(formatted)
+
+                # ダウンロードボタン
+                try:
+                    UIHelper.create_download_button(
+                        formatted,
+                        f"response_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+                        "application/json",
+                        "📥 JSONダウンロード"
+                    )
                 except Exception as e:
-                    st.error(f"詳細情報表示エラー: {e}")
-                    logger.error(f"Response display error: {e}")
-                    if config.get("experimental.debug_mode", False):
-                        st.exception(e)
+                    st.error(f"ダウンロードボタン作成エラー: {e}")
+
+            except Exception as e:
+                st.error(f"詳細情報表示エラー: {e}")
+                logger.error(f"Response display error: {e}")
+                if config.get("experimental.debug_mode", False):
+                    st.exception(e)
+
+    @staticmethod
+    def is_streaming_enabled() -> bool:
+        """ストリーミング表示が有効か（設定パネルのユーザー設定 → config.yml の順）"""
+        default = config.get("ui.streaming_display", False) is True
+        preference = SessionStateManager.get_user_preference("streaming_display", default)
+        return preference if isinstance(preference, bool) else default
+
+    @staticmethod
+    def display_streaming_response(stream_manager, show_details: bool = True, show_raw: bool = False,
+                                   transient: bool = False) -> Response:
+        """ストリーミングレスポンスの逐次表示
+
+        `client.messages.stream(...)` の戻り値を受け取り、テキスト差分を到着順に描画しながら
+        TTFT と受信速度（差分チャンク/秒）を表示する。完了後は usage.output_tokens から算出した
+        tokens/sec を表示し、組み立て済みの最終Messageから詳細情報を表示して返す。
+        transient=True の場合は完了時に逐次表示を消去し、計測結果のみを残す
+        （呼び出し側で display_response する場合）。
+        """
+        placeholder = st.empty()
+        with placeholder.container():
+            st.subheader("🤖 回答")
+            stats_area = st.empty()
+            started = time.perf_counter()
+            timing = {'ttft': None, 'chunks': 0}
+
+            with stream_manager as stream:
+                def _text_deltas():
+                    last_update = 0.0
+                    for text in stream.text_stream:
+                        now = time.perf_counter()
+                        if timing['ttft'] is None:
+                            timing['ttft'] = now - started
+                        timing['chunks'] += 1
+                        # 表示更新は間引く（差分ごとの再描画を避ける）。トークン数は完了時の usage で確定する
+                        if now - last_update >= 0.25:
+                            generating = now - started - timing['ttft']
+                            rate = timing['chunks'] / generating if generating > 0 else 0.0
+                            stats_area.caption(f"⏱️ TTFT {timing['ttft']:.2f}s ・ {rate:.1f} chunks/s")
+                            last_update = now
+                        yield text
+
+                st.write_stream(_text_deltas())
+                response = stream.get_final_message()
+
+            elapsed = time.perf_counter() - started
+            ttft = timing['ttft'] if timing['ttft'] is not None else elapsed
+            output_tokens = getattr(getattr(response, 'usage', None), 'output_tokens', 0) or 0
+            generating = elapsed - ttft
+            rate = output_tokens / generating if generating > 0 else 0.0
+            summary = f"⏱️ TTFT {ttft:.2f}s ・ {rate:.1f} tokens/s（出力 {output_tokens} tokens）・ 合計 {elapsed:.2f}s"
+            if not transient:
+                stats_area.caption(summary)
+                if show_details:
+                    ResponseProcessorUI.display_details(response, show_raw=show_raw)
+
+        if transient:
+            placeholder.empty()
+            st.caption(summary)
+
+        return response
+
+    @staticmethod
+    def create_message(sdk_client, spinner_text: str = "処理中...", stream: bool = None,
+                       **params) -> Response:
+        """messages.create の呼び出し（ストリーミング表示へのオプトイン対応）
+
+        sdk_client は anthropic.Anthropic（AnthropicClient の場合は `.client`）を渡す。
+        stream=None の場合はユーザー設定に従う。ストリーミング時は差分を逐次表示し、
+        完了後にその表示を消して最終Messageを返すため、呼び出し側は従来どおり
+        display_response で結果を表示できる。
+        """
+        if stream is None:
+            stream = ResponseProcessorUI.is_streaming_enabled()
+
+        if not stream:
+            with st.spinner(spinner_text):
+                response = sdk_client.messages.create(**params)
+        else:
+            response = ResponseProcessorUI.display_streaming_response(
+                sdk_client.messages.stream(**params),
+                transient=True
+            )
+
+        SessionStateManager.get_usage_log().record_response(response)
+        return response
+
+
+# ==================================================
+# 画像一括解析UI
+# ==================================================
+class VisionBatchUI:
+    """画像フォルダの一括解析UI（a00・a03共通）"""
+
+    @staticmethod
+    def render(client: AnthropicClient, model: str, key_prefix: str, default_prompt: str = None):
+        """フォルダ・プロンプトを指定して一括解析し、結果を表とJSONLに逐次出力"""
+        directory = st.text_input(
+            "画像フォルダ",
+            value=config.get("paths.images_dir", "images"),
+            key=f"batch_dir_{key_prefix}"
+        )
+        prompt = st.text_area(
+            "全画像に共通のプロンプト",
+            value=default_prompt or "この画像に何が写っているか日本語で簡潔に説明してください。",
+            height=config.get("ui.text_area_height", 75),
+            key=f"batch_prompt_{key_prefix}"
+        )
+        concurrency = st.slider(
+            "同時リクエスト数", 1, 16,
+            value=config.get("batch.max_concurrency", 4),
+            key=f"batch_concurrency_{key_prefix}"
+        )
+
+        paths = VisionBatchProcessor.list_images(directory)
+        st.caption(f"対象画像: {len(paths)} 枚")
+        if not st.button("🚀 一括解析", key=f"batch_run_{key_prefix}", disabled=not paths):
+            return
+
+        import pandas as pd
+
+        processor = VisionBatchProcessor(client, model=model, max_concurrency=concurrency)
+        output_path = VisionBatchProcessor.default_output_path()
+        progress = st.progress(0.0)
+        table = st.empty()
+        rows = []
+        for row in processor.run(paths, prompt, output_path):
+            rows.append(row)
+            progress.progress(len(rows) / len(paths), text=f"{len(rows)}/{len(paths)} {row['file']}")
+            table.dataframe(pd.DataFrame(rows).drop(columns=['answer']), use_container_width=True)
+
+        ok_rows = [row for row in rows if row['status'] == 'ok']
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("成功", f"{len(ok_rows)}/{len(rows)}")
+        with col2:
+            latencies = [row['latency_sec'] for row in ok_rows]
+            st.metric("平均レイテンシ", f"{sum(latencies) / len(latencies):.2f}s" if latencies else "-")
+        with col3:
+            st.metric("入力/出力トークン", f"{sum(r['input_tokens'] for r in rows):,} / "
+                                           f"{sum(r['output_tokens'] for r in rows):,}")
+        with col4:
+            st.metric("推定コスト", f"${sum(r['cost_usd'] for r in rows):.4f}")
+
+        for row in ok_rows:
+            with st.expander(f"🖼️ {row['file']}", expanded=False):
+                st.markdown(row['answer'])
+
+        st.caption(f"📄 結果JSONL: {output_path}")
+        st.download_button(
+            "📥 結果JSONLダウンロード",
+            data=output_path.read_bytes() if output_path.exists() else b"",
+            file_name=output_path.name,
+            mime="application/jsonl",
+            key=f"batch_download_{key_prefix}"
+        )
 
 
 # ==================================================
@@ -766,7 +1073,7 @@ class DemoBase(ABC):
 
     def display_messages(self):
         """メッセージの表示"""
-        messages = self.message_manager.get_messages()
+        messages = self.message_manager.snapshot()
         UIHelper.display_messages(messages)
 
     def add_user_message(self, content: str):
@@ -948,30 +1255,61 @@ class InfoPanelManager:
             monthly_cost = total_cost * daily_calls * 30
             st.info(f"月間推定: ${monthly_cost:.2f}")
 
+            InfoPanelManager._show_cost_comparison(selected_model, input_tokens, output_tokens, daily_calls)
+
+    @staticmethod
+    def _show_cost_comparison(selected_model: str, input_tokens: int, output_tokens: int, daily_calls: int):
+        """全モデルのコスト比較（入力値・記録済み使用量）"""
+        simulator = CostSimulator()
+        if not simulator.models:
+            return
+
+        if st.checkbox("全モデルで比較", key="cost_compare_models"):
+            monthly = simulator.cost_matrix([input_tokens, output_tokens])[0] * daily_calls * 30
+            st.dataframe(
+                [{"モデル": model, "月間推定": f"${cost:,.2f}", "選択中": "✓" if model == selected_model else ""}
+                 for model, cost in sorted(zip(simulator.models, monthly), key=lambda item: item[1])],
+                use_container_width=True,
+                hide_index=True
+            )
+
+        session_log = SessionStateManager.get_usage_log()
+        if len(session_log) and st.checkbox(f"記録済み使用量で試算（このセッションの {len(session_log):,} リクエスト）",
+                                            key="cost_compare_recorded"):
+            result = simulator.compare_log(session_log)
+            if result["actual"] is not None:
+                st.write(f"**実績コスト**: ${result['actual']:.4f}")
+            rows = []
+            for i, model in enumerate(result["models"]):
+                row = {"モデル": model, "総コスト": f"${result['totals'][i]:.4f}"}
+                if result["actual"] is not None:
+                    row["実績との差"] = f"${result['totals'][i] - result['actual']:+.4f}"
+                if result["projection"] is not None:
+                    row["月間推定"] = f"${result['projection'][i]:,.2f}"
+                rows.append(row)
+            st.dataframe(rows, use_container_width=True, hide_index=True)
+
     @staticmethod
     def show_performance_info():
-        """パフォーマンス情報パネル"""
-        metrics = SessionStateManager.get_performance_metrics()
-        if not metrics:
+        """パフォーマンス情報パネル（集計済みの統計を表示するためO(1)）"""
+        tracker = SessionStateManager.get_performance_tracker()
+        latest = tracker.latest()
+        if not latest:
             return
 
+        overall = tracker.overall
         with st.sidebar.expander("⚡ パフォーマンス", expanded=False):
-            recent_metrics = metrics[-5:]
-            if recent_metrics:
-                avg_time = sum(m['execution_time'] for m in recent_metrics) / len(recent_metrics)
-                max_time = max(m['execution_time'] for m in recent_metrics)
-                min_time = min(m['execution_time'] for m in recent_metrics)
-
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.write("平均", f"{avg_time:.2f}s")
-                    st.write("最大", f"{max_time:.2f}s")
-                with col2:
-                    st.write("最小", f"{min_time:.2f}s")
-                    st.write("実行回数", len(metrics))
+            col1, col2 = st.columns(2)
+            with col1:
+                st.write("平均", f"{overall.avg_time:.2f}s")
+                st.write("p50", f"{overall.quantile(0.5):.2f}s")
+                st.write("最大", f"{overall.max_time:.2f}s")
+            with col2:
+                st.write("p95", f"{overall.quantile(0.95):.2f}s")
+                st.write("p99", f"{overall.quantile(0.99):.2f}s")
+                st.write("実行回数", tracker.total_count)
 
-                latest = recent_metrics[-1]
-                st.write(f"**最新実行**: {latest['function']} ({latest['execution_time']:.2f}s)")
+            st.write(f"**最新実行**: {latest['function']} ({latest['execution_time']:.2f}s)")
 
     @staticmethod
     def show_debug_panel():
@@ -1006,6 +1344,47 @@ class InfoPanelManager:
                 cache.clear()
                 st.success("キャッシュをクリアしました")
 
+            InfoPanelManager._show_memory_usage()
+
+    @staticmethod
+    def _show_memory_usage():
+        """セッション・プロセスのメモリ使用量"""
+        st.write("**メモリ使用量**")
+        try:
+            rows = SessionStateManager.account_memory(force=True)
+            accountant = SessionStateManager.get_memory_accountant()
+
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("このセッション", format_bytes(accountant.last_total))
+            with col2:
+                st.metric("上限", format_bytes(accountant.cap_bytes))
+            if accountant.last_total > accountant.cap_bytes:
+                st.warning("⚠️ 上限を超えていますが、残りは自動では破棄しない値（会話ログ・レスポンス等）です。"
+                           "不要な会話履歴をクリアしてください。")
+
+            if rows:
+                st.dataframe(
+                    [{"キー": row["key"], "型": row["type"], "サイズ": format_bytes(row["size"]),
+                      "破棄対象": "✓" if row["evictable"] else ""} for row in rows[:15]],
+                    use_container_width=True,
+                    hide_index=True
+                )
+
+            summary = session_memory.summary()
+            st.write(f"- セッション数: {summary['sessions']}")
+            st.write(f"- 全セッション合計: {format_bytes(summary['total_bytes'])}"
+                     f"（最大 {format_bytes(summary['max_bytes'])}）")
+            if summary['rss_bytes'] is not None:
+                st.write(f"- プロセスRSS: {format_bytes(summary['rss_bytes'])}")
+
+            if accountant.evicted:
+                st.caption("直近の破棄: " + ", ".join(
+                    f"{item['key']} ({format_bytes(item['size'])})" for item in list(accountant.evicted)[-5:]
+                ))
+        except Exception as e:
+            st.error(f"メモリ計測エラー: {e}")
+
     @staticmethod
     def show_settings():
         """設定パネル"""
@@ -1028,6 +1407,15 @@ class InfoPanelManager:
             )
             config.set("experimental.performance_monitoring", perf_monitoring)
 
+            # ストリーミング表示（設定はこのウィジェットのみで変更する）
+            streaming = st.checkbox(
+                "ストリーミング表示",
+                value=ResponseProcessorUI.is_streaming_enabled(),
+                key="setting_streaming_display",
+                help="回答を生成しながら逐次表示（TTFT・tokens/sec を表示）"
+            )
+            SessionStateManager.set_user_preference("streaming_display", streaming)
+
             # キャッシュ管理
             st.write("**キャッシュ管理**")
             col1, col2 = st.columns(2)
@@ -1061,6 +1449,7 @@ __all__ = [
     'DemoBase',
     'SessionStateManager',
     'InfoPanelManager',
+    'VisionBatchUI',
 
     # デコレータ
     'error_handler_ui',
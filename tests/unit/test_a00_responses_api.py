@@ -498,6 +498,103 @@ class TestMemoryResponseDemo:
         # 代わりにinitializeが呼ばれたか確認
         mock_setup_ui.assert_called()
 
+    @staticmethod
+    def _bare_demo():
+        """__init__ を通さない MemoryResponseDemo（会話ステップ処理のみ検証）"""
+        from a00_responses_api import MemoryResponseDemo
+        from helper_api import ConversationLog
+
+        demo = MemoryResponseDemo.__new__(MemoryResponseDemo)
+        demo.safe_key = "memory_response_demo"
+        demo.model = "claude-sonnet-4-20250514"
+        demo.conversation_steps = []
+        demo.conversation_log = ConversationLog()
+        return demo
+
+    @patch('a00_responses_api.ResponseProcessorUI')
+    def test_steps_share_message_log(self, mock_processor_ui, mock_streamlit):
+        """各ステップは共有ログ上の範囲のみを持ち、送信内容を再構成できる"""
+        from helper_api import ResponseRecord
+
+        mock_streamlit.session_state = {}
+        demo = self._bare_demo()
+        sent = []
+
+        def fake_call(messages, **kwargs):
+            sent.append([dict(m) for m in messages])
+            return ResponseRecord(texts=(f"回答{len(sent)}",))
+
+        with patch.object(demo, 'call_api_unified', side_effect=fake_call):
+            demo._process_conversation_step("質問1", None)
+            demo._process_conversation_step("質問2", None)
+
+        assert all('messages_at_step' not in step for step in demo.conversation_steps)
+        assert demo._messages_at_step(demo.conversation_steps[0]) == sent[0]
+        assert demo._messages_at_step(demo.conversation_steps[1]) == sent[1]
+        assert len(demo.conversation_log) == len(sent[1]) + 1
+
+    @patch('a00_responses_api.ResponseProcessorUI')
+    def test_failed_step_rolls_back_question(self, mock_processor_ui, mock_streamlit):
+        """API呼び出しが失敗（None）した質問はビルダーから取り消される"""
+        from helper_api import ResponseRecord
+
+        mock_streamlit.session_state = {}
+        demo = self._bare_demo()
+
+        with patch.object(demo, 'call_api_unified', return_value=ResponseRecord(texts=("回答1",))):
+            demo._process_conversation_step("質問1", None)
+        sent_before = demo._get_message_builder().plain_messages()
+
+        with patch.object(demo, 'call_api_unified', return_value=None):
+            demo._process_conversation_step("質問2", None)
+
+        assert demo._get_message_builder().plain_messages() == sent_before
+        assert len(demo.conversation_steps) == 1
+
+    @patch('a00_responses_api.ResponseProcessorUI')
+    def test_replace_import_rebuilds_builder(self, mock_processor_ui, mock_streamlit):
+        """同じステップ数の履歴で置換インポートしても、次の送信はインポートした履歴になる"""
+        import io
+        from helper_api import ResponseRecord
+
+        mock_streamlit.session_state = {}
+        demo = self._bare_demo()
+        with patch.object(demo, 'call_api_unified', return_value=ResponseRecord(texts=("旧回答",))):
+            demo._process_conversation_step("旧質問", None)
+
+        data = {
+            "conversation_steps": [{"user_input": "新質問", "assistant_response": "新回答", "log_range": [0, 1]}],
+            "message_log": [{"role": "user", "content": "新質問"}],
+        }
+        mock_streamlit.radio = MagicMock(return_value="現在の履歴を置換")
+        mock_streamlit.button = MagicMock(return_value=True)
+        demo._import_conversation(io.BytesIO(json.dumps(data).encode("utf-8")))
+
+        sync = mock_streamlit.session_state[f"conversation_sync_{demo.safe_key}"]
+        assert sync['log_start'] is None
+        messages = demo._build_conversation_messages("次の質問")
+        contents = [msg["content"] for msg in messages]
+        assert "旧質問" not in contents and "旧回答" not in contents
+        assert contents[-3:] == ["新質問", "新回答", "次の質問"]
+
+    def test_import_offsets_log_ranges(self, mock_streamlit):
+        """インポート時はログ範囲を付け替え、旧形式のステップも変換する"""
+        demo = self._bare_demo()
+        demo.conversation_log.extend([{"role": "user", "content": "既存"}])
+
+        message_log = [{"role": "user", "content": "u1"}, {"role": "assistant", "content": "a1"}]
+        legacy_messages = [{"role": "user", "content": "old"}]
+        demo._append_imported_steps(
+            [{"user_input": "u1", "log_range": [0, 1]},
+             {"user_input": "old", "messages_at_step": legacy_messages}],
+            message_log
+        )
+
+        assert demo.conversation_steps[0]["log_range"] == [1, 2]
+        assert demo._messages_at_step(demo.conversation_steps[0]) == [{"role": "user", "content": "u1"}]
+        assert demo._messages_at_step(demo.conversation_steps[1]) == legacy_messages
+        assert "messages_at_step" not in demo.conversation_steps[1]
+
 
 # ==================================================
 # ImageResponseDemoのテスト
@@ -741,6 +838,23 @@ class TestWeatherDemo:
             assert demo.demo_name == "Weather API Demo"
 
 
+    @patch('a00_responses_api.requests')
+    def test_weather_response_shared_across_sessions(self, mock_requests, mock_streamlit):
+        """同じ座標の天気APIレスポンスはセッション間共有キャッシュから再利用する"""
+        from a00_responses_api import fetch_openweather
+        from helper_api import shared_cache
+
+        shared_cache.clear()
+        mock_requests.get.return_value.json.return_value = {"name": "Tokyo"}
+
+        for session in ({}, {}):
+            mock_streamlit.session_state = session
+            assert fetch_openweather("weather", 35.69, 139.69) == {"name": "Tokyo"}
+        fetch_openweather("forecast", 35.69, 139.69)
+
+        assert mock_requests.get.call_count == 2
+        shared_cache.clear()
+
 # ==================================================
 # DemoManagerのテスト
 # ==================================================
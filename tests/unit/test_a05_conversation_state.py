@@ -230,6 +230,30 @@ class TestConversationUtilities:
         # 履歴のクリア
         manager.clear_history()
         assert len(manager.get_history()) == 0
+
+    def test_api_messages_incremental(self):
+        """送信用メッセージ列はuserから始まり、追加分のみ反映される"""
+        from a05_conversation_state import ConversationHistoryManager
+        from helper_api import TokenManager
+
+        manager = ConversationHistoryManager(max_length=100)
+        with patch.object(TokenManager, '_encode_count', side_effect=lambda text, enc: len(text.split())):
+            for i in range(6):
+                manager.add_message("user", f"q{i}")
+                manager.add_message("assistant", f"a{i}")
+            first = manager.get_api_messages(limit=5)
+            manager.add_message("user", "q6")
+            second = manager.get_api_messages(limit=5)
+
+        assert second is first
+        assert second[0]["role"] == "user"
+        assert all(set(m) == {"role", "content"} for m in second)
+        assert second[-1]["content"] == "q6"
+        assert len(second) <= 5
+
+        # 履歴の置き換え後は再構築される
+        manager.history = [{"role": "user", "content": "x", "timestamp": "t"}]
+        assert manager.get_api_messages(limit=5) == [{"role": "user", "content": "x"}]
     
     def test_conversation_state_persistence(self, sample_conversation_history):
         """会話状態の永続化テスト"""
@@ -594,12 +618,17 @@ class TestMainApp:
                            mock_session_manager, mock_streamlit):
         """メイン関数のエラーハンドリングテスト"""
         from a05_conversation_state import main
-        
+        from helper_api import PerformanceTracker
+
         # SessionStateManagerのモック設定 - 空でないメトリクスを返す
         mock_session_manager.get_performance_metrics.return_value = [
             {'execution_time': 0.1, 'tokens': 100, 'function': 'test_func1'},
             {'execution_time': 0.2, 'tokens': 200, 'function': 'test_func2'}
         ]
+        tracker = PerformanceTracker(buffer_size=10)
+        tracker.record('test_func1', 0.1)
+        tracker.record('test_func2', 0.2)
+        mock_session_manager.get_performance_tracker.return_value = tracker
         
         # helper_st.stのモック設定
         mock_helper_st.sidebar.expander.return_value.__enter__.return_value = MagicMock()
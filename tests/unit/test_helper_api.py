@@ -0,0 +1,1606 @@
+# tests/unit/test_helper_api.py
+# --------------------------------------------------
+# helper_api.py の単体テスト
+# Streamlitに依存しない共通機能（計測・キャッシュ等）のテスト
+# --------------------------------------------------
+
+import sys
+import time
+import random
+import json
+import threading
+import base64
+import io
+import math
+import pickle
+import pytest
+import numpy as np
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+# プロジェクトルートをパスに追加
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from helper_api import (
+    StreamingQuantile,
+    PerformanceStats,
+    PerformanceTracker,
+    LRUCache,
+    DiskCache,
+    make_cache_key,
+    MessageHistory,
+    ConversationLog,
+    ConversationBuilder,
+    ConversationCompactor,
+    ResponseProcessor,
+    ResponseRecord,
+    TokenManager,
+    MemoryAccountant,
+    SessionMemoryRegistry,
+    deep_sizeof,
+    UsageLog,
+    CostSimulator,
+    Base64Payload,
+    ImageEncoder,
+    AnimationSampler,
+    PerceptualHash,
+    ImagePayloadCache,
+    VisionBatchProcessor,
+    VisionRequestPacker,
+    URLImagePrefetcher,
+    ImageDirectoryIndex,
+    CityIndex,
+    CitySpatialIndex,
+)
+
+
+# ==================================================
+# パフォーマンス計測のテスト
+# ==================================================
+class TestStreamingQuantile:
+    """P²分位点推定のテスト"""
+
+    def test_invalid_quantile(self):
+        """範囲外の分位点はエラー"""
+        with pytest.raises(ValueError):
+            StreamingQuantile(1.0)
+
+    def test_empty(self):
+        """観測なしの場合はNone"""
+        assert StreamingQuantile(0.5).value() is None
+
+    def test_few_samples(self):
+        """5件以下は実測値から算出"""
+        q = StreamingQuantile(0.5)
+        for v in [3.0, 1.0, 2.0]:
+            q.add(v)
+        assert q.value() == 2.0
+
+    @pytest.mark.parametrize("p", [0.5, 0.95, 0.99])
+    def test_accuracy_uniform(self, p):
+        """一様分布での推定精度"""
+        rng = random.Random(42)
+        values = [rng.random() for _ in range(20000)]
+        q = StreamingQuantile(p)
+        for v in values:
+            q.add(v)
+        exact = sorted(values)[int(p * (len(values) - 1))]
+        assert q.value() == pytest.approx(exact, abs=0.02)
+
+    def test_accuracy_long_tail(self):
+        """裾の重い分布（レイテンシ想定）でのp95推定"""
+        rng = random.Random(0)
+        values = [rng.lognormvariate(0, 1) for _ in range(20000)]
+        q = StreamingQuantile(0.95)
+        for v in values:
+            q.add(v)
+        exact = sorted(values)[int(0.95 * (len(values) - 1))]
+        assert q.value() == pytest.approx(exact, rel=0.05)
+
+
+class TestPerformanceTracker:
+    """パフォーマンストラッカーのテスト"""
+
+    def test_record_and_summary(self):
+        """関数別に集計される"""
+        tracker = PerformanceTracker(buffer_size=10)
+        tracker.record("func_a", 1.0)
+        tracker.record("func_a", 3.0)
+        tracker.record("func_b", 2.0)
+
+        assert tracker.total_count == 3
+        stats = tracker.get_stats("func_a")
+        assert stats.count == 2
+        assert stats.avg_time == 2.0
+        assert stats.min_time == 1.0
+        assert stats.max_time == 3.0
+        assert tracker.summaries()[0]['function'] == "func_a"
+        assert tracker.latest()['function'] == "func_b"
+
+    def test_memory_is_bounded(self):
+        """記録数が増えても保持サンプル数は一定"""
+        tracker = PerformanceTracker(buffer_size=50)
+        for i in range(5000):
+            tracker.record(f"func_{i % 3}", i * 0.001)
+
+        assert tracker.total_count == 5000
+        assert len(tracker.recent()) == 50
+        for name in ("func_0", "func_1", "func_2"):
+            assert len(tracker.get_stats(name).recent) == 50
+        assert tracker.recent(5)[-1]['execution_time'] == pytest.approx(4.999)
+
+    def test_unsupported_quantile(self):
+        """未定義の分位点はエラー"""
+        stats = PerformanceStats("func")
+        stats.record(1.0)
+        with pytest.raises(ValueError):
+            stats.quantile(0.75)
+
+    def test_clear(self):
+        """クリアで初期状態に戻る"""
+        tracker = PerformanceTracker(buffer_size=10)
+        tracker.record("func", 1.0)
+        tracker.clear()
+        assert tracker.total_count == 0
+        assert tracker.latest() is None
+        assert tracker.summaries() == []
+
+
+# ==================================================
+# キャッシュのテスト
+# ==================================================
+class TestLRUCache:
+    """LRUキャッシュのテスト"""
+
+    def test_lru_eviction(self):
+        """最も使われていないエントリから削除される"""
+        lru = LRUCache(max_size=2, ttl=60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        assert lru.get("a") == 1
+        lru.set("c", 3)
+
+        assert "a" in lru
+        assert "b" not in lru
+        assert len(lru) == 2
+
+    def test_ttl_expiry(self):
+        """呼び出し側TTLで期限切れ判定できる"""
+        lru = LRUCache(max_size=10, ttl=60)
+        lru.set("a", 1)
+        assert lru.get("a", ttl=60) == 1
+        assert lru.get("a", "missing", ttl=-1) == "missing"
+        assert "a" not in lru
+
+    def test_none_value_is_cached(self):
+        """Noneも正規の値としてキャッシュされる"""
+        lru = LRUCache()
+        sentinel = object()
+        lru.set("a", None)
+        assert lru.get("a", sentinel) is None
+        assert lru.hits == 1
+
+
+class TestDiskCache:
+    """ディスクキャッシュのテスト"""
+
+    def test_roundtrip_and_reload(self, tmp_path):
+        """保存した値が別インスタンスから読める"""
+        DiskCache(tmp_path, max_size=10).set("key", {"value": 1})
+        assert DiskCache(tmp_path, max_size=10).get("key") == {"value": 1}
+
+    def test_size_bounded(self, tmp_path):
+        """件数上限を超えると古いものから削除"""
+        disk = DiskCache(tmp_path, max_size=3)
+        for i in range(5):
+            disk.set(f"key_{i}", i)
+
+        assert disk.size() == 3
+        assert len(list(tmp_path.glob("*.pkl"))) == 3
+        assert disk.get("key_0") is None
+        assert disk.get("key_4") == 4
+
+    def test_clear(self, tmp_path):
+        """クリアでファイルも削除"""
+        disk = DiskCache(tmp_path)
+        disk.set("key", 1)
+        disk.clear()
+        assert disk.size() == 0
+        assert not list(tmp_path.glob("*.pkl"))
+
+    def test_bytes_bounded(self, tmp_path):
+        """合計バイト数の上限を超えると古いものから削除"""
+        disk = DiskCache(tmp_path, max_size=100, max_bytes=25_000)
+        for i in range(5):
+            disk.set(f"key_{i}", b"x" * 10_000)
+
+        assert disk.total_bytes <= 25_000
+        assert disk.get("key_0") is None
+        assert disk.get("key_4") is not None
+        assert DiskCache(tmp_path).size() == disk.size()
+
+
+class TestMakeCacheKey:
+    """キャッシュキー生成のテスト"""
+
+    def test_kwargs_order_independent(self):
+        """キーワード引数の順序に依存しない"""
+        assert make_cache_key("f", (1,), {"a": 1, "b": 2}) == make_cache_key("f", (1,), {"b": 2, "a": 1})
+
+    def test_distinguishes_functions_and_args(self):
+        """関数名・引数が異なればキーも異なる"""
+        assert make_cache_key("f", (1,)) != make_cache_key("g", (1,))
+        assert make_cache_key("f", (1,)) != make_cache_key("f", (2,))
+
+
+# ==================================================
+# メモリ計測のテスト
+# ==================================================
+class TestDeepSizeof:
+    """deep_sizeof のテスト"""
+
+    def test_counts_nested_values(self):
+        """コンテナ内の値も数える"""
+        payload = "x" * 100_000
+        assert deep_sizeof({"data": [payload]}) > 100_000
+        assert deep_sizeof({"data": []}) < 1_000
+
+    def test_slots_and_shared_seen(self):
+        """__slots__ を辿り、seen共有時は重複して数えない"""
+        record = ResponseRecord(texts=("y" * 50_000,))
+        assert deep_sizeof(record) > 50_000
+
+        seen = set()
+        first = deep_sizeof(record, seen)
+        assert deep_sizeof(record, seen) == 0
+        assert first > 50_000
+
+    def test_only_payload_types_traversed_and_capped(self):
+        """ペイロード型以外（クライアント等）の参照先は辿らず、max_bytes で打ち切る"""
+        class Client:
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.buffer = "z" * 100_000
+
+        assert deep_sizeof(Client()) < 10_000
+        assert deep_sizeof(np.zeros(10_000)) >= 80_000
+
+        payload = ["a" * 10_000 for _ in range(100)]
+        assert deep_sizeof(payload, max_bytes=50_000) < 100_000
+
+
+class TestMemoryAccountant:
+    """MemoryAccountant のテスト"""
+
+    def make_accountant(self, cap):
+        return MemoryAccountant(cap_bytes=cap, min_evict_bytes=1_000,
+                                evictable_keys=["results_cache_*", "ui_cache"],
+                                rebuildable_keys=["conversation_builder_*"])
+
+    def test_under_cap_keeps_everything(self):
+        state = {"results_cache_a": {"k": "a" * 10_000}}
+        assert self.make_accountant(10**9).enforce(state) == []
+        assert state["results_cache_a"]
+
+    def test_evicts_least_recently_used_evictable(self):
+        """上限超過時は指定されたキャッシュのうち古いものから中身をクリアする"""
+        accountant = self.make_accountant(150_000)
+        state = {
+            "results_cache_old": {"k": "o" * 100_000},
+            "messages_chat": "m" * 100_000,
+        }
+        accountant.measure(state)
+        with patch('helper_api.time.time', return_value=time.time() + 10):
+            state["results_cache_new"] = {"k": "n" * 20_000}
+            evicted = accountant.enforce(state)
+
+        assert evicted == ["results_cache_old"]
+        assert state["results_cache_old"] == {}
+        assert "messages_chat" in state
+        assert state["results_cache_new"]
+
+    def test_display_state_never_evicted(self):
+        """指定外のキー・キャッシュ以外の値（表示に必要なレスポンス等）は破棄しない"""
+        accountant = self.make_accountant(1_000)
+        state = {
+            "initial_response_demo": ResponseRecord(texts=("r" * 50_000,)),
+            "follow_up_response_demo": "f" * 50_000,
+            "results_cache_text": "not a cache" * 1_000,
+        }
+        assert accountant.enforce(state) == []
+        assert set(state) == {"initial_response_demo", "follow_up_response_demo", "results_cache_text"}
+
+    def test_rebuildable_value_is_deleted(self):
+        """再構築される値（送信用ビルダー）はキーごと削除し、会話ログは残す"""
+        accountant = self.make_accountant(60_000)
+        builder = ConversationBuilder([{"role": "user", "content": "b" * 50_000}], model="claude-sonnet-4-20250514")
+        state = {
+            "conversation_builder_demo": builder,
+            "conversation_log_demo": [{"role": "user", "content": "l" * 50_000}],
+        }
+
+        assert accountant.enforce(state) == ["conversation_builder_demo"]
+        assert set(state) == {"conversation_log_demo"}
+
+    def test_lru_cache_is_cleared_not_deleted(self):
+        """LRUCache の値はキーを残してクリアする"""
+        accountant = self.make_accountant(10_000)
+        ui_cache = LRUCache(max_size=10, ttl=3600)
+        ui_cache.set("k", "v" * 50_000)
+        state = {"ui_cache": ui_cache}
+
+        assert accountant.enforce(state) == ["ui_cache"]
+        assert state["ui_cache"] is ui_cache
+        assert ui_cache.size() == 0
+
+
+class TestSessionMemoryRegistry:
+    """SessionMemoryRegistry のテスト"""
+
+    def test_summary(self):
+        registry = SessionMemoryRegistry(ttl=60)
+        registry.update("a", 100)
+        registry.update("b", 300)
+        registry.update("a", 200)
+
+        summary = registry.summary()
+        assert summary["sessions"] == 2
+        assert summary["total_bytes"] == 500
+        assert summary["max_bytes"] == 300
+
+    def test_stale_sessions_expire(self):
+        registry = SessionMemoryRegistry(ttl=60)
+        registry.update("a", 100)
+        with patch('helper_api.time.time', return_value=time.time() + 120):
+            assert registry.summary()["sessions"] == 0
+
+
+# ==================================================
+# コスト試算のテスト
+# ==================================================
+PRICING = {
+    "model-a": {"input": 0.003, "output": 0.015},
+    "model-b": {"input": 0.00025, "output": 0.00125, "cache_read": 0.0001, "cache_write": 0.0005},
+}
+
+
+class TestCostSimulator:
+    """UsageLog / CostSimulator のテスト"""
+
+    def test_matches_estimate_cost(self):
+        """入力・出力のみの場合は estimate_cost と一致する"""
+        simulator = CostSimulator()
+        costs = simulator.cost_matrix([[1000, 500], [2000, 0]])
+
+        assert costs.shape == (2, len(simulator.models))
+        for model, j in simulator.model_index.items():
+            assert costs[0, j] == pytest.approx(TokenManager.estimate_cost(1000, 500, model))
+            assert costs[1, j] == pytest.approx(TokenManager.estimate_cost(2000, 0, model))
+
+    def test_cache_pricing(self):
+        """キャッシュ単価は指定値、未指定時は入力単価の倍率"""
+        simulator = CostSimulator(PRICING)
+        costs = simulator.cost_matrix([[0, 0, 1000, 1000]])[0]
+
+        assert costs[0] == pytest.approx(0.003 * 0.1 + 0.003 * 1.25)
+        assert costs[1] == pytest.approx(0.0001 + 0.0005)
+
+    def test_compare_log(self):
+        """実績コスト・月間推定を算出する"""
+        log = UsageLog(max_entries=10)
+        start = 1_700_000_000.0
+        log.record("model-a", {"input_tokens": 1000, "output_tokens": 1000}, timestamp=start)
+        log.record("model-b", {"input_tokens": 1000, "output_tokens": 1000}, timestamp=start + 86400)
+
+        result = CostSimulator(PRICING).compare_log(log, days=30)
+
+        assert result["requests"] == 2
+        assert result["actual"] == pytest.approx(0.018 + 0.0015)
+        assert result["totals"][0] == pytest.approx(0.036)
+        assert result["projection"][0] == pytest.approx(0.036 * 30)
+
+    def test_usage_log_bounded(self):
+        log = UsageLog(max_entries=3)
+        for i in range(5):
+            log.record("model-a", {"input_tokens": i})
+        models, timestamps, tokens = log.to_arrays()
+        assert len(log) == 3
+        assert tokens[:, 0].tolist() == [2, 3, 4]
+
+    def test_usage_log_resolver_routes_per_session(self):
+        """記録先はリゾルバが返すログ（解決できなければ記録しない）"""
+        first, second = UsageLog(), UsageLog()
+        current = {"log": first}
+        previous = UsageLog._resolver
+        response = MagicMock(model="model-a", usage={"input_tokens": 10, "output_tokens": 5})
+        try:
+            UsageLog.set_resolver(lambda: current["log"])
+            UsageLog.record_current(response)
+            current["log"] = second
+            UsageLog.record_current(response)
+            UsageLog.record_current(response)
+            current["log"] = None
+            UsageLog.record_current(response)
+        finally:
+            UsageLog.set_resolver(previous)
+
+        assert len(first) == 1
+        assert len(second) == 2
+
+
+# ==================================================
+# メッセージ履歴のテスト
+# ==================================================
+class TestMessageHistory:
+    """MessageHistory のテスト"""
+
+    def test_trim_keeps_pinned(self):
+        """上限超過時は古い順に破棄し、developerメッセージは保持する"""
+        history = MessageHistory([{"role": "developer", "content": "sys"}], limit=3)
+        for i in range(5):
+            history.append({"role": "user", "content": str(i)})
+
+        messages = history.to_list()
+        assert messages[0] == {"role": "developer", "content": "sys"}
+        assert [m["content"] for m in messages[1:]] == ["2", "3", "4"]
+        assert len(history) == 4
+
+    def test_later_system_messages_appended(self):
+        """先頭以外の system/developerメッセージは固定メッセージを置き換えず、追加順に保持する"""
+        history = MessageHistory([{"role": "developer", "content": "sys"}], limit=5)
+        history.append({"role": "user", "content": "q"})
+        history.append({"role": "system", "content": "new"})
+
+        assert [m["content"] for m in history.snapshot()] == ["sys", "q", "new"]
+        assert history.pinned == {"role": "developer", "content": "sys"}
+
+        unpinned = MessageHistory([{"role": "user", "content": "q"}], limit=5)
+        unpinned.append({"role": "system", "content": "later"})
+        assert unpinned.pinned is None
+        assert [m["content"] for m in unpinned.snapshot()] == ["q", "later"]
+
+    def test_snapshot_reused_until_changed(self):
+        """変更がなければ同じスナップショットを返す"""
+        history = MessageHistory([{"role": "user", "content": "a"}])
+        first = history.snapshot()
+        assert history.snapshot() is first
+
+        history.append({"role": "assistant", "content": "b"})
+        second = history.snapshot()
+        assert second is not first
+        assert len(second) == 2
+        assert isinstance(second, tuple)
+
+
+class TestConversationLog:
+    """ConversationLog のテスト"""
+
+    def test_slice_reconstructs_ranges(self):
+        log = ConversationLog([{"role": "user", "content": "d"}])
+        assert log.append({"role": "user", "content": "q"}) == 1
+        log.append({"role": "assistant", "content": "a"})
+
+        assert log.slice(0, 2) == [{"role": "user", "content": "d"}, {"role": "user", "content": "q"}]
+        assert len(log) == 3
+        log.clear()
+        assert len(log) == 0
+
+
+# ==================================================
+# レスポンス処理のテスト
+# ==================================================
+def make_message(text="こんにちは"):
+    from anthropic.types import Message
+    return Message.model_validate({
+        "id": "msg_test", "type": "message", "role": "assistant",
+        "model": "claude-sonnet-4-20250514",
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn", "stop_sequence": None,
+        "usage": {"input_tokens": 10, "output_tokens": 5},
+    })
+
+
+class TestResponseRecord:
+    """ResponseRecord / ResponseProcessor.to_record のテスト"""
+
+    def test_to_record(self):
+        """Messageから表示に必要な情報のみを抽出する"""
+        record = ResponseProcessor.to_record(make_message(), elapsed=1.5, spill=False)
+
+        assert record.texts == ("こんにちは",)
+        assert record.model == "claude-sonnet-4-20250514"
+        assert record.stop_reason == "end_turn"
+        assert record.usage == {"input_tokens": 10, "output_tokens": 5, "cache_read_input_tokens": 0,
+                                "cache_creation_input_tokens": 0, "total_tokens": 15}
+        assert record.elapsed == 1.5
+        assert record.raw_path is None
+        assert not hasattr(record, "__dict__")
+
+    def test_cache_usage_carried_to_usage_log(self):
+        """キャッシュの読み込み・書き込みトークンもレコード経由で使用量記録に残る"""
+        from anthropic.types import Message
+        message = Message.model_validate({
+            "id": "msg_cache", "type": "message", "role": "assistant", "model": "model-a",
+            "content": [{"type": "text", "text": "ok"}], "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": 10, "output_tokens": 5,
+                      "cache_read_input_tokens": 2000, "cache_creation_input_tokens": 300},
+        })
+        record = ResponseProcessor.to_record(message, spill=False)
+        log = UsageLog()
+        log.record_response(record)
+
+        _, _, tokens = log.to_arrays()
+        assert tokens[0].tolist() == [10, 5, 2000, 300]
+
+        # 追加前の形式でpickleされたレコードも読み込める
+        legacy = pickle.loads(pickle.dumps(record))
+        del legacy.cache_read_input_tokens
+        restored = pickle.loads(pickle.dumps(legacy))
+        assert restored.cache_read_input_tokens == 0 and restored.cache_creation_input_tokens == 300
+
+    def test_processor_compatibility(self):
+        """extract_text / format_response はレコードもそのまま扱える"""
+        record = ResponseProcessor.to_record(make_message("a"), spill=False)
+
+        assert ResponseProcessor.extract_text(record) == ["a"]
+        formatted = ResponseProcessor.format_response(record)
+        assert formatted["text"] == ["a"]
+        assert formatted["usage"]["total_tokens"] == 15
+        assert ResponseProcessor.to_record(record) is record
+
+    def test_spill_raw(self, tmp_path):
+        """spill=True の場合はRaw payloadをディスクに書き出す"""
+        import helper_api
+
+        original_get = helper_api.config.get
+        with patch.object(helper_api.config, 'get',
+                          side_effect=lambda k, d=None: str(tmp_path) if k == "paths.cache_dir" else original_get(k, d)):
+            record = ResponseProcessor.to_record(make_message(), spill=True)
+
+        assert record.raw_path is not None
+        assert Path(record.raw_path).parent == tmp_path / "responses"
+        raw = record.load_raw()
+        assert raw["content"][0]["text"] == "こんにちは"
+
+
+# ==================================================
+# トークン管理のテスト
+# ==================================================
+def fake_encode_count(text, encoding_name):
+    """tiktokenのエンコーディング取得（ネットワーク）を避けるための代替"""
+    return len(text.split())
+
+
+class TestTokenManagerMemo:
+    """トークン数メモ化のテスト"""
+
+    @pytest.fixture(autouse=True)
+    def clear_memo(self):
+        TokenManager._count_cache.clear()
+        yield
+        TokenManager._count_cache.clear()
+
+    def test_count_is_memoized(self):
+        """同一テキストは再トークナイズしない"""
+        text = "Anthropic APIのトークン数を数えます。" * 10
+        with patch.object(TokenManager, '_encode_count', side_effect=fake_encode_count) as encode:
+            first = TokenManager.count_tokens(text, "claude-3-5-haiku-20241022")
+            second = TokenManager.count_tokens(text, "claude-3-5-haiku-20241022")
+            # 同じエンコーディングのモデル間でも共有
+            third = TokenManager.count_tokens(text, "claude-sonnet-4-20250514")
+
+        assert first == second == third > 0
+        assert encode.call_count == 1
+
+    def test_async_large_text_reused_on_submit(self):
+        """長文はバックグラウンド計算され、送信時のcount_tokensで結果を再利用"""
+        text = "token " * 5000
+        with patch('helper_api.config.get', side_effect=lambda key, default=None:
+                   10 if key == "tokens.async_threshold" else default):
+            with patch.object(TokenManager, '_encode_count', side_effect=fake_encode_count) as encode:
+                preview = TokenManager.count_tokens_async(text)
+                submitted = TokenManager.count_tokens(text)
+                again = TokenManager.count_tokens_async(text)
+
+        assert preview is None or preview == submitted
+        assert again == submitted
+        assert encode.call_count == 1
+
+    def test_async_debounced_per_slot(self):
+        """入力中（テキストが変わり続ける間）は計算を開始せず、落ち着いてから1回だけ計算"""
+        settings = {"tokens.async_threshold": 10, "tokens.async_debounce": 0.5}
+        model = "claude-3-5-haiku-20241022"
+        clock = [100.0]
+        with patch('helper_api.config.get', side_effect=lambda key, default=None: settings.get(key, default)), \
+                patch('helper_api.time.monotonic', side_effect=lambda: clock[0]), \
+                patch.object(TokenManager, '_encode_count', side_effect=fake_encode_count) as encode:
+            for i in range(5):
+                assert TokenManager.count_tokens_async("token " * (100 + i), model, slot="typing") is None
+                clock[0] += 0.1
+            assert encode.call_count == 0
+
+            text = "token " * 104
+            clock[0] += 0.5
+            assert TokenManager.count_tokens_async(text, model, slot="typing") is None
+            key, _ = TokenManager._count_key(text, model)
+            future = TokenManager._pending_counts.get(key)
+            if future is not None:
+                future.result(timeout=5)
+            assert TokenManager.count_tokens_async(text, model, slot="typing") == 104
+            assert encode.call_count == 1
+
+    def test_short_text_sync(self):
+        """短いテキストは即座に返す"""
+        with patch.object(TokenManager, '_encode_count', side_effect=fake_encode_count):
+            assert TokenManager.count_tokens_async("hello world") == 2
+
+
+class TestConversationBuilder:
+    """ConversationBuilder のテスト"""
+
+    @pytest.fixture(autouse=True)
+    def fake_tokens(self):
+        TokenManager._count_cache.clear()
+        with patch.object(TokenManager, '_encode_count', side_effect=fake_encode_count):
+            yield
+        TokenManager._count_cache.clear()
+
+    def test_incremental_token_count(self):
+        """追加分のみカウントし、合計を維持する"""
+        builder = ConversationBuilder([{"role": "user", "content": "a b"}], cache_prefix=False)
+        builder.append("assistant", "c d e")
+        messages = builder.append("user", "f")
+
+        assert builder.total_tokens == 6
+        assert messages is builder.messages()
+        assert [m["content"] for m in messages] == ["a b", "c d e", "f"]
+
+    def test_cache_control_moves_with_prefix(self):
+        """最新のユーザーメッセージ直前にのみ cache_control を付与する"""
+        builder = ConversationBuilder(cache_prefix=True, min_cache_tokens=3)
+        builder.append("user", "one two")
+        assert builder.prefix_index is None
+
+        builder.append("assistant", "three four")
+        builder.append("user", "five")
+        assert builder.prefix_index == 1
+        marked = builder.messages()[1]["content"]
+        assert marked[-1]["cache_control"] == {"type": "ephemeral"}
+
+        builder.append("assistant", "six")
+        builder.append("user", "seven")
+        assert builder.prefix_index == 3
+        # 以前の位置は元の形に戻る
+        assert builder.messages()[1]["content"] == "three four"
+        assert all(isinstance(m["content"], str) for m in builder.plain_messages())
+
+    def test_below_threshold_not_marked(self):
+        builder = ConversationBuilder(cache_prefix=True, min_cache_tokens=100)
+        builder.extend([{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}])
+        builder.append("user", "c")
+        assert builder.prefix_index is None
+
+    def test_pop_rolls_back(self):
+        builder = ConversationBuilder([{"role": "user", "content": "a"}], cache_prefix=False)
+        builder.append("assistant", "b c")
+        builder.append("user", "d e f")
+        builder.pop()
+
+        assert len(builder) == 2
+        assert builder.total_tokens == 3
+
+    def test_trim_starts_with_user(self):
+        """上限超過時は先頭を破棄し、userメッセージから始める"""
+        builder = ConversationBuilder(max_messages=3, cache_prefix=False)
+        for i in range(3):
+            builder.append("user", f"u{i}")
+            builder.append("assistant", f"a{i}")
+
+        messages = builder.messages()
+        assert messages[0]["role"] == "user"
+        assert [m["content"] for m in messages] == ["u2", "a2"]
+        assert builder.total_tokens == 2
+
+    def test_trim_in_blocks_keeps_cached_prefix(self):
+        """キャッシュ有効時はまとめて破棄し、破棄の間のターンは前ターンの送信内容がプレフィックスになる"""
+        builder = ConversationBuilder(max_messages=10, cache_prefix=True, min_cache_tokens=0, trim_block=4)
+        previous = None
+        trims = 0
+        for i in range(12):
+            sent = [dict(m) for m in builder.append("user", f"u{i}")]
+            assert len(sent) <= 10 and sent[0]["role"] == "user"
+            plain = builder.plain_messages()
+            if previous is not None and plain[:len(previous)] != previous:
+                trims += 1
+            else:
+                assert builder.prefix_index == len(sent) - 2 or len(sent) == 1
+            builder.append("assistant", f"a{i}")
+            previous = builder.plain_messages()
+
+        # 1件ずつずらす場合は上限到達後に毎ターン先頭が変わる
+        assert trims <= 3
+
+    def test_replace_head_recounts_tokens(self):
+        builder = ConversationBuilder(cache_prefix=False)
+        for i in range(3):
+            builder.append("user", f"u{i} x")
+            builder.append("assistant", f"a{i} y")
+        builder.replace_head(4, [{"role": "user", "content": "summary"}])
+
+        assert [m["content"] for m in builder.messages()] == ["summary", "u2 x", "a2 y"]
+        assert builder.total_tokens == 5
+
+
+class FakeSummaryClient:
+    """要約呼び出しを記録するだけのクライアント"""
+
+    def __init__(self, text="要約です", error=None):
+        self.calls = []
+        self.messages = self
+        self._text = text
+        self._error = error
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if self._error:
+            raise self._error
+        return ResponseRecord(id="msg_s", model=kwargs["model"], texts=[self._text])
+
+
+class TestConversationCompactor:
+    """ConversationCompactor のテスト"""
+
+    def _history(self, turns):
+        history = []
+        for i in range(turns):
+            history.append({"role": "user", "content": f"質問{i}"})
+            history.append({"role": "assistant", "content": f"回答{i}"})
+        return history
+
+    def _wait(self, compactor, owner):
+        for _ in range(200):
+            result = compactor.poll(owner)
+            if result is not None or not compactor.pending:
+                return result
+            time.sleep(0.01)
+        return None
+
+    def test_below_threshold_not_submitted(self):
+        compactor = ConversationCompactor(model="fast", threshold_tokens=100, keep_messages=2)
+        client = FakeSummaryClient()
+        assert compactor.submit(client, self._history(4), 50) is False
+        assert not compactor.pending
+
+    def test_summarizes_oldest_turns(self):
+        """古いターンを要約し、残す側はuserメッセージから始まる"""
+        history = self._history(4)
+        compactor = ConversationCompactor(model="fast", threshold_tokens=10, keep_messages=3)
+        client = FakeSummaryClient()
+
+        assert compactor.submit(client, history, 100, owner=history) is True
+        cut, summary = self._wait(compactor, history)
+
+        assert cut == 4
+        assert history[cut]["role"] == "user"
+        assert summary["role"] == "user"
+        assert summary["content"].startswith(ConversationCompactor.SUMMARY_HEADER)
+        assert "要約です" in summary["content"]
+        call = client.calls[0]
+        assert call["model"] == "fast"
+        assert "質問0" in call["messages"][0]["content"]
+        assert "質問2" not in call["messages"][0]["content"]
+
+    def test_other_owner_discarded(self):
+        """要約開始後に履歴が置き換わった場合は結果を適用しない"""
+        history = self._history(4)
+        compactor = ConversationCompactor(model="fast", threshold_tokens=10, keep_messages=2)
+        compactor.submit(FakeSummaryClient(), history, 100, owner=history)
+        assert self._wait(compactor, self._history(4)) is None
+        assert not compactor.pending
+
+    def test_discard_drops_pending_summary(self):
+        """新規会話・クリア時に破棄した要約は適用しない"""
+        history = self._history(4)
+        compactor = ConversationCompactor(model="fast", threshold_tokens=10, keep_messages=2)
+        compactor.submit(FakeSummaryClient(), history, 100, owner=history)
+        compactor.discard()
+        assert not compactor.pending
+        assert compactor.poll(history) is None
+
+    def test_failure_returns_none(self):
+        history = self._history(4)
+        compactor = ConversationCompactor(model="fast", threshold_tokens=10, keep_messages=2)
+        compactor.submit(FakeSummaryClient(error=RuntimeError("boom")), history, 100, owner=history)
+        assert self._wait(compactor, history) is None
+        assert compactor.compactions == 0
+
+
+# ==================================================
+# 画像処理のテスト
+# ==================================================
+def make_noise_image(width: int, height: int):
+    """圧縮しにくいノイズ画像（RGB）"""
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8))
+
+
+class TestBase64Payload:
+    """Base64Payload のテスト"""
+
+    @pytest.mark.parametrize("n", [0, 1, 2, 3, 4, 8, 9, 10, 1000])
+    def test_chunked_file_encoding_matches_b64encode(self, tmp_path, n):
+        """チャンク境界をまたいでも一括エンコードと一致する"""
+        data = bytes(random.Random(n).getrandbits(8) for _ in range(n))
+        path = tmp_path / "payload.bin"
+        path.write_bytes(data)
+        expected = base64.b64encode(data).decode("ascii")
+        with patch.object(Base64Payload, "CHUNK_BYTES", 9):
+            assert Base64Payload.encode_file(path) == expected
+            assert Base64Payload.encode_bytes(data) == expected
+            assert b"".join(Base64Payload.iter_file(path)).decode("ascii") == expected
+        assert Base64Payload.encoded_size(n) == len(expected)
+
+    def test_chunk_size_must_be_multiple_of_three(self):
+        with pytest.raises(ValueError):
+            list(Base64Payload.iter_buffer(b"abcdef", chunk_bytes=4))
+
+
+class TestImageEncoder:
+    """ImageEncoder のテスト"""
+
+    @pytest.mark.parametrize("n", [0, 1, 2, 3, 4, 5, 100, 1001])
+    def test_base64_size_matches_encoding(self, n):
+        assert ImageEncoder.base64_size(n) == len(base64.b64encode(b"x" * n))
+
+    def test_max_raw_bytes_fits(self):
+        for limit in (100, 101, 102, 103, 5 * 1024 * 1024):
+            raw = ImageEncoder.max_raw_bytes(limit)
+            assert ImageEncoder.base64_size(raw) <= limit
+            assert ImageEncoder.base64_size(raw + 3) > limit
+
+    def test_output_format(self):
+        assert ImageEncoder.output_format("a.PNG") == ("PNG", "image/png")
+        assert ImageEncoder.output_format("a.gif") == ("JPEG", "image/jpeg")
+
+    def test_quality_search_fits_limit(self):
+        """品質の探索で制限内に収め、縮小はしない"""
+        img = make_noise_image(400, 300)
+        full = len(ImageEncoder.encode_bytes(img, "JPEG", 90))
+        limit = ImageEncoder.base64_size(int(full * 0.7))
+
+        result = ImageEncoder.fit_within(img, "JPEG", limit, max_quality=90, min_quality=20)
+
+        assert ImageEncoder.base64_size(len(result['data'])) <= limit
+        assert result['scale'] == 1.0
+        assert 20 <= result['quality'] < 90
+        assert result['encodes'] <= 8
+
+    def test_scale_search_for_png(self):
+        """PNGは縮小率の探索で制限内に収める"""
+        img = make_noise_image(400, 400)
+        full = len(ImageEncoder.encode_bytes(img, "PNG"))
+        limit = ImageEncoder.base64_size(full // 4)
+
+        result = ImageEncoder.fit_within(img, "PNG", limit, min_side=50)
+
+        assert ImageEncoder.base64_size(len(result['data'])) <= limit
+        assert result['quality'] is None
+        assert result['size'][0] < 400
+        assert result['encodes'] <= 8
+
+    def test_unreachable_limit(self):
+        img = make_noise_image(200, 200)
+        assert ImageEncoder.fit_within(img, "PNG", 1000, min_side=150) is None
+
+    def test_target_size_keeps_aspect_ratio(self):
+        assert ImageEncoder.target_size((1000, 800), max_long_edge=1568, max_pixels=10**7) is None
+        assert ImageEncoder.target_size((4000, 2000), max_long_edge=1568, max_pixels=10**7) == (1568, 784)
+        width, height = ImageEncoder.target_size((1500, 1500), max_long_edge=1568, max_pixels=1_150_000)
+        assert width == height and width * height <= 1_150_000
+
+    def test_estimate_tokens_uses_effective_size(self):
+        """実効解像度を超える画像は縮小後のサイズで見積もる"""
+        assert ImageEncoder.estimate_tokens((750, 1)) == 1
+        assert ImageEncoder.estimate_tokens((1000, 1000)) == 1334
+        assert ImageEncoder.estimate_tokens((8000, 8000)) == ImageEncoder.estimate_tokens((1072, 1072))
+
+    def test_encode_file_downscales_to_long_edge(self, tmp_path):
+        path = tmp_path / "wide.png"
+        make_noise_image(400, 100).save(path)
+
+        with patch.object(ImageEncoder, 'optimize_enabled', return_value=False):
+            encoded, media_type, stats = ImageEncoder.encode_file(path, 5 * 1024 * 1024, max_long_edge=200)
+        preflight = ImageEncoder.preflight(path, max_long_edge=200)
+
+        from PIL import Image
+        import io
+        with Image.open(io.BytesIO(base64.b64decode(encoded))) as img:
+            assert img.size == (200, 50)
+        assert media_type == "image/png"
+        assert preflight['downscale'] and preflight['send_size'] == (200, 50)
+
+    def test_optimize_applies_orientation_and_strips_exif(self, tmp_path):
+        """EXIFの向きを適用し、送信データにはEXIFを含めない"""
+        from PIL import Image
+        import io
+        path = tmp_path / "rotated.jpg"
+        exif = Image.Exif()
+        exif[0x0112] = 6  # 90度回転
+        make_noise_image(40, 20).save(path, exif=exif.tobytes(), quality=95)
+
+        encoded, _, stats = ImageEncoder.encode_file(path, 5 * 1024 * 1024)
+
+        with Image.open(io.BytesIO(base64.b64decode(encoded))) as img:
+            assert img.size == (20, 40)
+            assert not img.info.get('exif')
+        assert stats['kind'] == 'photo'
+
+    def test_screenshot_with_alpha_keeps_transparency(self, tmp_path):
+        """透明部分のある図版はJPEGにしない"""
+        from PIL import Image
+        img = Image.new("RGBA", (200, 100), (0, 0, 0, 0))
+        img.paste((30, 120, 200, 255), (20, 20, 180, 80))
+        path = tmp_path / "screenshot.png"
+        img.save(path)
+
+        _, media_type, stats = ImageEncoder.encode_file(path, 5 * 1024 * 1024)
+
+        assert media_type in ("image/png", "image/webp")
+        assert stats['kind'] == 'graphic'
+
+    def test_photo_png_converted_to_smaller_format(self, tmp_path):
+        path = tmp_path / "photo.png"
+        make_noise_image(200, 200).save(path)
+
+        encoded, media_type, stats = ImageEncoder.encode_file(path, 5 * 1024 * 1024)
+
+        assert media_type in ("image/jpeg", "image/webp")
+        assert stats['base64_bytes'] < ImageEncoder.base64_size(path.stat().st_size)
+
+    def test_jpeg_draft_decode(self, tmp_path):
+        """大きく縮小するJPEGは縮小デコードし、最終サイズは指定どおり"""
+        from PIL import Image
+        path = tmp_path / "photo.jpg"
+        make_noise_image(800, 600).save(path, quality=90)
+
+        with Image.open(path) as img:
+            assert ImageEncoder.draft_for(img, (200, 150)) is True
+            img.load()
+            assert img.size == (200, 150)
+        with Image.open(path) as img:
+            assert ImageEncoder.draft_for(img, (500, 375)) is False
+
+        encoded, _, stats = ImageEncoder.resize_and_encode(path, 5 * 1024 * 1024, (190, 142))
+        assert stats['size'] == (190, 142)
+        assert stats['original_size'] == (800, 600)
+
+    def test_resize_and_encode_file(self, tmp_path):
+        """ファイルから読み込み、base64後のサイズを制限内に収める"""
+        path = tmp_path / "noise.jpg"
+        make_noise_image(300, 300).save(path, quality=95)
+        limit = ImageEncoder.base64_size(path.stat().st_size // 2)
+
+        encoded, media_type, stats = ImageEncoder.resize_and_encode(path, limit)
+
+        assert media_type == "image/jpeg"
+        assert len(encoded) == stats['base64_bytes'] <= limit
+        assert stats['original_size'] == (300, 300)
+
+
+class TestImagePayloadCache:
+    """ImagePayloadCache のテスト"""
+
+    def test_repeat_request_skips_encoding(self, tmp_path):
+        path = tmp_path / "photo.png"
+        make_noise_image(64, 64).save(path)
+        cache = ImagePayloadCache(tmp_path / "cache", max_bytes=10 * 1024 * 1024)
+
+        data, media_type, stats = cache.get_or_encode(path, 5 * 1024 * 1024)
+        assert stats['cached'] is False
+        with patch.object(ImageEncoder, 'encode_file', side_effect=AssertionError("re-encoded")):
+            cached_data, cached_type, cached_stats = cache.get_or_encode(path, 5 * 1024 * 1024)
+
+        assert cached_stats['cached'] is True
+        assert (cached_data, cached_type) == (data, media_type)
+        assert cache.hits == 1 and cache.misses == 1
+
+    def test_key_depends_on_content_and_constraints(self, tmp_path):
+        path = tmp_path / "photo.png"
+        make_noise_image(32, 32).save(path)
+        cache = ImagePayloadCache(tmp_path / "cache")
+        cache.set(path, "payload", "image/png", max_base64_bytes=1000)
+
+        assert cache.get(path, max_base64_bytes=2000) is None
+        assert cache.get(path, max_base64_bytes=1000)['data'] == "payload"
+
+        make_noise_image(33, 33).save(path)
+        assert cache.get(path, max_base64_bytes=1000) is None
+
+
+def make_screenshot(width=320, height=200, offset=0):
+    """ウィンドウ・文字列風の矩形を並べたスクリーンショット相当の画像"""
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", (width, height), (240, 240, 240))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, width, 24), fill=(40, 80, 160))
+    for row in range(6):
+        y = 40 + row * 25
+        draw.rectangle((20 + offset, y, 20 + offset + 40 * (row + 2), y + 10), fill=(30, 30, 30))
+    draw.ellipse((width - 90, height - 90, width - 20, height - 20), fill=(200, 60, 60))
+    return img
+
+
+class TestPerceptualDedup:
+    """PerceptualHash / ImageHashIndex による近似重複の再利用のテスト"""
+
+    def test_recompressed_copy_is_near_duplicate(self, tmp_path):
+        original, recompressed, other = tmp_path / "a.png", tmp_path / "b.jpg", tmp_path / "c.png"
+        make_screenshot().save(original)
+        make_screenshot().resize((300, 188)).save(recompressed, quality=60)
+        make_screenshot(offset=120).rotate(180).save(other)
+
+        hashes = np.array([PerceptualHash.from_file(p) for p in (original, recompressed, other)],
+                          dtype=np.uint64)
+        distances = PerceptualHash.distances(hashes, int(hashes[0]))
+        assert distances[0] == 0
+        assert distances[1] <= 4
+        assert distances[2] > 10
+
+    def test_payload_reused_for_near_duplicate(self, tmp_path):
+        original, recompressed = tmp_path / "a.png", tmp_path / "b.jpg"
+        make_screenshot().save(original)
+        make_screenshot().save(recompressed, quality=70)
+        cache = ImagePayloadCache(tmp_path / "cache")
+
+        data, media_type, stats = cache.get_or_encode(original, 5 * 1024 * 1024)
+        assert stats['cached'] is False
+        with patch.object(ImageEncoder, 'encode_file', side_effect=AssertionError("re-encoded")):
+            reused, reused_type, reused_stats = cache.get_or_encode(recompressed, 5 * 1024 * 1024)
+        assert reused_stats['cached'] is True and reused_stats['near_duplicate'] is True
+        assert (reused, reused_type) == (data, media_type)
+
+        # 索引は永続化され、新しいインスタンスでも近似重複を検出する
+        assert ImagePayloadCache(tmp_path / "cache").is_near_duplicate(recompressed)
+
+    def test_answer_reused_only_for_same_content_and_prompt(self, tmp_path):
+        """回答は内容が完全に同じ画像のみ再利用（近似重複は前処理結果のみ共有）"""
+        original, copy, recompressed = tmp_path / "a.png", tmp_path / "copy.png", tmp_path / "b.jpg"
+        make_screenshot().save(original)
+        copy.write_bytes(original.read_bytes())
+        make_screenshot().save(recompressed, quality=70)
+        cache = ImagePayloadCache(tmp_path / "cache")
+
+        cache.get_or_encode(original, 5 * 1024 * 1024)
+        cache.set_answer(original, "何が写っていますか？", make_message("ウィンドウです"), model="m")
+        record = cache.get_answer(copy, "何が写っていますか？", model="m")
+        assert record is not None and record.texts == ("ウィンドウです",)
+        assert cache.get_answer(copy, "色は？", model="m") is None
+        assert cache.get_answer(copy, "何が写っていますか？", model="other") is None
+        assert cache.is_near_duplicate(recompressed)
+        assert cache.get_answer(recompressed, "何が写っていますか？", model="m") is None
+
+    def test_dedup_disabled_uses_exact_content(self, tmp_path):
+        import helper_api
+
+        original, recompressed = tmp_path / "a.png", tmp_path / "b.jpg"
+        make_screenshot().save(original)
+        make_screenshot().save(recompressed, quality=70)
+        cache = ImagePayloadCache(tmp_path / "cache")
+        original_get = helper_api.config.get
+        with patch.object(helper_api.config, "get",
+                          side_effect=lambda key, default=None: False if key == "images.dedup_enabled"
+                          else original_get(key, default)):
+            assert cache.canonical_hash(recompressed) == cache.content_hash(recompressed)
+            assert not cache.is_near_duplicate(recompressed)
+
+
+def make_animation(path, colors, size=(120, 80)):
+    """色の場面が切り替わり、白い四角が少しずつ動くアニメーションGIF"""
+    from PIL import Image
+    frames = []
+    for i, color in enumerate(colors):
+        frame = Image.new("RGB", size, color)
+        frame.paste((255, 255, 255), (i * 5, 10, i * 5 + 10, 20))
+        frames.append(frame)
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+    return path
+
+
+class TestAnimationSampler:
+    """AnimationSampler のテスト"""
+
+    SCENES = [(255, 0, 0)] * 4 + [(0, 255, 0)] * 4 + [(0, 0, 255)] * 4
+
+    def test_selects_scene_changes(self, tmp_path):
+        from PIL import Image
+        path = make_animation(tmp_path / "scenes.gif", self.SCENES)
+        assert AnimationSampler.is_animated(path)
+        with Image.open(path) as img:
+            assert AnimationSampler.select_frames(img, max_frames=4) == [0, 4, 8]
+            assert AnimationSampler.select_frames(img, max_frames=2) in ([0, 4], [0, 8])
+
+    def test_tile_and_blocks_modes(self, tmp_path):
+        path = make_animation(tmp_path / "scenes.gif", self.SCENES)
+
+        payloads, stats = AnimationSampler.encode(path, 5 * 1024 * 1024, mode="tile")
+        assert len(payloads) == 1 and stats['mode'] == "tile"
+        assert stats['frames'] == 12 and stats['selected'] == [0, 4, 8]
+        blocks = AnimationSampler.content_blocks(payloads, stats)
+        assert blocks[0]['type'] == "text" and blocks[1]['type'] == "image"
+
+        payloads, stats = AnimationSampler.encode(path, 5 * 1024 * 1024, mode="blocks")
+        assert len(payloads) == 3 and stats['mode'] == "blocks"
+
+    def test_tile_layout(self):
+        from PIL import Image
+        frames = [Image.new("RGBA", (30, 20), (0, 0, 0, 255)) for _ in range(3)]
+        assert AnimationSampler.tile(frames).size == (60, 40)
+
+    def test_static_animation_sends_first_frame(self, tmp_path):
+        from PIL import Image
+        path = tmp_path / "static.gif"
+        frame = Image.new("RGB", (64, 64), (10, 20, 30))
+        frame.save(path, save_all=True, append_images=[frame.copy() for _ in range(5)], duration=100)
+        payloads, stats = AnimationSampler.encode(path, 5 * 1024 * 1024)
+        assert stats['selected'] == [0] and stats['mode'] == "single"
+
+        still = tmp_path / "still.png"
+        make_noise_image(8, 8).save(still)
+        assert not AnimationSampler.is_animated(still)
+
+    def test_animation_result_is_cached(self, tmp_path):
+        path = make_animation(tmp_path / "scenes.gif", self.SCENES)
+        cache = ImagePayloadCache(tmp_path / "cache")
+        payloads, stats = cache.get_or_encode_animation(path, 5 * 1024 * 1024)
+        assert stats['cached'] is False
+        with patch.object(AnimationSampler, 'encode', side_effect=AssertionError("re-sampled")):
+            cached_payloads, cached_stats = cache.get_or_encode_animation(path, 5 * 1024 * 1024)
+        assert cached_stats['cached'] is True and cached_payloads == payloads
+
+
+class FakeVisionClient:
+    """画像メッセージを受け取り固定の回答を返すクライアント"""
+
+    def __init__(self, fail_on=None):
+        self.requests = []
+        self._fail_on = fail_on
+        self._lock = threading.Lock()
+
+    def create_message(self, messages, model=None, max_tokens=None):
+        image = messages[0]["content"][1]["source"]
+        with self._lock:
+            self.requests.append(image["media_type"])
+        if self._fail_on and self._fail_on in messages[0]["content"][0]["text"]:
+            raise RuntimeError("api error")
+        return ResponseRecord(id="msg", model=model, texts=["説明"], input_tokens=100, output_tokens=20)
+
+
+class TestVisionBatchProcessor:
+    """VisionBatchProcessor のテスト"""
+
+    def _make_images(self, directory, count):
+        for i in range(count):
+            make_noise_image(32, 32).save(directory / f"img_{i}.png")
+        (directory / "notes.txt").write_text("skip")
+
+    def test_list_images_filters_extensions(self, tmp_path):
+        self._make_images(tmp_path, 2)
+        assert [p.name for p in VisionBatchProcessor.list_images(tmp_path)] == ["img_0.png", "img_1.png"]
+        assert VisionBatchProcessor.list_images(tmp_path / "missing") == []
+
+    def test_run_streams_rows_and_jsonl(self, tmp_path):
+        self._make_images(tmp_path, 5)
+        client = FakeVisionClient()
+        processor = VisionBatchProcessor(client, model="claude-3-5-haiku-20241022", max_concurrency=2,
+                                         process_workers=2, use_cache=False)
+        output = tmp_path / "out" / "result.jsonl"
+
+        rows = list(processor.run(VisionBatchProcessor.list_images(tmp_path), "説明して", output))
+
+        assert sorted(row['file'] for row in rows) == [f"img_{i}.png" for i in range(5)]
+        assert all(row['status'] == 'ok' and row['answer'] == "説明" for row in rows)
+        assert all(row['input_tokens'] == 100 and row['cost_usd'] > 0 for row in rows)
+        assert len(client.requests) == 5 and len(set(client.requests)) == 1
+        lines = output.read_text(encoding="utf-8").splitlines()
+        assert len(lines) == 5
+        assert json.loads(lines[0])['latency_sec'] is not None
+
+    def test_preprocess_pool_uses_spawn(self):
+        """前処理プールは fork せず spawn で起動する"""
+        processor = VisionBatchProcessor(FakeVisionClient(), process_workers=1, use_cache=False)
+        with patch('helper_api.ProcessPoolExecutor') as pool_cls:
+            processor._preprocess_executor()
+        assert pool_cls.call_args.kwargs['mp_context'].get_start_method() == "spawn"
+
+    def test_api_error_recorded(self, tmp_path):
+        self._make_images(tmp_path, 1)
+        processor = VisionBatchProcessor(FakeVisionClient(fail_on="説明"), process_workers=1, use_cache=False)
+        rows = list(processor.run(VisionBatchProcessor.list_images(tmp_path), "説明して"))
+        assert rows[0]['status'] == 'error'
+        assert "api error" in rows[0]['error']
+
+
+class TestVisionRequestPacker:
+    """VisionRequestPacker のテスト"""
+
+    def test_pack_respects_count_and_size_limits(self):
+        packer = VisionRequestPacker(max_images=3, max_request_bytes=100)
+        items = [VisionRequestPacker.base64_item("x" * size, "image/png", label=str(i))
+                 for i, size in enumerate([40, 40, 40, 10, 10, 10, 10, 500])]
+        groups = packer.pack(items)
+        assert [[item['label'] for item in group] for group in groups] == [
+            ["0", "1"], ["2", "3", "4"], ["5", "6"], ["7"]]
+
+    def test_url_items_only_limited_by_count(self):
+        packer = VisionRequestPacker(max_images=20, max_request_bytes=1)
+        items = [VisionRequestPacker.url_item(f"https://example.com/{i}.png") for i in range(45)]
+        assert [len(group) for group in packer.pack(items)] == [20, 20, 5]
+
+    def test_build_messages_numbers_images_with_questions(self):
+        packer = VisionRequestPacker(max_tokens_per_image=300, max_tokens_limit=1000)
+        group = [VisionRequestPacker.url_item("https://example.com/a.png", "色は？"),
+                 VisionRequestPacker.base64_item("AAAA", "image/png")]
+        content = packer.build_messages(group, "説明して")[0]['content']
+        assert "2枚" in content[0]['text']
+        assert content[1]['text'] == "画像 1 の質問: 色は？"
+        assert content[2]['source']['type'] == "url"
+        assert content[3]['text'] == "画像 2 の質問: 説明して"
+        assert content[4]['source'] == {"type": "base64", "media_type": "image/png", "data": "AAAA"}
+        assert packer.max_tokens_for(group) == 600
+        assert packer.max_tokens_for(group * 5) == 1000
+
+    def test_split_json_answer(self):
+        text = '```json\n[{"image": 2, "answer": "犬"}, {"image": 1, "answer": "猫"}]\n```'
+        assert VisionRequestPacker.split_answer(text, 3) == ["猫", "犬", None]
+
+    def test_split_heading_fallback(self):
+        text = "## 画像 1\n猫が写っています。\n\n**画像 2**: 犬が写っています。"
+        assert VisionRequestPacker.split_answer(text, 2) == ["猫が写っています。", "犬が写っています。"]
+        assert VisionRequestPacker.split_answer("猫です", 1) == ["猫です"]
+
+
+@pytest.fixture
+def image_server():
+    """画像・HTMLを返すローカルHTTPサーバー（ETagによる条件付きGETに対応）"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    small = io.BytesIO()
+    make_screenshot(64, 48).save(small, format="PNG")
+    large = io.BytesIO()
+    make_noise_image(400, 300).save(large, format="PNG")
+    routes = {
+        "/small.png": ("image/png", small.getvalue()),
+        "/large.png": ("image/png", large.getvalue()),
+        "/page.html": ("text/html", b"<html></html>"),
+        "/fake.png" : ("image/png", b"not an image"),
+    }
+    redirects = {
+        "/redirect.png": "/small.png",
+        "/redirect-file": "file:///etc/passwd",
+    }
+    requests_log = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _respond(self, body_wanted):
+            requests_log.append((self.command, self.path))
+            if self.path in redirects:
+                self.send_response(302)
+                self.send_header("Location", redirects[self.path])
+                self.end_headers()
+                return
+            if self.path not in routes:
+                self.send_response(404)
+                self.end_headers()
+                return
+            content_type, body = routes[self.path]
+            etag = f'"{len(body)}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            if body_wanted:
+                self.wfile.write(body)
+
+        def do_HEAD(self):
+            self._respond(False)
+
+        def do_GET(self):
+            self._respond(True)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", requests_log, len(large.getvalue())
+    server.shutdown()
+    server.server_close()
+
+
+class TestURLImagePrefetcher:
+    """URLImagePrefetcher のテスト"""
+
+    def _prefetcher(self, tmp_path, **kwargs):
+        from helper_api import DiskCache
+        kwargs.setdefault('allow_private_hosts', True)
+        return URLImagePrefetcher(cache=DiskCache(tmp_path / "url_cache"), **kwargs)
+
+    def test_validates_urls_concurrently(self, tmp_path, image_server):
+        base, _, _ = image_server
+        urls = [f"{base}/small.png", f"{base}/page.html", f"{base}/missing.png", f"{base}/fake.png"]
+        results = self._prefetcher(tmp_path).prefetch(urls + [urls[0]])
+
+        assert list(results) == urls
+        ok = results[urls[0]]
+        assert ok['status'] == "ok" and ok['mode'] == "url" and ok['size'] == (64, 48)
+        assert URLImagePrefetcher.content_block(ok)['source'] == {"type": "url", "url": urls[0]}
+        assert "画像ではありません" in results[urls[1]]['error']
+        assert "取得エラー" in results[urls[2]]['error']
+        assert "画像として読み込めません" in results[urls[3]]['error']
+
+    def test_oversize_image_converted_to_base64(self, tmp_path, image_server):
+        base, _, large_bytes = image_server
+        limit = ImageEncoder.base64_size(large_bytes) // 2
+        result = self._prefetcher(tmp_path, max_base64_bytes=limit).fetch(f"{base}/large.png")
+        assert result['status'] == "ok" and result['mode'] == "base64"
+        assert len(result['data']) <= limit
+        assert URLImagePrefetcher.content_block(result)['source']['type'] == "base64"
+
+        rejected = self._prefetcher(tmp_path / "b", max_base64_bytes=limit,
+                                    convert_oversize=False).fetch(f"{base}/large.png")
+        assert rejected['status'] == "error" and "サイズ制限超過" in rejected['error']
+
+    def test_oversize_dimension_resized_or_rejected(self, tmp_path, image_server):
+        """長辺が上限を超える画像は縮小（変換しない設定では除外）"""
+        base, _, _ = image_server
+        result = self._prefetcher(tmp_path, max_dimension=200).fetch(f"{base}/large.png")
+        assert result['status'] == "ok" and result['mode'] == "base64"
+        assert max(result['size']) <= 200
+
+        rejected = self._prefetcher(tmp_path / "b", max_dimension=200,
+                                    convert_oversize=False).fetch(f"{base}/large.png")
+        assert rejected['status'] == "error" and "解像度制限超過" in rejected['error']
+
+    def test_rejects_internal_hosts_and_other_schemes(self, tmp_path, image_server):
+        """http(s) 以外・ループバック等のホストは（リダイレクト先も含めて）取得しない"""
+        base, log, _ = image_server
+        blocked = self._prefetcher(tmp_path, allow_private_hosts=False).fetch(f"{base}/small.png")
+        assert blocked['status'] == "error" and "内部ネットワーク" in blocked['error']
+        assert log == []
+
+        prefetcher = self._prefetcher(tmp_path / "b")
+        assert "非対応のスキーム" in prefetcher.fetch("file:///etc/passwd")['error']
+        assert "非対応のスキーム" in prefetcher.fetch(f"{base}/redirect-file")['error']
+
+        followed = prefetcher.fetch(f"{base}/redirect.png")
+        assert followed['status'] == "ok" and followed['size'] == (64, 48)
+
+    def test_download_cap(self, tmp_path, image_server):
+        base, _, large_bytes = image_server
+        result = self._prefetcher(tmp_path, max_download_bytes=large_bytes - 1).fetch(f"{base}/large.png")
+        assert result['status'] == "error" and "上限" in result['error']
+
+    def test_revalidates_cached_result_with_etag(self, tmp_path, image_server):
+        base, log, _ = image_server
+        prefetcher = self._prefetcher(tmp_path)
+        first = prefetcher.fetch(f"{base}/small.png")
+        log.clear()
+        second = prefetcher.fetch(f"{base}/small.png")
+
+        assert first['cached'] is False and second['cached'] is True
+        assert second['size'] == first['size']
+        assert log == [("GET", "/small.png")]
+
+
+class TestImageDirectoryIndex:
+    """ImageDirectoryIndex のテスト"""
+
+    def _make_dir(self, tmp_path, count):
+        directory = tmp_path / "images"
+        directory.mkdir()
+        for i in range(count):
+            make_screenshot(40 + i, 30).save(directory / f"shot_{i:02d}.png")
+        (directory / "notes.txt").write_text("not an image")
+        return directory
+
+    def test_entries_include_metadata_and_thumbnail(self, tmp_path):
+        from PIL import Image
+        directory = self._make_dir(tmp_path, 3)
+        index = ImageDirectoryIndex(directory, index_dir=tmp_path / "index", thumbnail_size=16)
+        entries, total = index.list()
+
+        assert total == 3 and [e['name'] for e in entries] == ["shot_00.png", "shot_01.png", "shot_02.png"]
+        first = entries[0]
+        assert (first['width'], first['height']) == (40, 30)
+        assert first['path'] == str(directory / "shot_00.png")
+        assert len(first['content_hash']) == 64
+        assert max(Image.open(io.BytesIO(first['thumbnail'])).size) <= 16
+
+    def test_incremental_refresh(self, tmp_path):
+        directory = self._make_dir(tmp_path, 3)
+        index = ImageDirectoryIndex(directory, index_dir=tmp_path / "index", rescan_interval=3600)
+        index.refresh()
+        assert index.updated == 3
+
+        # フォルダが変わらなければ走査しない
+        assert index.refresh() == 0
+
+        make_screenshot(90, 60).save(directory / "shot_01.png")
+        (directory / "shot_02.png").unlink()
+        assert index.refresh(force=True) == 2
+        assert index.updated == 1
+        assert index.get("shot_01.png")['width'] == 90
+        assert index.get("shot_02.png") is None
+
+    def test_persisted_index_skips_unchanged_files(self, tmp_path):
+        directory = self._make_dir(tmp_path, 3)
+        ImageDirectoryIndex(directory, index_dir=tmp_path / "index").refresh()
+
+        reloaded = ImageDirectoryIndex(directory, index_dir=tmp_path / "index")
+        with patch.object(ImageDirectoryIndex, "_describe", side_effect=AssertionError("re-described")):
+            assert reloaded.refresh() == 0
+            assert len(reloaded) == 3
+
+    def test_filter_and_pagination(self, tmp_path):
+        directory = self._make_dir(tmp_path, 12)
+        index = ImageDirectoryIndex(directory, index_dir=tmp_path / "index")
+
+        page, total = index.list(offset=5, limit=5)
+        assert total == 12 and [e['name'] for e in page] == [f"shot_{i:02d}.png" for i in range(5, 10)]
+        filtered, total = index.list(query="SHOT_1")
+        assert total == 2 and [e['name'] for e in filtered] == ["shot_10.png", "shot_11.png"]
+        assert index.count() == 12 and index.count("SHOT_1") == 2
+
+    def test_file_removed_during_refresh_is_skipped(self, tmp_path):
+        """走査後・エントリ作成前に削除されたファイルは一覧から除く"""
+        directory = self._make_dir(tmp_path, 3)
+        index = ImageDirectoryIndex(directory, index_dir=tmp_path / "index")
+        original = ImageDirectoryIndex._describe
+
+        def describe(self, name):
+            if name == "shot_01.png":
+                (directory / name).unlink()
+            return original(self, name)
+
+        with patch.object(ImageDirectoryIndex, '_describe', describe):
+            entries, total = index.list()
+        assert total == 2 and [e['name'] for e in entries] == ["shot_00.png", "shot_02.png"]
+
+    def test_content_hash_reused_by_payload_cache(self, tmp_path):
+        """インデックスの内容ハッシュを登録すると画像キャッシュは再ハッシュしない"""
+        directory = self._make_dir(tmp_path, 1)
+        index = ImageDirectoryIndex(directory, index_dir=tmp_path / "index")
+        entry = index.get("shot_00.png")
+        cache = ImagePayloadCache(tmp_path / "cache")
+        cache.remember_hash(entry['path'], entry['size'], entry['mtime_ns'], entry['content_hash'])
+
+        with patch('builtins.open', side_effect=AssertionError("re-hashed")):
+            assert cache.content_hash(entry['path']) == entry['content_hash']
+
+
+# ==================================================
+# 都市データのテスト
+# ==================================================
+class TestCityIndex:
+    """CityIndex のテスト"""
+
+    CITIES = [
+        {"id": 3, "name": "Tokyo", "state": "", "country": "JP", "coord": {"lon": 139.69, "lat": 35.69}},
+        {"id": 1, "name": "Osaka", "state": "", "country": "JP", "coord": {"lon": 135.50, "lat": 34.69}},
+        {"id": 2, "name": "Higashiosaka", "state": "", "country": "JP", "coord": {"lon": 135.60, "lat": 34.67}},
+        {"id": 4, "name": "Sapporo", "state": "", "country": "JP", "coord": {"lon": 141.35, "lat": 43.06}},
+    ]
+
+    def _write_json(self, tmp_path, cities=None):
+        json_path = tmp_path / "city_jp.list.json"
+        json_path.write_text(json.dumps(cities or self.CITIES), encoding="utf-8")
+        return json_path
+
+    def test_build_sorts_columns_by_name(self, tmp_path):
+        json_path = self._write_json(tmp_path)
+        cities = CityIndex(CityIndex.build(json_path, tmp_path / "index"))
+
+        assert cities.name_list() == ["Higashiosaka", "Osaka", "Sapporo", "Tokyo"]
+        assert cities.ids.tolist() == [2, 1, 4, 3]
+        assert cities.countries.tolist() == ["JP"] * 4
+        assert isinstance(cities.lat, np.memmap)
+        assert cities.lookup("Tokyo") == ("Tokyo", 35.69, 139.69)
+        assert cities.lookup("Kyoto") is None
+
+    def test_load_prebuilt_never_builds(self, tmp_path):
+        """未生成の成果物は生成せずNone、生成済みなら読み込む"""
+        json_path = self._write_json(tmp_path)
+        index_dir = tmp_path / "prebuilt"
+        with patch.object(CityIndex, 'build', side_effect=AssertionError("built")):
+            assert CityIndex.load_prebuilt(json_path, index_dir) is None
+            assert CityIndex.load_prebuilt(tmp_path / "missing.json", index_dir) is None
+        CityIndex.build(json_path, index_dir)
+        assert len(CityIndex.load_prebuilt(json_path, index_dir)) == len(self.CITIES)
+
+    def test_load_is_shared_and_rebuilds_when_source_changes(self, tmp_path):
+        json_path = self._write_json(tmp_path)
+        index_dir = tmp_path / "index"
+        first = CityIndex.load(json_path, index_dir)
+        assert CityIndex.load(json_path, index_dir) is first
+        assert CityIndex.is_current(json_path, index_dir)
+
+        updated = self.CITIES + [{"id": 5, "name": "Naha", "country": "JP", "coord": {"lon": 127.68, "lat": 26.21}}]
+        json_path.write_text(json.dumps(updated), encoding="utf-8")
+        assert not CityIndex.is_current(json_path, index_dir)
+        reloaded = CityIndex.load(json_path, index_dir)
+        assert reloaded is not first and len(reloaded) == 5
+
+    def test_search_and_closest(self, tmp_path):
+        cities = CityIndex.load(self._write_json(tmp_path), tmp_path / "index")
+
+        assert [cities.row(i)[0] for i in cities.search("OSAKA")] == ["Higashiosaka", "Osaka"]
+        assert len(cities.search("Kyoto")) == 0
+        assert cities.row(cities.closest("Sapporo-shi", cutoff=0.6))[0] == "Sapporo"
+        assert cities.closest("Fukuoka", cutoff=0.9) is None
+
+    def test_gzip_source_gets_its_own_index_dir(self, tmp_path):
+        import gzip
+        gz_path = tmp_path / "city.list.json.gz"
+        with gzip.open(gz_path, "wt", encoding="utf-8") as f:
+            json.dump(self.CITIES, f)
+        with patch('helper_api.config.get', side_effect=lambda key, default=None: {
+                "paths.cache_dir": str(tmp_path / "cache")}.get(key, default)):
+            cities = CityIndex.load(gz_path)
+
+        assert cities.directory == tmp_path / "cache" / "city_index" / "city"
+        assert len(cities) == 4
+
+    def test_nearest_and_within(self, tmp_path):
+        cities = CityIndex.load(self._write_json(tmp_path), tmp_path / "index")
+
+        [(position, distance)] = cities.nearest(34.70, 135.51)
+        assert cities.row(position)[0] == "Osaka" and distance < 2
+        assert [cities.row(p)[0] for p, _ in cities.nearest(34.67, 135.58, k=3)] == \
+            ["Higashiosaka", "Osaka", "Tokyo"]
+        assert [cities.row(p)[0] for p, _ in cities.within(34.67, 135.58, 20)] == ["Higashiosaka", "Osaka"]
+
+
+class TestCitySpatialIndex:
+    """CitySpatialIndex のテスト（全件走査との一致）"""
+
+    @pytest.fixture
+    def points(self):
+        rng = np.random.default_rng(0)
+        lat = np.concatenate([rng.uniform(-89, 89, 500), rng.uniform(34, 36, 300)])
+        lon = np.concatenate([rng.uniform(-180, 180, 500), rng.uniform(-180, -179, 150), rng.uniform(179, 180, 150)])
+        return lat, lon
+
+    def test_nearest_matches_brute_force(self, points):
+        lat, lon = points
+        index = CitySpatialIndex(lat, lon, leaf_size=8)
+        rng = np.random.default_rng(1)
+        for q_lat, q_lon in zip(rng.uniform(-90, 90, 50), rng.uniform(-180, 180, 50)):
+            distances = CitySpatialIndex.distance_km(q_lat, q_lon, lat, lon)
+            result = index.nearest(q_lat, q_lon, k=4)
+            assert np.allclose([d for _, d in result], np.sort(distances)[:4])
+            assert np.allclose(distances[[p for p, _ in result]], [d for _, d in result])
+
+    def test_within_matches_brute_force_across_date_line(self, points):
+        lat, lon = points
+        index = CitySpatialIndex(lat, lon, leaf_size=8)
+        distances = CitySpatialIndex.distance_km(35.0, 180.0, lat, lon)
+        result = index.within(35.0, 180.0, 80)
+
+        assert sorted(p for p, _ in result) == sorted(np.flatnonzero(distances <= 80).tolist())
+        assert [d for _, d in result] == sorted(d for _, d in result)
+        assert any(lon[p] < 0 for p, _ in result) and any(lon[p] > 0 for p, _ in result)
+
+    def test_edge_cases(self):
+        assert CitySpatialIndex(np.empty(0), np.empty(0)).nearest(35.0, 139.0) == []
+        index = CitySpatialIndex(np.array([35.0, 34.0]), np.array([139.0, 135.0]))
+        assert [p for p, _ in index.nearest(0.0, 0.0, k=10)] == [1, 0]
+        assert index.within(35.0, 139.0, -1) == []
+        assert CitySpatialIndex.distance_km(0, 0, 0, 180) == pytest.approx(math.pi * CitySpatialIndex.EARTH_RADIUS_KM)
@@ -0,0 +1,260 @@
+# tests/unit/test_helper_st.py
+# --------------------------------------------------
+# helper_st.py の単体テスト
+# Streamlit UIヘルパー（デコレータ・セッション管理等）のテスト
+# --------------------------------------------------
+
+import sys
+import pytest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+# プロジェクトルートをパスに追加
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+
+class SessionStateStub(dict):
+    """st.session_state の簡易スタブ（属性・キーの両方でアクセス可能）"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+@pytest.fixture
+def session_state():
+    """helper_st.st をモックし、辞書ベースのsession_stateを提供"""
+    import helper_st
+
+    state = SessionStateStub()
+    with patch.object(helper_st, 'st') as mock_st:
+        mock_st.session_state = state
+        yield state
+
+
+# ==================================================
+# キャッシュデコレータのテスト
+# ==================================================
+class TestCacheResultUI:
+    """cache_result_ui のテスト"""
+
+    def test_session_tier(self, session_state):
+        """セッション層は同一セッション内で再利用され、他セッションとは共有しない"""
+        from helper_st import cache_result_ui
+
+        calls = []
+
+        @cache_result_ui()
+        def compute(x, y=1):
+            calls.append((x, y))
+            return x + y
+
+        assert compute(1, y=2) == 3
+        assert compute(1, y=2) == 3
+        assert len(calls) == 1
+
+        # 別セッション
+        session_state.clear()
+        assert compute(1, y=2) == 3
+        assert len(calls) == 2
+
+    def test_shared_tier(self, session_state):
+        """共有層はセッションをまたいで再利用される"""
+        from helper_st import cache_result_ui
+        from helper_api import shared_cache
+
+        calls = []
+
+        @cache_result_ui(shared=True)
+        def lookup(name):
+            calls.append(name)
+            return {"name": name}
+
+        try:
+            assert lookup("tokyo") == {"name": "tokyo"}
+            session_state.clear()
+            assert lookup("tokyo") == {"name": "tokyo"}
+            assert calls == ["tokyo"]
+            assert 'ui_cache' not in session_state
+        finally:
+            shared_cache.clear()
+
+    def test_clear_cache_keeps_shared_tier(self, session_state):
+        """セッションのキャッシュクリアは共有層に影響しない"""
+        from helper_st import SessionStateManager
+        from helper_api import shared_cache
+
+        try:
+            shared_cache.set("shared_key", "value")
+            SessionStateManager.get_ui_cache().set("session_key", "value")
+            SessionStateManager.clear_cache()
+            assert SessionStateManager.get_ui_cache().get("session_key") is None
+            assert shared_cache.get("shared_key") == "value"
+
+            SessionStateManager.clear_shared_cache()
+            assert shared_cache.get("shared_key") is None
+        finally:
+            shared_cache.clear()
+
+    def test_none_result_cached(self, session_state):
+        """Noneの結果もキャッシュされる"""
+        from helper_st import cache_result_ui
+
+        calls = []
+
+        @cache_result_ui()
+        def nothing():
+            calls.append(1)
+            return None
+
+        nothing()
+        nothing()
+        assert len(calls) == 1
+
+
+# ==================================================
+# メモリ計測のテスト
+# ==================================================
+class TestAccountMemory:
+    """SessionStateManager.account_memory のテスト"""
+
+    def test_registers_session_total(self, session_state):
+        from helper_st import SessionStateManager
+        from helper_api import session_memory
+
+        session_state["last_response_x"] = "r" * 10_000
+        rows = SessionStateManager.account_memory(force=True)
+
+        keys = [row["key"] for row in rows]
+        assert "last_response_x" in keys
+        assert "memory_accountant" not in keys
+        session_id = session_state["session_id"]
+        assert session_memory._sessions[session_id][1] >= 10_000
+        session_memory.remove(session_id)
+
+    def test_throttled(self, session_state):
+        """check_interval 内の再計測は省略する"""
+        from helper_st import SessionStateManager
+
+        assert SessionStateManager.account_memory(force=True) is not None
+        assert SessionStateManager.account_memory() is None
+
+
+# ==================================================
+# メッセージ管理のテスト
+# ==================================================
+class TestMessageManagerUI:
+    """MessageManagerUI のテスト"""
+
+    def test_history_limit(self, session_state):
+        """上限を超えても先頭の固定メッセージと直近の履歴を保持する"""
+        import helper_st
+        from helper_st import MessageManagerUI
+
+        session_state["messages_test"] = [{"role": "developer", "content": "sys"}]
+        with patch.object(helper_st.config, 'get', side_effect=lambda k, d=None: 3 if k == "ui.message_display_limit" else d):
+            manager = MessageManagerUI("messages_test")
+            for i in range(5):
+                manager.add_message("user", str(i))
+
+        messages = manager.get_messages()
+        assert messages[0]["role"] == "developer"
+        assert [m["content"] for m in messages[1:]] == ["2", "3", "4"]
+
+    def test_get_messages_returns_copy(self, session_state):
+        """get_messages はコピー、snapshot は変更がなければ同一オブジェクト"""
+        from helper_st import MessageManagerUI
+
+        manager = MessageManagerUI("messages_test")
+        manager.get_messages().append({"role": "user", "content": "x"})
+        assert len(manager.get_messages()) == 1
+        assert manager.snapshot() is manager.snapshot()
+
+    def test_legacy_list_converted(self, session_state):
+        """旧形式（リスト）のセッション値も扱える"""
+        from helper_st import MessageManagerUI
+
+        session_state["messages_test"] = [{"role": "user", "content": "old"}]
+        manager = MessageManagerUI("messages_test")
+        manager.add_message("assistant", "new")
+        assert [m["content"] for m in manager.get_messages()] == ["old", "new"]
+
+
+# ==================================================
+# ストリーミング表示のテスト
+# ==================================================
+class FakeStream:
+    """messages.stream() の戻り値を模したコンテキストマネージャ"""
+
+    def __init__(self, chunks, final_message):
+        self.text_stream = iter(chunks)
+        self._final = final_message
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def get_final_message(self):
+        return self._final
+
+
+class TestStreamingDisplay:
+    """display_streaming_response / create_message のテスト"""
+
+    def test_streaming_consumes_deltas(self, session_state):
+        """テキスト差分を順に描画し、最終Messageを返す"""
+        import helper_st
+        from helper_st import ResponseProcessorUI
+
+        rendered = []
+        helper_st.st.empty.reset_mock()
+        helper_st.st.caption.reset_mock()
+        helper_st.st.write_stream.side_effect = lambda gen: rendered.append("".join(gen))
+        final = MagicMock()
+        final.usage.output_tokens = 3
+
+        response = ResponseProcessorUI.display_streaming_response(
+            FakeStream(["こん", "にち", "は"], final), transient=True
+        )
+
+        assert response is final
+        assert rendered == ["こんにちは"]
+        # 逐次表示を消去した後も、usage から算出した計測結果は残る
+        helper_st.st.empty.return_value.empty.assert_called_once()
+        summary = helper_st.st.caption.call_args.args[0]
+        assert "tokens/s" in summary and "出力 3 tokens" in summary
+
+    def test_create_message_non_stream(self, session_state):
+        """stream=False の場合は messages.create を呼び出す"""
+        from helper_st import ResponseProcessorUI
+
+        client = MagicMock()
+        response = ResponseProcessorUI.create_message(client, stream=False, model="m", max_tokens=10)
+
+        client.messages.create.assert_called_once_with(model="m", max_tokens=10)
+        client.messages.stream.assert_not_called()
+        assert response is client.messages.create.return_value
+
+    def test_create_message_stream(self, session_state):
+        """stream=True の場合は messages.stream を経由する"""
+        import helper_st
+        from helper_st import ResponseProcessorUI
+
+        helper_st.st.write_stream.side_effect = lambda gen: "".join(gen)
+        final = MagicMock()
+        final.usage.output_tokens = 1
+        client = MagicMock()
+        client.messages.stream.return_value = FakeStream(["a"], final)
+
+        response = ResponseProcessorUI.create_message(client, stream=True, model="m", max_tokens=10)
+
+        client.messages.create.assert_not_called()
+        assert response is final